@@ -3,9 +3,106 @@ import threading
 import os
 import time
 import platform
+import select
+import collections
+import bisect
+import functools
+import hashlib
+import zlib
 
 #global
 PEER_HOST = socket.gethostname()
+BATCH_ADD_SIZE = 50000  # entries per ADD RFCS request; the server's cap
+PIPELINE_WINDOW = 32    # requests in flight at once in pipelined mode
+V2_VERSION = "P2P-CI/2.0"
+SUPPORTED_VERSIONS = ("P2P-CI/1.0", V2_VERSION)
+
+# P2P-CI/2.0 binary framing -- see the protocol notes in server.py. Every message is
+# a varint body length and the body; requests start with one of these opcodes.
+OP_ADD = 1
+OP_ADD_BATCH = 2
+OP_LOOKUP = 3
+OP_LIST = 4
+OP_KEEPALIVE = 6
+OP_LIST_SINCE = 7
+OP_SUBSCRIBE = 8
+OP_SEARCH = 9
+
+KEEPALIVE_ROUNDS = 3  # heartbeats per lease, so one late KEEPALIVE doesn't cost the records
+CONNECT_ATTEMPTS = 5  # tries at startup while the server answers 503 (at its connection cap)
+UPLOAD_CAPACITY = 4   # uploads this peer serves comfortably at once; "ranking" servers weigh load by it
+REPORT_INTERVAL = 15  # seconds between upload reports to a "ranking" server that has no leases
+
+SHARD_VNODES = 64     # ring points per shard; must match server.py
+
+# 1.0 wire parsing, on bytes. head_end and parse_head are the same code as in
+# server.py, keep them in step. A head (status or request line plus headers, up to a
+# blank line) is located with find() and decoded in one go, rather than read and
+# decoded line by line.
+MAX_HEAD_BYTES = 8 * 1024  # longest head accepted
+
+
+def head_end(buf, start=0):
+    """(end of the last line, end of the blank line) of the head at buf[start:], or None
+    while the blank line has yet to arrive. Lines may end in CRLF or a bare LF."""
+    crlf = buf.find(b"\n\r\n", start)
+    lf = buf.find(b"\n\n", start, len(buf) if crlf < 0 else crlf + 1)
+    if lf >= 0:
+        return lf, lf + 2
+    if crlf >= 0:
+        return crlf, crlf + 3
+    return None
+
+
+def parse_head(head):
+    """(first line, headers) from a head's bytes, blank line excluded.
+
+    Strict: bad UTF-8, or a header line without a colon or a name, raises ValueError.
+    """
+    lines = str(head, "utf-8").split("\n")
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(":")
+        name = name.strip()
+        if not colon or not name:
+            raise ValueError(f"malformed header line {line!r}")
+        headers[name] = value.strip()
+    return lines[0].strip(), headers
+
+
+@functools.lru_cache(maxsize=64)  # a connection sees the same few status lines over and over
+def parse_status(line):
+    """(status code, reason) of a status line like "P2P-CI/1.0 404 Not Found"; ValueError if it isn't one."""
+    parts = line.split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("P2P-CI/") or len(parts[1]) != 3 or not parts[1].isdigit():
+        raise ValueError(f"malformed status line {line!r}")
+    return int(parts[1]), parts[2].strip() if len(parts) > 2 else ""
+
+
+def read_file_head(sock_file):
+    """(first line, headers) of the head arriving on a makefile(); ("", {}) at end of stream.
+
+    Lines are read one at a time but only decoded once, together.
+    """
+    lines = []
+    size = 0
+    while True:
+        line = sock_file.readline(MAX_HEAD_BYTES + 1)
+        size += len(line)
+        if size > MAX_HEAD_BYTES:
+            raise ValueError("head too large")
+        if not line or (lines and line in (b"\r\n", b"\n")):
+            break
+        if lines or line.strip():  # blank lines before a head are skipped
+            lines.append(line)
+    if not lines:
+        return "", {}
+    return parse_head(b"".join(lines).rstrip(b"\r\n"))
+
+
+# GETs this peer is serving and has served since its last report to the server
+upload_counts = {'active': 0, 'served': 0}
+upload_lock = threading.Lock()
 
 
 # upload server -- get rfc
@@ -50,48 +147,59 @@ def extract_title_from_file(filename, rfc_number):
     
     return f"RFC {rfc_number}"
 
-def register_local_rfcs(ci_file, upload_port):
+def register_local_rfcs(ci_file, upload_port, features, owned=None):
+    """ADD every local rfc<N>.txt -- or, given `owned`, those whose N it accepts."""
     print("[Peer] Scanning for local RFC files...")
-    
+
     try:
         files = os.listdir('.')
     except Exception as e:
         print(f"[Peer] Error reading directory: {e}")
         return False
-    
+
     rfc_files = [f for f in files if f.startswith('rfc') and f.endswith('.txt')]
-    
+
     if not rfc_files:
         print("[Peer] No local RFC files found.")
         return True
-    
+
     print(f"[Peer] Found {len(rfc_files)} RFC file(s)")
-    
+
+    entries = []
     for filename in rfc_files:
         try:
-            rfc_number_str = filename[3:-4]
-            rfc_number = int(rfc_number_str)
-            
-            title = extract_title_from_file(filename, rfc_number)
-            
-            print(f"[Peer] Registering RFC {rfc_number}: {title}")
-            
-            success = send_add(ci_file, rfc_number, title, upload_port)
-            if not success:
-                print("[Peer] Registration failed - port conflict or server error")
-                return False
-            
+            rfc_number = int(filename[3:-4])
         except ValueError:
             print(f"[Peer] Skipping invalid filename: {filename}")
             continue
-        except (BrokenPipeError, ConnectionResetError, OSError) as e:
-            print(f"[Peer] Connection error during registration: {e}")
-            print("[Peer] Server rejected the connection - port may be in use")
-            return False
-        except Exception as e:
-            print(f"[Peer] Error registering {filename}: {e}")
-            return False
-    
+        if owned is not None and not owned(rfc_number):
+            continue  # another shard's
+        title = extract_title_from_file(filename, rfc_number)
+        print(f"[Peer] Registering RFC {rfc_number}: {title}")
+        entries.append((rfc_number, title))
+
+    try:
+        # one ADD RFCS round trip per BATCH_ADD_SIZE files when the server supports it
+        if "batch-add" in features:
+            for i in range(0, len(entries), BATCH_ADD_SIZE):
+                if not send_add_batch(ci_file, entries[i:i + BATCH_ADD_SIZE], upload_port):
+                    print("[Peer] Registration failed - port conflict or server error")
+                    return False
+        else:
+            for rfc_number, title in entries:
+                success = send_add(ci_file, rfc_number, title, upload_port)
+                if not success:
+                    print("[Peer] Registration failed - port conflict or server error")
+                    return False
+
+    except (BrokenPipeError, ConnectionResetError, OSError) as e:
+        print(f"[Peer] Connection error during registration: {e}")
+        print("[Peer] Server rejected the connection - port may be in use")
+        return False
+    except Exception as e:
+        print(f"[Peer] Error during registration: {e}")
+        return False
+
     print("[Peer] Registration complete.")
     return True
 
@@ -100,8 +208,11 @@ def handle_get_rfc(conn, addr):
     print(f"[UPLOAD SERVER] Connection from {addr}")
 
     try:
-        # read request line
-        request_line = conn_file.readline().decode().strip()
+        try:
+            request_line, headers = read_file_head(conn_file)
+        except ValueError:
+            send_err(conn_file, 400, "Bad Request")
+            return
         if not request_line:
             return
 
@@ -125,8 +236,6 @@ def handle_get_rfc(conn, addr):
             send_err(conn_file, 400, "Bad Request")
             return
 
-        # read headers
-        headers = read_headers(conn_file)
         host = headers.get("Host")
         os_header = headers.get("OS")
 
@@ -134,35 +243,39 @@ def handle_get_rfc(conn, addr):
             send_err(conn_file, 400, "Bad Request")
             return
 
+        # a downloader asking for 2.0 gets the switch line, then a binary reply
+        if headers.get("Upgrade") == V2_VERSION:
+            conn_file.write(f"{V2_VERSION} 101 Switching Protocols\r\n\r\n".encode())
+            conn_file.protocol = 2
+
         # rfc file
         rfc_file = f"rfc{rfc_number}.txt"
         if not os.path.isfile(rfc_file):
             send_err(conn_file, 404, "Not Found")
             return
 
-        send_rfc(conn_file, rfc_file, rfc_number)
+        with upload_lock:
+            upload_counts['active'] += 1
+        try:
+            send_rfc(conn_file, rfc_file, rfc_number)
+        finally:
+            with upload_lock:
+                upload_counts['active'] -= 1
+                upload_counts['served'] += 1
 
     finally:
         conn_file.close()
         conn.close()
 
 
-def read_headers(conn_file):
-    headers = {}
-    while True:
-        line = conn_file.readline().decode()
-        if not line:
-            break
-        line = line.strip()
-        if line == "":
-            break
-        if ":" in line:
-            key, value = line.split(":", 1)
-            headers[key.strip()] = value.strip()
-    return headers
-
-
 def send_err(conn_file, code, message):
+    if getattr(conn_file, "protocol", 1) == 2:
+        body = bytearray()
+        put_varint(body, code)
+        put_str(body, message)
+        conn_file.write(frame(body))
+        conn_file.flush()
+        return
     response = f"P2P-CI/1.0 {code} {message}\r\n\r\n"
     conn_file.write(response.encode())
     conn_file.flush()
@@ -173,6 +286,19 @@ def send_rfc(conn_file, filename, rfc_number):
     modified_time = time.ctime(os.path.getmtime(filename))
     os_name = platform.system()
 
+    if getattr(conn_file, "protocol", 1) == 2:
+        # status, size, Last-Modified and OS in one frame; the file follows it raw
+        body = bytearray()
+        put_varint(body, 200)
+        put_varint(body, file_size)
+        put_str(body, modified_time)
+        put_str(body, os_name)
+        conn_file.write(frame(body))
+        with open(filename, 'rb') as f:
+            conn_file.write(f.read())
+        conn_file.flush()
+        return
+
     header = (
         "P2P-CI/1.0 200 OK\r\n"
         f"Date: {time.ctime()}\r\n"
@@ -192,11 +318,247 @@ def send_rfc(conn_file, filename, rfc_number):
 
 
 # client side -- talk to ci server
+class CIStream:
+    """The CI connection as a file that sets aside what SUBSCRIBE pushes.
+
+    The server sends pushes only between responses -- "NOTIFY ..." lines in 1.0,
+    frames with status 0 in 2.0 -- so read_head() and read_frame() file them in
+    `notices` and hand request/response code only the response. It buffers reads
+    itself so ready() can tell whether anything is waiting.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+        self.out = bytearray()
+        self.protocol = 1  # becomes 2 if query_features negotiates P2P-CI/2.0
+        self.shards = []   # a sharded server's "host:port" list, from query_features
+        self.standbys = [] # the server's hot standbys, "host:port" each, from query_features
+        self.deflate = False  # the server compresses LOOKUP and LIST bodies on request
+        self.notices = collections.deque()
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        self.buf += data
+        return bool(data)
+
+    def read(self, n):
+        while len(self.buf) < n and self._fill():
+            pass
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def _readline(self):
+        start = 0
+        while True:
+            end = self.buf.find(b"\n", start)
+            if end >= 0:
+                line = bytes(self.buf[:end + 1])
+                del self.buf[:end + 1]
+                return line
+            start = len(self.buf)
+            if not self._fill():
+                return self.read(len(self.buf))
+
+    def read_head(self):
+        """(status line, status code, headers) of the next response.
+
+        Pushes ahead of it are filed in notices. A response that doesn't parse means
+        the stream can't be followed, so it raises ConnectionError like a drop does.
+        """
+        buf = self.buf
+        start = 0
+        while True:
+            if buf.startswith(b"NOTIFY "):
+                end = buf.find(b"\n")
+                if end >= 0:
+                    self.notices.append(parse_notice_line(buf[:end].decode().strip()))
+                    del buf[:end + 1]
+                    start = 0
+                    continue
+            else:
+                found = head_end(buf, start)
+                if found is not None:
+                    last, end = found
+                    try:
+                        status, headers = parse_head(buf[:last])
+                        code = parse_status(status)[0]
+                    except ValueError as e:
+                        raise ConnectionError(f"bad response from server - {e}")
+                    del buf[:end]
+                    return status, code, headers
+            if len(buf) > MAX_HEAD_BYTES:
+                raise ConnectionError("response head too large")
+            start = max(0, len(buf) - 2)
+            if not self._fill():
+                raise ConnectionError("connection closed")
+
+    def read_lines(self):
+        """The entry lines up to the next blank line, decoded in one go."""
+        buf = self.buf
+        start = 0
+        while True:
+            if buf.startswith((b"\r\n", b"\n")):
+                del buf[:buf.index(b"\n") + 1]
+                return []  # no entries at all
+            found = head_end(buf, start)
+            if found is not None:
+                last, end = found
+                if last <= MAX_HEAD_BYTES:
+                    text = str(buf[:last], "utf-8")
+                else:
+                    # a long listing is decoded in place rather than copied out first
+                    with memoryview(buf) as view:
+                        text = str(view[:last], "utf-8")
+                del buf[:end]
+                return text.replace("\r", "").split("\n")
+            # only look at what arrives next, so a long listing is scanned once
+            start = max(0, len(buf) - 2)
+            if not self._fill():
+                raise ConnectionError("connection closed")
+
+    def read_body(self, headers):
+        """The entry lines of a 200 response, whose head gave `headers`."""
+        if headers.get("Content-Encoding") != "deflate":
+            return self.read_lines()
+        try:
+            length = int(headers["Content-Length"])
+        except (KeyError, ValueError):
+            raise ConnectionError("bad response from server - deflate body without a Content-Length")
+        return self.read_deflated(length)
+
+    def read_deflated(self, length):
+        """The entry lines of a deflate body of `length` bytes, inflated as it arrives.
+
+        Each piece is decompressed and split into lines as soon as it is received, so a
+        long listing is never held compressed and decompressed at once.
+        """
+        inflater = zlib.decompressobj()
+        lines = []
+        rest = b""  # an entry line cut off at the end of the last piece
+        while length:
+            if not self.buf and not self._fill():
+                raise ConnectionError("connection closed")
+            size = min(length, len(self.buf))
+            try:
+                with memoryview(self.buf) as view:
+                    data = rest + inflater.decompress(view[:size])
+            except zlib.error as e:
+                raise ConnectionError(f"bad response from server - {e}")
+            del self.buf[:size]
+            length -= size
+            cut = data.rfind(b"\n") + 1
+            if cut:
+                lines.extend(str(data[:cut], "utf-8").replace("\r", "").split("\n")[:-1])
+            rest = data[cut:]
+        if not inflater.eof or rest or lines[-1:] != [""]:
+            raise ConnectionError("bad response from server - truncated deflate body")
+        lines.pop()  # the closing blank line
+        return lines
+
+    def write(self, data):
+        self.out += data
+
+    def flush(self):
+        self.sock.sendall(self.out)
+        self.out.clear()
+
+    def close(self):
+        self.sock.close()
+
+    def ready(self, timeout):
+        """True once something has arrived, waiting up to `timeout` seconds for it."""
+        return bool(self.buf) or bool(select.select([self.sock], [], [], timeout)[0])
+
+    def read_notice(self):
+        # only with no request in flight, when whatever arrives is a push
+        if self.protocol == 2:
+            self.notices.append(decode_notice_v2(read_frame_body(self)))
+            return
+        line = self._readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        if line.startswith(b"NOTIFY "):
+            self.notices.append(parse_notice_line(line.decode().strip()))
+
+
+def parse_notice_line(line):
+    # "NOTIFY ADD RFC ..." / "NOTIFY DEL RFC ..." carry an entry line; "NOTIFY RESYNC" nothing
+    parts = line.split(None, 2)
+    if parts[1] == "RESYNC":
+        return {"event": "resync"}
+    return dict(parse_entry_line(parts[2]), event=parts[1].lower())
+
+
+def decode_notice_v2(body):
+    fields = FrameReader(body)
+    fields.varint()  # status 0
+    kind = fields.varint()
+    if kind == 2:
+        return {"event": "resync"}
+    rfc = fields.varint()
+    return {"event": "add" if kind == 1 else "del", "rfc": rfc, "title": fields.text(),
+            "host": fields.text(), "port": fields.varint()}
+
+
+def send_subscribe(ci_file, upload_port, rfc_number, on=True):
+    """SUBSCRIBE (or UNSUBSCRIBE, on=False) one RFC, or every RFC if rfc_number is None."""
+    if ci_file.protocol == 2:
+        body = bytearray([OP_SUBSCRIBE])
+        # 2 marks a single RFC, so RFC 0 isn't taken for all of them
+        put_varint(body, (1 if on else 0) | (0 if rfc_number is None else 2))
+        put_varint(body, rfc_number or 0)
+        status, fields = request_v2(ci_file, frame(body))
+        return status == 200
+
+    method = "SUBSCRIBE" if on else "UNSUBSCRIBE"
+    target = "ALL" if rfc_number is None else f"RFC {rfc_number}"
+    request = (
+        f"{method} {target} P2P-CI/1.0\r\n"
+        f"Host: {PEER_HOST}\r\n"
+        f"Port: {upload_port}\r\n"
+        "\r\n"
+    )
+    ci_file.write(request.encode())
+    ci_file.flush()
+
+    status, code, _ = ci_file.read_head()
+    print(status)
+    return code == 200
+
+
+def poll_notices(ci_file, timeout=0):
+    """Take the pushes received so far, waiting up to `timeout` seconds if there are none.
+
+    Call it only with no request in flight.
+    """
+    deadline = time.monotonic() + timeout
+    while not ci_file.notices and ci_file.ready(max(0.0, deadline - time.monotonic())):
+        ci_file.read_notice()
+    # and anything else that has already arrived
+    while ci_file.ready(0):
+        ci_file.read_notice()
+    notices = list(ci_file.notices)
+    ci_file.notices.clear()
+    return notices
+
+
+def print_notices(notices):
+    for notice in notices:
+        if notice["event"] == "resync":
+            print("[Peer] Notice: missed some index changes, LOOKUP again to catch up")
+        elif notice["event"] == "add":
+            print(f"[Peer] Notice: RFC {notice['rfc']} {notice['title']} now at {notice['host']}:{notice['port']}")
+        else:
+            print(f"[Peer] Notice: RFC {notice['rfc']} no longer at {notice['host']}:{notice['port']}")
+
+
 def connect_to_ci(ci_host, ci_port):
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((ci_host, ci_port))
-        return sock, sock.makefile('rwb')
+        return sock, CIStream(sock)
     except ConnectionRefusedError:
         print(f"[Peer] Error: Cannot connect to CI server at {ci_host}:{ci_port} - Connection refused")
         print("[Peer] Make sure the server is running")
@@ -209,7 +571,7 @@ def connect_to_ci(ci_host, ci_port):
         return None, None
 
 
-def send_add(ci_file, rfc_number, title, upload_port):
+def format_add(rfc_number, title, upload_port):
     request = (
         f"ADD RFC {rfc_number} P2P-CI/1.0\r\n"
         f"Host: {PEER_HOST}\r\n"
@@ -217,153 +579,760 @@ def send_add(ci_file, rfc_number, title, upload_port):
         f"Title: {title}\r\n"
         "\r\n"
     )
-    ci_file.write(request.encode())
+    return request.encode()
+
+
+def format_lookup(rfc_number, upload_port, title, deflate=False):
+    request = (
+        f"LOOKUP RFC {rfc_number} P2P-CI/1.0\r\n"
+        f"Host: {PEER_HOST}\r\n"
+        f"Port: {upload_port}\r\n"
+        f"Title: {title}\r\n"
+        + ("Accept-Encoding: deflate\r\n" if deflate else "")
+        + "\r\n"
+    )
+    return request.encode()
+
+
+def format_list(upload_port, deflate=False):
+    request = (
+        "LIST ALL P2P-CI/1.0\r\n"
+        f"Host: {PEER_HOST}\r\n"
+        f"Port: {upload_port}\r\n"
+        + ("Accept-Encoding: deflate\r\n" if deflate else "")
+        + "\r\n"
+    )
+    return request.encode()
+
+
+def send_add(ci_file, rfc_number, title, upload_port):
+    if ci_file.protocol == 2:
+        status, fields = request_v2(ci_file, encode_add_v2(rfc_number, title))
+        if status != 200:
+            return False
+        for entry in read_entries(fields):
+            print(entry_line(entry))
+        return True
+
+    ci_file.write(format_add(rfc_number, title, upload_port))
     ci_file.flush()
 
-    # read and print status line
-    status = ci_file.readline().decode()
-    print(status, end="")
-    
-    # Check for errors
-    if "400" in status or "404" in status or "505" in status:
-        ci_file.readline()
+    # status line, blank line, the entry as registered, blank line
+    status, code, _ = ci_file.read_head()
+    print(status)
+    if code != 200:
         return False
+    print()
+    print("\n".join(ci_file.read_lines()))
+    print()
+    return True
 
-    blank = ci_file.readline().decode()
-    print(blank, end="")
 
-    # rfc line (if any)
-    line = ci_file.readline().decode()
-    print(line, end="")
-    
-    final_blank = ci_file.readline().decode()
-    print(final_blank, end="")
-    return True 
+class ServerBusy(ConnectionError):
+    """The server turned the connection away (503); try again after retry_after seconds."""
 
+    def __init__(self, retry_after):
+        super().__init__(f"server busy, retry after {retry_after:g}s")
+        self.retry_after = retry_after
+
+
+def query_features(ci_file, upload_port):
+    """Ask the server which optional features it supports; older servers answer 400.
+
+    If it lists "binary", the connection is then upgraded to P2P-CI/2.0. Raises
+    ServerBusy if the server is at its connection limit.
+    """
+    ci_file.write(b"OPTIONS P2P-CI/1.0\r\n\r\n")
+    ci_file.flush()
+
+    _, code, headers = ci_file.read_head()
+    if code == 503:
+        try:
+            retry_after = float(headers.get("Retry-After", "1"))
+        except ValueError:
+            retry_after = 1.0
+        raise ServerBusy(retry_after)
+    if code != 200:
+        return set()
+
+    features = headers.get("Features", "")
+    features = {feature.strip() for feature in features.split(",") if feature.strip()}
+    ci_file.shards = [name.strip() for name in headers.get("Shards", "").split(",") if name.strip()]
+    ci_file.standbys = [name.strip() for name in headers.get("Standbys", "").split(",") if name.strip()]
+    ci_file.deflate = "deflate" in features
+    if "binary" in features:
+        upgrade_to_v2(ci_file, upload_port)
+    return features
+
+
+def upload_report():
+    """(uploads active, uploads served since the last report, capacity) for the server."""
+    with upload_lock:
+        served, upload_counts['served'] = upload_counts['served'], 0
+        return upload_counts['active'], served, UPLOAD_CAPACITY
+
+
+def send_keepalive(ci_file, upload_port, token, report=False):
+    """Renew this peer's lease: (session token, lease seconds, resumed), or None if refused.
+
+    `resumed` is True when the server still holds what was registered under `token`.
+    With `report` (servers listing "ranking") it also tells the server how busy this
+    peer's uploads are, so LOOKUPs steer downloaders elsewhere when it is loaded.
+    """
+    if ci_file.protocol == 2:
+        body = bytearray([OP_KEEPALIVE])
+        put_str(body, token or "")
+        if report:
+            for count in upload_report():
+                put_varint(body, count)
+        ci_file.write(frame(body))
+        ci_file.flush()
+        fields = FrameReader(read_frame(ci_file))
+        if fields.varint() != 200:
+            return None
+        return fields.text(), fields.varint() / 1000, fields.varint() == 1
 
-def send_lookup(ci_file, rfc_number, upload_port, title):
     request = (
-        f"LOOKUP RFC {rfc_number} P2P-CI/1.0\r\n"
+        "KEEPALIVE P2P-CI/1.0\r\n"
         f"Host: {PEER_HOST}\r\n"
         f"Port: {upload_port}\r\n"
-        f"Title: {title}\r\n"
+        + (f"Session: {token}\r\n" if token else "")
+    )
+    if report:
+        active, served, capacity = upload_report()
+        request += (f"Uploads-Active: {active}\r\nUploads-Served: {served}\r\n"
+                    f"Upload-Capacity: {capacity}\r\n")
+    request += "\r\n"
+
+    ci_file.write(request.encode())
+    ci_file.flush()
+
+    _, code, headers = ci_file.read_head()
+    if code != 200:
+        return None
+    return headers.get("Session", ""), float(headers.get("Lease", "0")), headers.get("Resumed") == "yes"
+
+
+def resume_or_register(ci, upload_port, features):
+    """Resume the lease in ci['token'] if the server kept it, else register the local RFCs."""
+    if "keepalive" in features:
+        lease = send_keepalive(ci['file'], upload_port, ci['token'], "ranking" in features)
+        if lease is not None:
+            ci['token'], ci['lease'], resumed = lease
+            if resumed:
+                print("[Peer] Server kept this peer's records, lease resumed")
+                return True
+    return register_local_rfcs(ci['file'], upload_port, features, owned_by(ci))
+
+
+def reconnect(ci, upload_port):
+    """Open a new CI connection after the old one dropped; caller holds ci['lock'].
+
+    If the server is gone, fails over to the first of its standbys that answers.
+    """
+    try:
+        ci['sock'].close()
+    except OSError:
+        pass
+    sock, ci_file = connect_to_ci(ci['host'], ci['port'])
+    if sock is None:
+        for standby in ci['file'].standbys:
+            host, _, port = standby.rpartition(":")
+            sock, ci_file = connect_to_ci(host, int(port))
+            if sock is not None:
+                print(f"[Peer] Failing over to standby {standby}")
+                ci['host'], ci['port'] = host, int(port)
+                break
+        else:
+            return False
+    old_file = ci['file']
+    ci['sock'], ci['file'] = sock, ci_file
+    try:
+        ci['features'] = query_features(ci_file, upload_port)
+        # keep somewhere to fail over to, even if a standby has no standbys of its own
+        ci_file.standbys = ci_file.standbys or [standby for standby in old_file.standbys
+                                                if standby != f"{ci['host']}:{ci['port']}"]
+        if resume_or_register(ci, upload_port, ci['features']):
+            print("[Peer] Reconnected to server")
+            # subscriptions belong to the connection; missed pushes mean a resync
+            for rfc_number in ci['subscriptions']:
+                send_subscribe(ci_file, upload_port, rfc_number)
+            if ci['subscriptions']:
+                ci_file.notices.append({"event": "resync"})
+            return True
+    except (OSError, ValueError) as e:
+        print(f"[Peer] Reconnect failed: {e}")
+    return False
+
+
+def keepalive_loop(ci, upload_port):
+    """Heartbeat thread: renew the lease KEEPALIVE_ROUNDS times per lease period, or
+    just report uploads every REPORT_INTERVAL to a "ranking" server without leases."""
+    while True:
+        time.sleep(ci['lease'] / KEEPALIVE_ROUNDS if ci['lease'] else REPORT_INTERVAL)
+        with ci['lock']:
+            if ci['sock'] is None:  # EXIT
+                return
+            for conn in connections(ci):
+                try:
+                    lease = send_keepalive(conn['file'], upload_port, conn['token'], "ranking" in conn['features'])
+                except (OSError, ValueError):
+                    lease = None
+                if lease is None:
+                    print("[Peer] Lost the server connection, reconnecting...")
+                    reconnect(conn, upload_port)
+                    continue
+                conn['token'], conn['lease'], resumed = lease
+                if not resumed:
+                    print("[Peer] Lease ran out on the server, registering again")
+                    register_local_rfcs(conn['file'], upload_port, conn['features'], owned_by(conn))
+
+
+def upgrade_to_v2(ci_file, upload_port):
+    request = (
+        "OPTIONS P2P-CI/1.0\r\n"
+        f"Host: {PEER_HOST}\r\n"
+        f"Port: {upload_port}\r\n"
+        f"Upgrade: {V2_VERSION}\r\n"
         "\r\n"
     )
     ci_file.write(request.encode())
     ci_file.flush()
 
+    status, code, _ = ci_file.read_head()
+    if code == 101 and status.startswith(V2_VERSION):
+        ci_file.protocol = 2
+
+
+def send_add_batch(ci_file, entries, upload_port):
+    """Register many (rfc_number, title) pairs with a single ADD RFCS request."""
+    if ci_file.protocol == 2:
+        status, fields = request_v2(ci_file, encode_add_batch_v2(entries))
+        if status != 200:
+            return False
+        count, added = fields.varint(), fields.varint()
+        print(f"[Peer] Registered {count} RFC(s), {added} new")
+        return True
+
+    lines = [
+        "ADD RFCS P2P-CI/1.0\r\n"
+        f"Host: {PEER_HOST}\r\n"
+        f"Port: {upload_port}\r\n"
+        f"Count: {len(entries)}\r\n"
+        "\r\n"
+    ]
+    lines.extend(f"RFC {rfc_number} {title}\r\n" for rfc_number, title in entries)
+    ci_file.write("".join(lines).encode())
+    ci_file.flush()
+
+    status, code, headers = ci_file.read_head()
+    print(status)
+    if code != 200:
+        return False
+
+    print(f"[Peer] Registered {headers.get('Count', len(entries))} RFC(s), "
+          f"{headers.get('Added', '?')} new")
+    return True
+
+
+def send_lookup(ci_file, rfc_number, upload_port, title):
+    if ci_file.protocol == 2:
+        return print_entries_v2(*request_v2(ci_file, encode_lookup_v2(rfc_number)))
+
+    ci_file.write(format_lookup(rfc_number, upload_port, title, ci_file.deflate))
+    ci_file.flush()
+
     # read status line
-    status = ci_file.readline().decode().strip()
+    status, code, headers = ci_file.read_head()
     print(status)
-    
+
     # Check for any error status
-    if "400" in status:
+    if code == 400:
         print("[Peer] Error: Bad Request")
-        ci_file.readline()
         return []
-    elif "404" in status:
+    elif code == 404:
         print("[Peer] Error: RFC not found")
-        ci_file.readline()
         return []
-    elif "505" in status:
+    elif code == 505:
         print("[Peer] Error: Protocol version not supported")
-        ci_file.readline()
         return []
-    elif "200" not in status:
+    elif code != 200:
         print(f"[Peer] Error: Unexpected response: {status}")
-        ci_file.readline()
         return []
 
-    ci_file.readline()
+    lines = ci_file.read_body(headers)
 
-    entries = []
-    while True:
-        line = ci_file.readline().decode().strip()
-        if line == "":
-            break
-        print(line)
-        parts = line.split()
-        if parts[0] == "RFC":
-            rfc = int(parts[1])
-            port = int(parts[-1])
-            host = parts[-2]
-            title = " ".join(parts[2:-2])
-        else:
-            # Fallback if no RFC prefix
-            rfc = int(parts[0])
-            port = int(parts[-1])
-            host = parts[-2]
-            title = " ".join(parts[1:-2])
-        entries.append({
-            "rfc": rfc,
-            "title": title,
-            "host": host,
-            "port": port
-        })
-
-    return entries
+    # one stdout write for the whole response rather than one per entry
+    if lines:
+        print("\n".join(lines))
+    return [parse_entry_line(line) for line in lines]
 
 
-def send_list(ci_file, upload_port):
+def format_search(ci_file, query, upload_port, limit=0):
+    if ci_file.protocol == 2:
+        body = bytearray([OP_SEARCH])
+        put_str(body, query)
+        put_varint(body, limit)
+        return frame(body)
     request = (
-        "LIST ALL P2P-CI/1.0\r\n"
+        "SEARCH P2P-CI/1.0\r\n"
         f"Host: {PEER_HOST}\r\n"
         f"Port: {upload_port}\r\n"
-        "\r\n"
+        f"Query: {query}\r\n"
+        + (f"Limit: {limit}\r\n" if limit else "")
+        + "\r\n"
     )
-    ci_file.write(request.encode())
+    return request.encode()
+
+
+def read_search(ci_file):
+    """Read a SEARCH response: (status line, status code, matching RFCs in all, entries)."""
+    if ci_file.protocol == 2:
+        fields = FrameReader(read_frame(ci_file))
+        status = fields.varint()
+        if status != 200:
+            return f"{V2_VERSION} {status} {fields.text()}", status, 0, []
+        total = fields.varint()
+        return f"{V2_VERSION} 200 OK", 200, total, read_entries(fields)
+
+    status, code, headers, lines = read_response(ci_file, True)
+    entries = [parse_entry_line(line) for line in lines]
+    return status, code, int(headers.get("Matches", len(lines))), entries
+
+
+def send_search(ci_file, query, upload_port, limit=0):
+    """SEARCH RFC titles ("tcp congest*": every word, * for a prefix); limit 0 takes the server's default."""
+    ci_file.write(format_search(ci_file, query, upload_port, limit))
     ci_file.flush()
 
-    status = ci_file.readline().decode().strip()
+    status, code, total, entries = read_search(ci_file)
     print(status)
-    
+    if code == 404:
+        print("[Peer] Error: No matching RFCs")
+        return []
+    if code != 200:
+        return []
+    print(f"[Peer] {total} matching RFC(s)")
+    if entries:
+        print("\n".join(map(entry_line, entries)))
+    return entries
+
+
+def send_list(ci_file, upload_port):
+    if ci_file.protocol == 2:
+        status, fields = request_v2(ci_file, encode_list_v2())
+        if status == 200:
+            fields.varint()  # no cursor on a whole listing
+        return print_entries_v2(status, fields)
+
+    ci_file.write(format_list(upload_port, ci_file.deflate))
+    ci_file.flush()
+
+    status, code, headers = ci_file.read_head()
+    print(status)
+
     # Check for any error status
-    if "400" in status:
+    if code == 400:
         print("[Peer] Error: Bad Request")
-        ci_file.readline()
         return []
-    elif "404" in status:
+    elif code == 404:
         print("[Peer] Error: No RFCs available")
-        ci_file.readline()
         return []
-    elif "505" in status:
+    elif code == 505:
         print("[Peer] Error: Protocol version not supported")
-        ci_file.readline()
         return []
-    elif "200" not in status:
+    elif code != 200:
         print(f"[Peer] Error: Unexpected response: {status}")
-        ci_file.readline()
         return []
 
-    ci_file.readline()
+    lines = ci_file.read_body(headers)
 
-    entries = []
+    # one stdout write for the whole response rather than one per entry
+    if lines:
+        print("\n".join(lines))
+    return [parse_entry_line(line) for line in lines]
+
+
+def read_list(ci_file):
+    """The entries of an unpaged LIST ALL response, printing nothing; [] for a 404."""
+    if ci_file.protocol == 2:
+        fields = FrameReader(read_frame(ci_file))
+        status = fields.varint()
+        if status != 200:
+            if status != 404:
+                print(f"[Peer] Error: Unexpected response: {V2_VERSION} {status} {fields.text()}")
+            return []
+        fields.varint()  # no cursor on a whole listing
+        return read_entries(fields)
+
+    status, code, _, lines = read_response(ci_file, True)
+    if code != 200 and code != 404:
+        print(f"[Peer] Error: Unexpected response: {status}")
+    return [parse_entry_line(line) for line in lines]
+
+
+def iter_list(ci_file, upload_port, page_size=1000):
+    """Yield LIST ALL entries lazily, fetching one page of page_size entries at a time."""
+    if ci_file.protocol == 2:
+        yield from iter_list_v2(ci_file, page_size)
+        return
+
+    cursor = None
     while True:
-        line = ci_file.readline().decode().strip()
-        if line == "":
-            break
-        print(line)
-        parts = line.split()
-        if parts[0] == "RFC":
-            rfc = int(parts[1])
-            port = int(parts[-1])
-            host = parts[-2]
-            title = " ".join(parts[2:-2])
+        request = (
+            "LIST ALL P2P-CI/1.0\r\n"
+            f"Host: {PEER_HOST}\r\n"
+            f"Port: {upload_port}\r\n"
+            f"Limit: {page_size}\r\n"
+        )
+        if cursor:
+            request += f"Cursor: {cursor}\r\n"
+        if ci_file.deflate:
+            request += "Accept-Encoding: deflate\r\n"
+        request += "\r\n"
+        ci_file.write(request.encode())
+        ci_file.flush()
+
+        status, code, headers = ci_file.read_head()
+        if code != 200:
+            if code != 404:
+                print(f"[Peer] Error: Unexpected response: {status}")
+            return
+
+        # a server without paging ignores Limit and sends everything with no Cursor
+        cursor = headers.get("Cursor")
+
+        # read the whole page before handing entries out so the stream stays in sync
+        page = [parse_entry_line(line) for line in ci_file.read_body(headers)]
+        yield from page
+
+        if not cursor:
+            return
+
+
+def send_list_since(ci_file, upload_port, since, epoch):
+    """One LIST SINCE round trip: (epoch, generation, changes), or None if it failed.
+
+    changes are (added, entry) pairs in index order, entry as parse_entry_line returns
+    it -- or None when the server's change log no longer reaches back to `since`.
+    """
+    if ci_file.protocol == 2:
+        body = bytearray([OP_LIST_SINCE])
+        put_varint(body, since)
+        put_str(body, epoch or "")
+        ci_file.write(frame(body))
+        ci_file.flush()
+        fields = FrameReader(read_frame(ci_file))
+        status = fields.varint()
+        if status == 410:
+            fields.text()
+            return fields.text(), fields.varint(), None
+        if status != 200:
+            print(f"[Peer] Error: Unexpected response: {V2_VERSION} {status} {fields.text()}")
+            return None
+        epoch, generation = fields.text(), fields.varint()
+        changes = []
+        for _ in range(fields.varint()):
+            added = fields.varint() == 1
+            rfc = fields.varint()
+            changes.append((added, {"rfc": rfc, "title": fields.text(), "host": fields.text(),
+                                    "port": fields.varint()}))
+        return epoch, generation, changes
+
+    request = (
+        f"LIST SINCE {since} P2P-CI/1.0\r\n"
+        f"Host: {PEER_HOST}\r\n"
+        f"Port: {upload_port}\r\n"
+        + (f"Epoch: {epoch}\r\n" if epoch else "")
+        + "\r\n"
+    )
+    ci_file.write(request.encode())
+    ci_file.flush()
+
+    status, code, headers, lines = read_response(ci_file, True)
+    if code != 200 and code != 410:
+        print(f"[Peer] Error: Unexpected response: {status}")
+        return None
+    epoch, generation = headers.get("Epoch"), int(headers.get("Generation", "0"))
+    if code == 410:
+        return epoch, generation, None
+    # each line is an entry line prefixed with ADD or DEL
+    return epoch, generation, [(line.startswith("ADD "), parse_entry_line(line[4:])) for line in lines]
+
+
+def new_replica():
+    """A local copy of the index that sync_replica keeps current."""
+    return {'epoch': None, 'generation': None, 'entries': {}}
+
+
+def sync_replica(ci_file, upload_port, replica):
+    """Apply the index changes since the replica's generation; returns how many, or None.
+
+    Only a replica that is new, or too far behind for the server's change log, is
+    refilled from a full LIST ALL; otherwise the cost follows the number of changes.
+    replica['entries'] maps (rfc, host, port) to the title.
+    """
+    result = send_list_since(ci_file, upload_port, replica['generation'] or 0, replica['epoch'])
+    if result is None:
+        return None
+    epoch, generation, changes = result
+    if changes is None:
+        # the listing is at least as new as `generation`, and replaying a change
+        # it already has is harmless, so the next sync picks up from there
+        entries = {}
+        for entry in iter_list(ci_file, upload_port):
+            entries[(entry['rfc'], entry['host'], entry['port'])] = entry['title']
+        replica.update(epoch=epoch, generation=generation, entries=entries)
+        return len(entries)
+
+    entries = replica['entries']
+    for added, entry in changes:
+        key = (entry['rfc'], entry['host'], entry['port'])
+        if added:
+            entries[key] = entry['title']
         else:
-            rfc = int(parts[0])
-            port = int(parts[-1])
-            host = parts[-2]
-            title = " ".join(parts[1:-2])
-        entries.append({
-            "rfc": rfc,
-            "title": title,
-            "host": host,
-            "port": port
-        })
+            entries.pop(key, None)
+    replica.update(epoch=epoch, generation=generation)
+    return len(changes)
+
+
+def read_response(ci_file, has_body):
+    """Read one CI response: (status line, status code, headers, body lines).
+
+    has_body is True for ADD/LOOKUP/LIST, whose 200 responses carry entry lines
+    up to a blank line after the header block.
+    """
+    status, code, headers = ci_file.read_head()
+    lines = ci_file.read_body(headers) if has_body and code == 200 else []
+    return status, code, headers, lines
+
+
+def send_pipelined(ci_file, requests, window=PIPELINE_WINDOW):
+    """Send (request_bytes, has_body) pairs with up to `window` of them awaiting answers.
+
+    The server answers strictly in order, so responses come back as a list matching
+    `requests`. One round trip covers a whole window instead of a single request.
+    """
+    responses = []
+    sent = 0
+    while len(responses) < len(requests):
+        burst = []
+        while sent < len(requests) and sent - len(responses) < window:
+            burst.append(requests[sent][0])
+            sent += 1
+        if burst:
+            ci_file.write(b"".join(burst))
+            ci_file.flush()
+        if ci_file.protocol == 2:
+            responses.append(read_frame(ci_file))
+        else:
+            responses.append(read_response(ci_file, requests[len(responses)][1]))
+    return responses
+
+
+def lookup_many(ci_file, rfc_numbers, upload_port, window=PIPELINE_WINDOW):
+    """Pipelined LOOKUP sweep; returns {rfc_number: entries}, empty for RFCs nobody holds."""
+    if ci_file.protocol == 2:
+        requests = [(encode_lookup_v2(rfc_number), True) for rfc_number in rfc_numbers]
+        results = {}
+        for rfc_number, body in zip(rfc_numbers, send_pipelined(ci_file, requests, window)):
+            fields = FrameReader(body)
+            results[rfc_number] = read_entries(fields) if fields.varint() == 200 else []
+        return results
+
+    requests = [(format_lookup(rfc_number, upload_port, f"RFC {rfc_number}", ci_file.deflate), True)
+                for rfc_number in rfc_numbers]
+    responses = send_pipelined(ci_file, requests, window)
+    return {rfc_number: [parse_entry_line(line) for line in lines]
+            for rfc_number, (_status, _code, _headers, lines) in zip(rfc_numbers, responses)}
+
 
+def put_varint(buf, n):
+    while n > 0x7f:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def put_str(buf, text):
+    data = text.encode()
+    put_varint(buf, len(data))
+    buf += data
+
+
+def frame(body):
+    head = bytearray()
+    put_varint(head, len(body))
+    head += body
+    return bytes(head)
+
+
+class FrameReader:
+    """Reads fields off one 2.0 frame body; truncated or malformed data raises ValueError."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def varint(self):
+        n = shift = 0
+        while True:
+            if self.pos >= len(self.data) or shift > 63:
+                raise ValueError("bad varint")
+            byte = self.data[self.pos]
+            self.pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def text(self):
+        size = self.varint()
+        end = self.pos + size
+        if end > len(self.data):
+            raise ValueError("truncated string")
+        value = self.data[self.pos:end].decode()
+        self.pos = end
+        return value
+
+
+def read_frame(conn_file):
+    """Read the next 2.0 response frame and return its body, filing pushes before it."""
+    while True:
+        body = read_frame_body(conn_file)
+        if body[:1] != b"\x00":  # a response status is never 0
+            return body
+        conn_file.notices.append(decode_notice_v2(body))
+
+
+def read_frame_body(conn_file):
+    """Read one 2.0 frame and return its body."""
+    size = shift = 0
+    while True:
+        byte = conn_file.read(1)
+        if not byte:
+            raise ConnectionError("connection closed mid-frame")
+        size |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            break
+        shift += 7
+    body = conn_file.read(size)
+    if len(body) < size:
+        raise ConnectionError("connection closed mid-frame")
+    return body
+
+
+def encode_add_v2(rfc_number, title):
+    body = bytearray([OP_ADD])
+    put_varint(body, rfc_number)
+    put_str(body, title)
+    return frame(body)
+
+
+def encode_add_batch_v2(entries):
+    body = bytearray([OP_ADD_BATCH])
+    put_varint(body, len(entries))
+    for rfc_number, title in entries:
+        put_varint(body, rfc_number)
+        put_str(body, title)
+    return frame(body)
+
+
+def encode_lookup_v2(rfc_number):
+    body = bytearray([OP_LOOKUP])
+    put_varint(body, rfc_number)
+    return frame(body)
+
+
+def encode_list_v2(limit=0, cursor=(0, 0)):
+    # limit 0 asks for the whole listing
+    body = bytearray([OP_LIST])
+    put_varint(body, limit)
+    put_varint(body, cursor[0])
+    put_varint(body, cursor[1])
+    return frame(body)
+
+
+def request_v2(ci_file, request):
+    """Send one framed request and read its reply: (status, FrameReader past the status).
+
+    Prints the reply's status line the way a 1.0 reply's would be printed.
+    """
+    ci_file.write(request)
+    ci_file.flush()
+    fields = FrameReader(read_frame(ci_file))
+    status = fields.varint()
+    reason = "OK" if status == 200 else fields.text()
+    print(f"{V2_VERSION} {status} {reason}")
+    return status, fields
+
+
+def read_entries(fields):
+    """Decode an entry block into the dicts parse_entry_line returns."""
+    peers = [(fields.text(), fields.varint()) for _ in range(fields.varint())]
+    entries = []
+    for _ in range(fields.varint()):
+        rfc = fields.varint()
+        for _ in range(fields.varint()):
+            host, port = peers[fields.varint()]
+            entries.append({"rfc": rfc, "title": fields.text(), "host": host, "port": port})
+    return entries
+
+
+def print_entries_v2(status, fields):
+    if status != 200:
+        return []
+    entries = read_entries(fields)
+    # one stdout write for the whole response rather than one per entry
+    if entries:
+        print("\n".join(map(entry_line, entries)))
     return entries
 
 
+def iter_list_v2(ci_file, page_size):
+    cursor = (0, 0)
+    while True:
+        ci_file.write(encode_list_v2(page_size, cursor))
+        ci_file.flush()
+        fields = FrameReader(read_frame(ci_file))
+        status = fields.varint()
+        if status != 200:
+            if status != 404:
+                print(f"[Peer] Error: Unexpected response: {V2_VERSION} {status} {fields.text()}")
+            return
+        more = fields.varint()
+        if more:
+            cursor = (fields.varint(), fields.varint())
+        yield from read_entries(fields)
+        if not more:
+            return
+
+
+def entry_line(entry):
+    return f"RFC {entry['rfc']} {entry['title']} {entry['host']} {entry['port']}"
+
+
+def parse_entry_line(line):
+    parts = line.split()
+    if parts[0] == "RFC":
+        rfc = int(parts[1])
+        port = int(parts[-1])
+        host = parts[-2]
+        title = " ".join(parts[2:-2])
+    else:
+        # Fallback if no RFC prefix
+        rfc = int(parts[0])
+        port = int(parts[-1])
+        host = parts[-2]
+        title = " ".join(parts[1:-2])
+    return {
+        "rfc": rfc,
+        "title": title,
+        "host": host,
+        "port": port
+    }
+
+
 def download_rfc_from_peer(rfc_number, peer_host, peer_port, upload_port):
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -384,50 +1353,44 @@ def download_rfc_from_peer(rfc_number, peer_host, peer_port, upload_port):
             f"GET RFC {rfc_number} P2P-CI/1.0\r\n"
             f"Host: {PEER_HOST}\r\n"
             f"OS: {platform.system()} {platform.release()}\r\n"
+            f"Upgrade: {V2_VERSION}\r\n"
             "\r\n"
         )
         sock_file.write(request.encode())
         sock_file.flush()
 
-        # status line
-        status = sock_file.readline().decode().strip()
+        # status line and headers
+        try:
+            status, headers = read_file_head(sock_file)
+            code = parse_status(status)[0]
+        except ValueError as e:
+            print(f"[Peer] Error: Bad response from peer - {e}")
+            sock.close()
+            return False
+        if code == 101 and status.startswith(V2_VERSION):
+            return receive_rfc_v2(sock_file, rfc_number, peer_host)
         print(status)
 
         # Check for any error status
-        if "400" in status:
+        if code == 400:
             print("[Peer] Error: Bad Request from peer")
-            sock_file.readline()
             sock.close()
             return False
-        elif "404" in status:
+        elif code == 404:
             print("[Peer] Error: RFC not found on peer")
-            sock_file.readline()
             sock.close()
             return False
-        elif "505" in status:
+        elif code == 505:
             print("[Peer] Error: Protocol version not supported by peer")
-            sock_file.readline()
             sock.close()
             return False
-        elif "200" not in status:
+        elif code != 200:
             print(f"[Peer] Error: Unexpected response from peer: {status}")
-            sock_file.readline()
             sock.close()
             return False
 
-        # read headers from peer
-        headers = {}
-        while True:
-            line = sock_file.readline().decode()
-            if not line:
-                break
-            line = line.strip()
-            if line == "":
-                break
-            print(line)
-            if ":" in line:
-                key, value = line.split(":", 1)
-                headers[key.strip()] = value.strip()
+        if headers:
+            print("\n".join(f"{name}: {value}" for name, value in headers.items()))
 
         content_len = int(headers.get("Content-Length", "0"))
 
@@ -456,6 +1419,152 @@ def download_rfc_from_peer(rfc_number, peer_host, peer_port, upload_port):
         sock.close()
 
 
+def receive_rfc_v2(sock_file, rfc_number, peer_host):
+    # a 2.0 peer's reply: one frame with status and file details, then the file raw
+    fields = FrameReader(read_frame_body(sock_file))
+    status = fields.varint()
+    if status != 200:
+        print(f"{V2_VERSION} {status} {fields.text()}")
+        print("[Peer] Error: RFC not found on peer" if status == 404 else "[Peer] Error: Bad Request from peer")
+        return False
+    content_len = fields.varint()
+    modified_time = fields.text()
+    os_name = fields.text()
+    print(f"{V2_VERSION} 200 OK")
+    print(f"OS: {os_name}")
+    print(f"Last-Modified: {modified_time}")
+    print(f"Content-Length: {content_len}")
+
+    with open(f"rfc{rfc_number}.txt", 'wb') as f:
+        remaining = content_len
+        while remaining > 0:
+            chunk = sock_file.read(min(4096, remaining))
+            if not chunk:
+                break
+            f.write(chunk)
+            remaining -= len(chunk)
+
+    print(f"[PEER] Downloaded RFC {rfc_number} from {peer_host}")
+    return True
+
+
+# Sharded servers: OPTIONS lists the shards, and each owns the RFC numbers that
+# consistent hashing maps to it -- the same ring server.py builds. The peer keeps a
+# connection to every shard, each with its own session, in ci['shards'].
+def ring_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+
+def build_ring(names):
+    points = sorted((ring_hash(f"{name}#{i}"), name) for name in names for i in range(SHARD_VNODES))
+    return [point for point, _ in points], [name for _, name in points]
+
+
+def shard_of(ring, rfc_number):
+    points, owners = ring
+    return owners[bisect.bisect(points, ring_hash(str(rfc_number))) % len(points)]
+
+
+def connections(ci):
+    """Every CI connection: one per shard, or just ci itself when the server isn't sharded."""
+    return list(ci['shards'].values()) or [ci]
+
+
+def route(ci, rfc_number):
+    """The connection to the server that owns rfc_number."""
+    if not ci['shards']:
+        return ci
+    return ci['shards'][shard_of(ci['ring'], rfc_number)]
+
+
+def owned_by(conn):
+    # which local RFCs to register over conn: all of them unless it is one of several shards
+    if conn['ring'] is None:
+        return None
+    return lambda rfc_number: shard_of(conn['ring'], rfc_number) == conn['name']
+
+
+def connect_shards(ci, upload_port, names):
+    """Connect to every shard and register there the local RFCs it owns; False on failure.
+
+    The connection that discovered the shards has served its purpose and is closed.
+    """
+    print(f"[Peer] Server is sharded: {', '.join(names)}")
+    ci['sock'].close()
+    ci['ring'] = build_ring(names)
+    for name in names:
+        host, _, port = name.rpartition(":")
+        shard = {'sock': None, 'file': None, 'host': host, 'port': int(port), 'token': None,
+                 'lease': 0, 'features': set(), 'subscriptions': set(), 'lock': ci['lock'],
+                 'shards': {}, 'ring': ci['ring'], 'name': name}
+        sock, ci_file = connect_to_ci(shard['host'], shard['port'])
+        if sock is None:
+            return False
+        shard['sock'], shard['file'] = sock, ci_file
+        ci['shards'][name] = shard
+        try:
+            shard['features'] = query_features(ci_file, upload_port)
+            if not resume_or_register(shard, upload_port, shard['features']):
+                return False
+        except OSError as e:
+            print(f"[Peer] Connection error with shard {name}: {e}")
+            return False
+    ci['lease'] = min(shard['lease'] for shard in ci['shards'].values())
+    return True
+
+
+def list_shards(ci, upload_port):
+    """LIST ALL from every shard at once, merged into RFC-number order."""
+    conns = connections(ci)
+    # scatter all the requests first, so the shards build their listings in parallel
+    for conn in conns:
+        conn['file'].write(encode_list_v2() if conn['file'].protocol == 2
+                           else format_list(upload_port, conn['file'].deflate))
+        conn['file'].flush()
+    entries = []
+    for conn in conns:
+        entries.extend(read_list(conn['file']))
+    entries.sort(key=lambda entry: entry['rfc'])
+    if not entries:
+        print("[Peer] Error: No RFCs available")
+        return []
+    print(f"[Peer] {len(entries)} entries from {len(conns)} shard(s)")
+    print("\n".join(map(entry_line, entries)))
+    return entries
+
+
+def search_shards(ci, query, upload_port, limit=0):
+    """SEARCH every shard at once; each answers for its own RFCs, merged by RFC number."""
+    conns = connections(ci)
+    for conn in conns:
+        conn['file'].write(format_search(conn['file'], query, upload_port, limit))
+        conn['file'].flush()
+    total, entries = 0, []
+    for conn in conns:
+        status, code, matches, found = read_search(conn['file'])
+        if code not in (200, 404):
+            print(status)
+        total += matches
+        entries.extend(found)
+    entries.sort(key=lambda entry: entry['rfc'])
+    if not entries:
+        print("[Peer] Error: No matching RFCs")
+        return []
+    print(f"[Peer] {total} matching RFC(s)")
+    print("\n".join(map(entry_line, entries)))
+    return entries
+
+
+def poll_all(ci, timeout=0):
+    """poll_notices() over every connection, waiting up to `timeout` for the first push."""
+    files = [conn['file'] for conn in connections(ci)]
+    if len(files) == 1:
+        return poll_notices(files[0], timeout)
+    if timeout and not any(f.notices or f.buf for f in files):
+        select.select([f.sock for f in files], [], [], timeout)
+    return [notice for f in files for notice in poll_notices(f)]
+
+
 def main():
     try:
         upload_port = int(input("Enter your upload port: ").strip())
@@ -485,22 +1594,64 @@ def main():
         print("[Peer] Error: Invalid port number")
         return
 
-    ci_sock, ci_file = connect_to_ci(ci_host, ci_port)
-    
-    if ci_sock is None or ci_file is None:
-        print("[Peer] Failed to connect to CI server. Exiting...")
+    for attempt in range(CONNECT_ATTEMPTS):
+        ci_sock, ci_file = connect_to_ci(ci_host, ci_port)
+
+        if ci_sock is None or ci_file is None:
+            print("[Peer] Failed to connect to CI server. Exiting...")
+            return
+
+        try:
+            features = query_features(ci_file, upload_port)
+            break
+        except ServerBusy as e:
+            print(f"[Peer] Server is busy, retrying in {e.retry_after:g}s")
+            ci_sock.close()
+            time.sleep(e.retry_after)
+        except OSError as e:
+            print(f"[Peer] Connection error: {e}")
+            ci_sock.close()
+            return
+    else:
+        print("[Peer] Server is still busy. Exiting...")
         return
-    
+
     print(f"[Peer] Connected to server at port {ci_port}")
 
-    if not register_local_rfcs(ci_file, upload_port):
+    # shared with the heartbeat thread, which may swap in a new connection
+    ci = {'sock': ci_sock, 'file': ci_file, 'host': ci_host, 'port': ci_port,
+          'token': None, 'lease': 0, 'features': features, 'subscriptions': set(),
+          'lock': threading.Lock(), 'shards': {}, 'ring': None, 'name': None}
+
+    try:
+        if ci_file.shards:
+            registered = connect_shards(ci, upload_port, ci_file.shards)
+        else:
+            registered = resume_or_register(ci, upload_port, ci['features'])
+    except OSError as e:
+        print(f"[Peer] Connection error: {e}")
+        ci_sock.close()
+        return
+    if ci_file.protocol == 2:
+        print(f"[Peer] Server speaks {V2_VERSION}, using binary framing")
+
+    if not registered:
         print("[Peer] Failed to register with server. Please use a different port and try again.")
         ci_sock.close()
         return
 
+    if ci['lease']:
+        print(f"[Peer] Server lease is {ci['lease']:g}s, sending heartbeats")
+    if ci['lease'] or "ranking" in ci['features']:
+        threading.Thread(target=keepalive_loop, args=(ci, upload_port), daemon=True).start()
+
+    replicas = {}  # shard name (None when not sharded) -> that server's replica
+
     while True:
         try:
-            cmd = input("\nEnter command (ADD / LOOKUP / LIST / GET / EXIT): ").strip().upper()
+            with ci['lock']:
+                print_notices(poll_all(ci))
+            cmd = input("\nEnter command (ADD / LOOKUP / SEARCH / LIST / SYNC / SUBSCRIBE / WAIT / GET / EXIT): ").strip().upper()
 
             if cmd == "ADD":
                 rfc = int(input("RFC number: ").strip())
@@ -509,10 +1660,11 @@ def main():
                 if not version.startswith("P2P-CI/"):
                     print("P2P-CI/1.0 400 Bad Request")
                     continue
-                if version != "P2P-CI/1.0":
+                if version not in SUPPORTED_VERSIONS:
                     print("P2P-CI/1.0 505 P2P-CI Version Not Supported")
                     continue
-                send_add(ci_file, rfc, title, upload_port)
+                with ci['lock']:
+                    send_add(route(ci, rfc)['file'], rfc, title, upload_port)
 
             elif cmd == "LOOKUP":
                 rfc = int(input("RFC number: ").strip())
@@ -521,20 +1673,98 @@ def main():
                 if not version.startswith("P2P-CI/"):
                     print("P2P-CI/1.0 400 Bad Request")
                     continue
-                if version != "P2P-CI/1.0":
+                if version not in SUPPORTED_VERSIONS:
                     print("P2P-CI/1.0 505 P2P-CI Version Not Supported")
                     continue
-                _entries = send_lookup(ci_file, rfc, upload_port, title) 
+                with ci['lock']:
+                    _entries = send_lookup(route(ci, rfc)['file'], rfc, upload_port, title)
 
             elif cmd == "LIST":
                 version = input("Version: ").strip()
                 if not version.startswith("P2P-CI/"):
                     print("P2P-CI/1.0 400 Bad Request")
                     continue
-                if version != "P2P-CI/1.0":
+                if version not in SUPPORTED_VERSIONS:
+                    print("P2P-CI/1.0 505 P2P-CI Version Not Supported")
+                    continue
+                with ci['lock']:
+                    if ci['shards']:
+                        _entries = list_shards(ci, upload_port)
+                    else:
+                        _entries = send_list(ci['file'], upload_port)
+
+            elif cmd == "SEARCH":
+                if "search" not in ci['features']:
+                    print("[Peer] Server does not support SEARCH")
+                    continue
+                query = input("Title words (end a word with * for a prefix): ").strip()
+                version = input("Version: ").strip()
+                if not version.startswith("P2P-CI/"):
+                    print("P2P-CI/1.0 400 Bad Request")
+                    continue
+                if version not in SUPPORTED_VERSIONS:
+                    print("P2P-CI/1.0 505 P2P-CI Version Not Supported")
+                    continue
+                with ci['lock']:
+                    if ci['shards']:
+                        search_shards(ci, query, upload_port)
+                    else:
+                        send_search(ci['file'], query, upload_port)
+
+            elif cmd == "SYNC":
+                # refresh the local replica with only what changed since the last SYNC
+                if "delta" not in ci['features']:
+                    print("[Peer] Server does not support LIST SINCE")
+                    continue
+                applied = 0
+                with ci['lock']:
+                    for conn in connections(ci):
+                        replica = replicas.setdefault(conn['name'], new_replica())
+                        count = sync_replica(conn['file'], upload_port, replica)
+                        if count is None:
+                            applied = None
+                            break
+                        applied += count
+                if applied is not None:
+                    # one generation per shard: each keeps its own change log
+                    generations = "/".join(str(replica['generation']) for replica in replicas.values())
+                    entries = sum(len(replica['entries']) for replica in replicas.values())
+                    print(f"[Peer] Replica at generation {generations}: "
+                          f"{applied} change(s) applied, {entries} entries")
+
+            elif cmd == "SUBSCRIBE":
+                # pushes for the RFC (or ALL of them) arrive as they happen; see WAIT
+                if "subscribe" not in ci['features']:
+                    print("[Peer] Server does not support SUBSCRIBE")
+                    continue
+                target = input("RFC number (or ALL): ").strip().upper()
+                rfc = None if target == "ALL" else int(target)
+                version = input("Version: ").strip()
+                if not version.startswith("P2P-CI/"):
+                    print("P2P-CI/1.0 400 Bad Request")
+                    continue
+                if version not in SUPPORTED_VERSIONS:
                     print("P2P-CI/1.0 505 P2P-CI Version Not Supported")
                     continue
-                _entries = send_list(ci_file, upload_port)
+                with ci['lock']:
+                    # one RFC's changes happen on its shard; ALL takes every shard
+                    for conn in connections(ci) if rfc is None else [route(ci, rfc)]:
+                        if send_subscribe(conn['file'], upload_port, rfc):
+                            conn['subscriptions'].add(rfc)
+
+            elif cmd == "WAIT":
+                # block until a subscribed change arrives, instead of polling LOOKUP
+                seconds = float(input("Seconds to wait: ").strip())
+                deadline = time.monotonic() + seconds
+                notices = []
+                while not notices and time.monotonic() < deadline:
+                    # short slices, so heartbeats still get the connection
+                    with ci['lock']:
+                        notices = poll_all(ci, min(1.0, max(0.0, deadline - time.monotonic())))
+                if notices:
+                    print_notices(notices)
+                else:
+                    print("[Peer] No notifications")
 
             elif cmd == "GET":
                 rfc = int(input("RFC number: ").strip())
@@ -544,27 +1774,36 @@ def main():
                 if not version.startswith("P2P-CI/"):
                     print("P2P-CI/1.0 400 Bad Request")
                     continue
-                if version != "P2P-CI/1.0":
+                if version not in SUPPORTED_VERSIONS:
                     print("P2P-CI/1.0 505 P2P-CI Version Not Supported")
                     continue
                 download_rfc_from_peer(rfc, host, port, upload_port)
 
             elif cmd == "EXIT":
                 print("[PEER] Disconnecting.")
-                ci_sock.close()
+                with ci['lock']:
+                    for conn in connections(ci):
+                        conn['sock'].close()
+                    ci['sock'] = None
                 break
 
             else:
-                print("Unknown command. Use ADD / LOOKUP / LIST / GET / EXIT.")
+                print("Unknown command. Use ADD / LOOKUP / SEARCH / LIST / SYNC / SUBSCRIBE / WAIT / GET / EXIT.")
                 
         except ValueError as e:
             print(f"[Peer] Error: Invalid input - {e}")
         except KeyboardInterrupt:
             print("\n[PEER] Interrupted. Disconnecting...")
-            ci_sock.close()
+            for conn in connections(ci):
+                conn['sock'].close()
             break
-        except BrokenPipeError:
+        except (BrokenPipeError, ConnectionError):
             print("[Peer] Error: Connection to server lost")
+            # with a lease the records are still there; pick them back up
+            if ci['lease']:
+                with ci['lock']:
+                    if all(reconnect(conn, upload_port) for conn in connections(ci)):
+                        continue
             break
         except Exception as e:
             print(f"[Peer] Error: {e}")
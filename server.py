@@ -1,167 +1,728 @@
+import argparse
+import array
+import asyncio
+import atexit
+import bisect
+import collections
+import functools
+import gc
+import hashlib
+import heapq
+import io
+import itertools
+import logging
+import logging.handlers
+import marshal
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import re
+import secrets
+import signal
 import socket
+import struct
+import sys
+import tempfile
 import threading
+import time
+import zlib
 
 S_PORT = 7734
 
-def peer_conn(conn, addr):
-    print(f"[SERVER] Connection with {addr}")
-    conn_file = conn.makefile('rwb')
+# Per-subsystem loggers. Anything logged once per request or per RFC is DEBUG, so at
+# the default INFO level the request path skips it before building a record.
+log = logging.getLogger("ci.server")
+conn_log = logging.getLogger("ci.conn")
+request_log = logging.getLogger("ci.request")
+index_log = logging.getLogger("ci.index")
+
+class SampleFilter(logging.Filter):
+    """Lets one record in every `rate` through."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.seen = 0
+
+    def filter(self, record):
+        self.seen += 1
+        return self.seen % self.rate == 0
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted so formatting and stdout writes happen on the listener thread."""
+
+    def prepare(self, record):
+        if record.exc_info:
+            # the traceback's frames may be gone by the time the listener gets to it
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging(level="INFO", sample=1, process_tag=False):
+    """Send the "ci" loggers through a queue to a background thread writing stdout.
+
+    sample > 1 keeps only one in every `sample` per-request lines; process_tag names the
+    process on each line, for when several of them share the output.
+    """
+    fmt = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+    if process_tag:
+        fmt = "%(asctime)s %(levelname)s %(processName)s [%(name)s] %(message)s"
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(fmt))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
 
-    host_cleanup = None
-    port_cleanup = None
-    connection_logged = False 
+    root = logging.getLogger("ci")
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(records))
+    if sample > 1:
+        request_log.addFilter(SampleFilter(sample))
+
+def new_session(addr):
+    # protocol becomes 2 once an OPTIONS request upgraded the connection to P2P-CI/2.0;
+    # subscription is set by its first SUBSCRIBE
+    # registered/renew_at/unreported: see register_peer
+    return {'addr': addr, 'host': None, 'port': None, 'logged': False, 'protocol': 1,
+            'subscription': None, 'registered': None, 'renew_at': 0.0, 'unreported': 0}
+
+def peer_conn(conn, addr):
+    # the accept loop has already counted this connection in (admit)
+    conn_log.debug("Connection with %s", addr)
+    framer = RequestFramer()
+    out = ResponseBuffer()
+    session = new_session(addr)
+    send_lock = threading.Lock()  # keeps pushes from a SUBSCRIBE between whole responses
+    pushing = False
+    # reads wake up at least every tick to check the timeouts; a send fails when a
+    # LIST_CHUNK_BYTES piece of it takes longer than a tick (see send_sliced), so a
+    # peer that stops reading can't pin the thread
+    conn.settimeout(timeout_tick())
+    last_read = time.monotonic()
+    request_started = None
 
     try:
         while True:
-            request_line = conn_file.readline().decode()
-            if not request_line:
+            request = framer.next_request()
+            if request is None:
+                # answered everything received so far: send it all, then wait for more
+                with send_lock:
+                    send_responses(conn, out)
+                request_started = framer.partial() and (request_started or time.monotonic())
+                try:
+                    data = conn.recv(RECV_SIZE)
+                except socket.timeout:
+                    data = None
+                if data == b"":
+                    break
+                now = time.monotonic()
+                if data:
+                    framer.feed(data)
+                    last_read = now
+                if timed_out(request_started, last_read, now):
+                    conn_log.info("Closing connection with %s - timed out", addr)
+                    break
+                continue
+
+            keep_open = serve_request(out, request, session)
+            if session['protocol'] == 2 and type(framer) is RequestFramer:
+                framer = FrameFramer(framer.buf)  # whatever followed the upgrade is binary
+            if session['subscription'] is not None and not pushing:
+                pushing = True
+                threading.Thread(target=push_notices, args=(conn, session['subscription'], send_lock),
+                                 daemon=True).start()
+            if out.streams:
+                with send_lock:
+                    send_responses(conn, out)
+            if not keep_open:
                 break
 
-            request_line = request_line.strip()
-            if request_line == "":
-                continue
+        with send_lock:
+            send_responses(conn, out)
+    except socket.timeout:
+        with counts_lock:
+            connection_counts['timed_out'] += 1
+        conn_log.info("Closing connection with %s - timed out", addr)
+    except OSError:
+        pass
+    finally:
+        connection_closed()
+        close_session(session)
+        conn.close()
 
-            print(f"[SERVER] Received request: {request_line}")
-            parts = request_line.split()
+def timed_out(request_started, last_read, now):
+    """Whether a connection has had its time: a request under way for longer than
+    --request-timeout, or nothing received for --idle-timeout between requests."""
+    if request_started:
+        expired = request_timeout and now - request_started > request_timeout
+    else:
+        expired = idle_timeout and now - last_read > idle_timeout
+    if expired:
+        with counts_lock:
+            connection_counts['timed_out'] += 1
+    return bool(expired)
 
+def timeout_tick():
+    # how long a single read or send may block; None when neither timeout is set
+    return min(filter(None, (request_timeout, idle_timeout)), default=None)
 
-            if len(parts) < 3:
-                send_err(conn_file, 400, "Bad Request")
-                continue
+def send_responses(conn, out):
+    if out:
+        send_sliced(conn, out)
+        out.clear()
+    while out.streams:
+        for chunk in out.streams.pop(0):
+            send_sliced(conn, chunk)
 
-            method = parts[0]
-            
-            #LIST ALL
-            if method == "LIST":
-                if len(parts) != 3 or parts[1] != "ALL":
-                    send_err(conn_file, 400, "Bad Request")
-                    continue
-                
-                version = parts[2]
-                if not version.startswith("P2P-CI/"):
-                    send_err(conn_file, 400, "Bad Request")
-                    continue
-                if version != "P2P-CI/1.0":
-                    send_err(conn_file, 505, "P2P-CI Version Not Supported")
-                    continue
+def send_sliced(conn, data):
+    # the socket timeout bounds a whole sendall(), so large bodies go LIST_CHUNK_BYTES
+    # at a time: a slow peer that keeps reading gets a tick for every piece
+    if len(data) <= LIST_CHUNK_BYTES:
+        conn.sendall(data)
+        return
+    with memoryview(data) as view:
+        for start in range(0, len(view), LIST_CHUNK_BYTES):
+            conn.sendall(view[start:start + LIST_CHUNK_BYTES])
 
-                headers = read_headers(conn_file)
-                host = headers.get("Host")
-                port = headers.get("Port")
+def push_notices(conn, subscription, send_lock):
+    # one per subscribed connection, so a slow reader only ever holds up its own pushes
+    ready = threading.Event()
+    subscription.wake = ready.set
+    try:
+        while not subscription.closed:
+            data = subscription.take()
+            if data:
+                with send_lock:
+                    conn.sendall(data)
+            ready.wait()
+            ready.clear()
+    except OSError:
+        # the peer stopped reading (or went): end the connection, not just the pushes
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-                if not host or not port:
-                    send_err(conn_file, 400, "Bad Request")
-                    continue
-                
-                port = int(port)
-                host_cleanup = host
-                port_cleanup = port
-                
-                if not connection_logged:
-                    print(f"[Server] Connection from host {host} at {addr[0]}:{port}")
-                    connection_logged = True
-
-                # Check if port is already used by another peer
-                if not peer_add(host, port):
-                    send_err(conn_file, 400, "Bad Request - Port already in use by another peer")
-                    conn_file.flush()
-                    break
-                handle_list_all(conn_file) # Helper function to handle LIST ALL
-                conn_file.flush()
-                continue
+def serve_request(conn_file, request, session):
+    """Answer one framed request. Returns False when the connection must be closed."""
+    start = time.perf_counter()
+    if request is OVERSIZED or request is MALFORMED or request is TOO_LARGE:
+        # past the limits, or unparsable: the rest of the stream can't be trusted
+        if request is OVERSIZED:
+            send_err(conn_file, 431, "Request Header Fields Too Large")
+        elif request is TOO_LARGE:
+            send_err(conn_file, 413, "Payload Too Large")
+        else:
+            send_err(conn_file, 400, "Bad Request")
+        record_request("INVALID", time.perf_counter() - start)
+        return False
+    if session['protocol'] == 2:
+        method, keep_open = serve_frame(conn_file, request, session)
+        record_request(method, time.perf_counter() - start)
+        return keep_open
+    request_line, headers, body = request
+    parsed = parse_request_line(conn_file, request_line)
+    if parsed is None:
+        method, keep_open = "INVALID", True
+    else:
+        method = parsed[0]
+        keep_open = dispatch_request(conn_file, parsed, headers, session, body)
+    record_request(method, time.perf_counter() - start)
+    return keep_open
 
-            else:
-                #ADD/LOOKUP
-                if len(parts) != 4:
-                    send_err(conn_file, 400, "Bad Request")
-                    continue
+def parse_request_line(conn_file, request_line):
+    """Validate a request line, returning (method, rfc_number) or None once an error was sent."""
+    request_log.debug("Received request: %s", request_line)
+    parts = request_line.split()
+    if not parts:
+        send_err(conn_file, 400, "Bad Request")
+        return None
 
-                _, obj, rfc_full, version = parts
+    #OPTIONS/STATS/KEEPALIVE/SEARCH -- too short for a 1.0 request line, so older servers answer 400
+    if parts[0] in ("OPTIONS", "STATS", "KEEPALIVE", "SEARCH") and len(parts) == 2:
+        if parts[1] != "P2P-CI/1.0":
+            send_err(conn_file, 505, "P2P-CI Version Not Supported")
+            return None
+        return parts[0], None
 
-                #RFC_keyword validation
-                if obj != "RFC":
-                    send_err(conn_file, 400, "Bad Request")
-                    continue
+    if len(parts) < 3:
+        send_err(conn_file, 400, "Bad Request")
+        return None
 
-                #Version validation    
-                if not version.startswith("P2P-CI/"):
-                    send_err(conn_file, 400, "Bad Request")
-                    continue
-                if version != "P2P-CI/1.0":
-                    send_err(conn_file, 505, "P2P-CI Version Not Supported")
-                    continue
-                
+    method = parts[0]
+    rfc_number = None
 
-                
-                #RFC_number validation
-                try:
-                    rfc_number = int(rfc_full)
-                except ValueError:
-                    send_err(conn_file, 400, "Bad Request")
-                    continue
+    #LIST SINCE <generation> -- the index changes after that generation
+    if method == "LIST" and len(parts) == 4 and parts[1] == "SINCE":
+        method = "LIST SINCE"
+        version = parts[3]
 
-                headers = read_headers(conn_file)
-                host = headers.get("Host")
-                port = headers.get("Port")
-                title = headers.get("Title")
+    #SUBSCRIBE ALL / UNSUBSCRIBE ALL -- the per-RFC forms parse like LOOKUP
+    elif method in ("SUBSCRIBE", "UNSUBSCRIBE") and len(parts) == 3 and parts[1] == "ALL":
+        method += " ALL"
+        version = parts[2]
 
-                if not host or not port:
-                    send_err(conn_file, 400, "Bad Request")
-                    continue
-                
-                port = int(port)
-                host_cleanup = host
-                port_cleanup = port
-
-                if not connection_logged:
-                    print(f"[Server] Connection from host {host} at {addr[0]}:{port}")
-                    connection_logged = True
-                
-                # Check if port is already used by another peer
-                if not peer_add(host, port):
-                    send_err(conn_file, 400, "Bad Request - Port already in use by another peer")
-                    conn_file.flush()
-                    break
+    #LIST ALL
+    elif method == "LIST":
+        if len(parts) != 3 or parts[1] != "ALL":
+            send_err(conn_file, 400, "Bad Request")
+            return None
+        version = parts[2]
 
-                #dispatch
-                if method == "ADD":
-                    if not title:
-                        send_err(conn_file, 400, "Bad Request")
-                        continue
-                    handle_add(conn_file, rfc_number, title, host, port)
-                    conn_file.flush()
-
-                elif method == "LOOKUP":
-                    handle_lookup(conn_file, rfc_number)
-                    conn_file.flush()
-                
-                else:
-                    send_err(conn_file, 400, "Bad Request")
-                    conn_file.flush()
+    #ADD RFCS -- batch registration, entry lines follow the headers
+    elif method == "ADD" and len(parts) == 3 and parts[1] == "RFCS":
+        method = "ADD RFCS"
+        version = parts[2]
 
-    finally:
-        print(f"[SERVER] Closing connection with {addr}")
-        if host_cleanup and port_cleanup:
-            print(f"[Server] Peer {host_cleanup}:{port_cleanup} disconnected")
-            peer_delete(host_cleanup, port_cleanup)
-            print(f"[Server] Removed all records for {host_cleanup}:{port_cleanup}")
+    else:
+        #ADD/LOOKUP
+        if len(parts) != 4:
+            send_err(conn_file, 400, "Bad Request")
+            return None
 
-        conn_file.close()
-        conn.close()
+        _, obj, rfc_full, version = parts
+
+        #RFC_keyword validation
+        if obj != "RFC":
+            send_err(conn_file, 400, "Bad Request")
+            return None
+
+    #Version validation
+    if not version.startswith("P2P-CI/"):
+        send_err(conn_file, 400, "Bad Request")
+        return None
+    if version != "P2P-CI/1.0":
+        send_err(conn_file, 505, "P2P-CI Version Not Supported")
+        return None
+
+    if method == "LIST SINCE":
+        # the generation travels in the rfc_number slot
+        try:
+            rfc_number = int(parts[2])
+        except ValueError:
+            send_err(conn_file, 400, "Bad Request")
+            return None
+        if rfc_number < 0:
+            send_err(conn_file, 400, "Bad Request")
+            return None
+
+    elif method not in ("LIST", "ADD RFCS", "SUBSCRIBE ALL", "UNSUBSCRIBE ALL"):
+        #RFC_number validation
+        try:
+            rfc_number = rfc_number_from(rfc_full)
+        except ValueError:
+            send_err(conn_file, 400, "Bad Request")
+            return None
 
-def read_headers(conn_file):
+    return method, rfc_number
+
+def dispatch_request(conn_file, request, headers, session, body=None):
+    """Serve one validated request. Returns False when the connection must be closed.
+
+    body holds the entry lines of an ADD RFCS, or None if its Count was unusable.
+    """
+    method, rfc_number = request
+
+    if method == "OPTIONS":
+        if headers.get("Upgrade") != V2_VERSION or not handle_upgrade(conn_file, headers, session):
+            handle_options(conn_file)
+        return True
+
+    if method == "STATS":
+        handle_stats(conn_file)
+        return True
+
+    if method == "ADD RFCS" and body is None:
+        # without a valid Count the entry lines cannot be skipped, so give up on the stream
+        send_err(conn_file, 400, "Bad Request")
+        return False
+
+    if shard_names and method in ("ADD", "LOOKUP", "SUBSCRIBE", "UNSUBSCRIBE"):
+        owner = shard_of(rfc_number)
+        if owner != own_shard:
+            send_misdirected(conn_file, owner)
+            return True
+
+    host = headers.get("Host")
+    port = headers.get("Port")
+
+    if not host or not port:
+        send_err(conn_file, 400, "Bad Request")
+        return True
+
+    try:
+        port = int(port)
+    except ValueError:
+        send_err(conn_file, 400, "Bad Request")
+        return True
+
+    session['host'] = host
+    session['port'] = port
+
+    if not session['logged']:
+        conn_log.info("Connection from host %s at %s:%s", host, session['addr'][0], port)
+        session['logged'] = True
+
+    if primary_address is not None:
+        # a standby: reads only, and without registering anyone -- its peers are the primary's
+        if method in ("ADD", "ADD RFCS", "KEEPALIVE"):
+            send_read_only(conn_file)
+            return True
+    # Check if port is already used by another peer
+    elif not register_peer(session, host, port, method == "KEEPALIVE"):
+        send_err(conn_file, 400, "Bad Request - Port already in use by another peer")
+        return False
+
+    #dispatch
+    if method == "LIST":
+        handle_list_all(conn_file, headers) # Helper function to handle LIST ALL
+
+    elif method == "ADD":
+        title = headers.get("Title")
+        if not title:
+            send_err(conn_file, 400, "Bad Request")
+            return True
+        handle_add(conn_file, rfc_number, title, host, port)
+
+    elif method == "ADD RFCS":
+        handle_add_batch(conn_file, body, host, port)
+
+    elif method == "LOOKUP":
+        handle_lookup(conn_file, rfc_number, (host, port), headers.get("Max-Results"),
+                      accepts_deflate(headers))
+
+    elif method == "KEEPALIVE":
+        handle_keepalive(conn_file, host, port, headers)
+
+    elif method == "LIST SINCE":
+        handle_list_since(conn_file, rfc_number, headers.get("Epoch"))
+
+    elif method == "SEARCH":
+        handle_search(conn_file, headers)
+
+    elif method in ("SUBSCRIBE", "SUBSCRIBE ALL", "UNSUBSCRIBE", "UNSUBSCRIBE ALL"):
+        # rfc_number is None for the ALL forms
+        subscribe(session, method.startswith("SUBSCRIBE"), rfc_number)
+        conn_file.write(OK_HEADER)
+
+    else:
+        send_err(conn_file, 400, "Bad Request")
+
+    return True
+
+def close_session(session):
+    conn_log.debug("Closing connection with %s", session['addr'])
+    if session['subscription'] is not None:
+        subscribe(session, False, None)
+        session['subscription'].close()
+    host = session['host']
+    port = session['port']
+    if host and port:
+        if primary_address is not None:
+            return  # on a standby, records go when the primary says so
+        if lease_ttl:
+            conn_log.info("Peer %s:%s disconnected, its records stay until its lease runs out", host, port)
+            return
+        peer_delete(host, port)
+        conn_log.info("Peer %s:%s disconnected, removed all records", host, port)
+
+RFC_NUMBER_LIMIT = 1 << 63  # peer_rfcs keeps RFC numbers in signed 64-bit arrays
+
+def rfc_number_from(value):
+    """int(value), raising ValueError unless it is an RFC number the index can hold.
+
+    Negative numbers are refused too: 2.0 encodes RFC numbers as unsigned varints,
+    and paged LIST cursors start at RFC 0.
+    """
+    rfc_number = int(value)
+    if not 0 <= rfc_number < RFC_NUMBER_LIMIT:
+        raise ValueError(value)
+    return rfc_number
+
+def batch_count(headers):
+    """Number of entry lines announced by an ADD RFCS, or None if missing or out of range."""
+    try:
+        count = int(headers.get("Count", ""))
+    except ValueError:
+        return None
+    if count < 1 or count > MAX_BATCH_ADD:
+        return None
+    return count
+
+# 1.0 wire parsing, on bytes. A head -- a request or status line plus its header lines,
+# up to a blank line -- is located with a couple of find() calls over the receive
+# buffer and decoded in one go, so nothing is sliced or decoded line by line; ADD RFCS
+# entry lines, which can run to megabytes, are decoded straight out of the buffer
+# through a memoryview. peer.py carries a copy of head_end and parse_head for the
+# responses it reads; keep them in step.
+MAX_HEAD_BYTES = 8 * 1024   # longest head accepted, request line and headers together
+MAX_HEADERS = 64            # most header lines in one head
+MAX_LINE_BYTES = 8 * 1024   # longest ADD RFCS entry line accepted
+MAX_BODY_BYTES = 16 * 1024 * 1024  # most ADD RFCS entry lines in all; as MAX_FRAME_BYTES caps them in 2.0
+
+def head_end(buf, start=0):
+    """(end of the last line, end of the blank line) of the head at buf[start:], or None
+    while the blank line has yet to arrive. Lines may end in CRLF or a bare LF."""
+    crlf = buf.find(b"\n\r\n", start)
+    lf = buf.find(b"\n\n", start, len(buf) if crlf < 0 else crlf + 1)
+    if lf >= 0:
+        return lf, lf + 2
+    if crlf >= 0:
+        return crlf, crlf + 3
+    return None
+
+def parse_head(head):
+    """(first line, headers) from a head's bytes, blank line excluded.
+
+    Strict: bad UTF-8, or a header line without a colon or a name, raises ValueError.
+    """
+    lines = str(head, "utf-8").split("\n")
     headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(":")
+        name = name.strip()
+        if not colon or not name:
+            raise ValueError(f"malformed header line {line!r}")
+        headers[name] = value.strip()
+    return lines[0].strip(), headers
+
+RECV_SIZE = 64 * 1024
+OVERSIZED = ("", None, None)  # what RequestFramer returns for a request past the limits
+MALFORMED = ("", {}, None)    # ... and for one that does not parse
+TOO_LARGE = ("", None, [])    # ... and for entry lines past MAX_BODY_BYTES
+
+class RequestFramer:
+    """Splits the bytes received on a connection into complete requests.
+
+    A request is its head and, for ADD RFCS, the Count entry lines after it.
+    next_request() returns (request_line, headers, body) once all of that has
+    arrived, so several pipelined requests can be answered from one recv.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.head = None       # (request_line, headers, body) while entry lines are arriving
+        self.body_left = 0     # entry lines still to find
+        self.scanned = 0       # bytes of buf already searched without finding what was needed
+        self.failed = None     # OVERSIZED or MALFORMED once the stream can't be followed
+
+    def feed(self, data):
+        self.buf += data
+
+    def partial(self):
+        """True while a request has started arriving but is not complete."""
+        return self.head is not None or bool(self.buf)
+
+    def next_request(self):
+        request = self._next_request()
+        return self.failed or request
+
+    def _next_request(self):
+        buf = self.buf
+        if self.head is None:
+            # blank (or all-whitespace) lines between requests are skipped
+            skip = 0
+            while skip < len(buf) and buf[skip] in b" \t\r\n":
+                skip += 1
+            if skip:
+                del buf[:skip]
+                self.scanned = 0
+            found = head_end(buf, max(0, self.scanned - 2))
+            if found is None:
+                self.scanned = len(buf)
+                if len(buf) > MAX_HEAD_BYTES:
+                    self.failed = OVERSIZED
+                return None
+            last, end = found
+            self.scanned = 0
+            if end > MAX_HEAD_BYTES or buf.count(b"\n", 0, last) > MAX_HEADERS:
+                self.failed = OVERSIZED
+                return None
+            try:
+                request_line, headers = parse_head(buf[:last])
+            except ValueError:
+                self.failed = MALFORMED
+                return None
+            del buf[:end]
+            body = []
+            if request_line.startswith("ADD RFCS"):
+                count = batch_count(headers)
+                if count is None:
+                    body = None  # unusable Count: the entry lines cannot be framed
+                else:
+                    self.body_left = count
+            self.head = (request_line, headers, body)
+
+        if self.body_left:
+            # find where the last entry line ends, then decode them all at once
+            pos, left = self.scanned, self.body_left
+            while left:
+                newline = buf.find(b"\n", pos, pos + MAX_LINE_BYTES)
+                if newline < 0:
+                    if len(buf) - pos >= MAX_LINE_BYTES:
+                        self.failed = OVERSIZED
+                    elif len(buf) > MAX_BODY_BYTES:
+                        self.failed = TOO_LARGE
+                    self.scanned, self.body_left = pos, left
+                    return None
+                pos = newline + 1
+                left -= 1
+            if pos > MAX_BODY_BYTES:
+                self.failed = TOO_LARGE
+                return None
+            try:
+                with memoryview(buf) as view:
+                    lines = str(view[:pos - 1], "utf-8").split("\n")
+            except ValueError:
+                self.failed = MALFORMED
+                return None
+            del buf[:pos]
+            self.head[2].extend(lines)
+            self.scanned = self.body_left = 0
+
+        request, self.head = self.head, None
+        return request
+
+class ResponseBuffer(bytearray):
+    """Responses waiting to be sent on one connection.
+
+    Handlers write() into it and the connection loop sends it once no complete
+    request is left to answer. Bodies handed to stream() are sent piece by piece
+    after whatever was written before them.
+    """
+
+    write = bytearray.extend
+
+    def __init__(self):
+        super().__init__()
+        self.streams = []
+
+    def stream(self, chunks):
+        self.streams.append(chunks)
+
+# asyncio engine -- same protocol, one coroutine per connection instead of a thread
+async def push_notices_async(writer, subscription, send_lock):
+    ready = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    subscription.wake = lambda: loop.call_soon_threadsafe(ready.set)
+    try:
+        while not subscription.closed:
+            data = subscription.take()
+            if data:
+                async with send_lock:
+                    writer.write(data)
+                    await writer.drain()
+            await ready.wait()
+            ready.clear()
+    except ConnectionError:
+        pass
+
+def watch_connection(writer, state, tick):
+    """Timer standing in for the threads engine's socket timeouts: every tick, close
+    the connection if timed_out() says so or a send has made no progress since the last."""
+    unsent = writer.transport.get_write_buffer_size()
+    stalled = 0 < state['unsent'] <= unsent
+    state['unsent'] = unsent
+    if stalled or timed_out(state['request_started'], state['last_read'], time.monotonic()):
+        conn_log.info("Closing connection with %s - timed out", writer.get_extra_info('peername'))
+        writer.transport.abort()
+        return
+    state['watchdog'] = asyncio.get_running_loop().call_later(tick, watch_connection, writer, state, tick)
+
+async def send_responses_async(writer, out):
+    if out:
+        writer.write(bytes(out))
+        out.clear()
+    while out.streams:
+        for chunk in out.streams.pop(0):
+            writer.write(chunk)
+            await writer.drain()
+    await writer.drain()
+
+def serve_framed(framer, out, request, session):
+    """serve_request() for `request` and the complete requests after it in `framer`,
+    all in one trip to a worker's executor thread.
+
+    Stops early when peer_conn_async has something to do first: the connection is to
+    be closed, a response is to be streamed or a subscription has started. Returns
+    the framer to go on with and whether to keep the connection open.
+    """
+    subscribed = session['subscription'] is not None
     while True:
-        line = conn_file.readline().decode()
-        if not line:
-            break
-        line = line.strip()
-        if line == "":
-            break
-        if ":" in line:
-            key, value = line.split(":", 1)
-            headers[key.strip()] = value.strip()
-    return headers
+        keep_open = serve_request(out, request, session)
+        if session['protocol'] == 2 and type(framer) is RequestFramer:
+            framer = FrameFramer(framer.buf)  # whatever followed the upgrade is binary
+        if not keep_open or out.streams or (session['subscription'] is not None) != subscribed:
+            return framer, keep_open
+        request = framer.next_request()
+        if request is None:
+            return framer, True
+
+async def peer_conn_async(reader, writer):
+    addr = writer.get_extra_info('peername')
+    conn_log.debug("Connection with %s", addr)
+    if not admit():
+        writer.write(OVERLOADED)
+        writer.close()
+        return
+    framer = RequestFramer()
+    out = ResponseBuffer()
+    session = new_session(addr)
+    send_lock = asyncio.Lock()
+    pusher = None
+    state = {'last_read': time.monotonic(), 'request_started': None, 'unsent': 0, 'watchdog': None}
+    loop = asyncio.get_running_loop()
+    tick = timeout_tick()
+    if tick:
+        watch_connection(writer, state, tick)
+
+    try:
+        while True:
+            request = framer.next_request()
+            if request is None:
+                async with send_lock:
+                    await send_responses_async(writer, out)
+                state['request_started'] = framer.partial() and (state['request_started'] or time.monotonic())
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                framer.feed(data)
+                state['last_read'] = time.monotonic()
+                continue
+
+            if index_client is None:
+                keep_open = serve_request(out, request, session)
+            else:
+                # in a worker registrations and writes wait on the owner; keep that off the event loop
+                framer, keep_open = await loop.run_in_executor(None, serve_framed, framer, out, request, session)
+            if session['protocol'] == 2 and type(framer) is RequestFramer:
+                framer = FrameFramer(framer.buf)  # whatever followed the upgrade is binary
+            if session['subscription'] is not None and pusher is None:
+                pusher = asyncio.create_task(push_notices_async(writer, session['subscription'], send_lock))
+            if out.streams:
+                async with send_lock:
+                    await send_responses_async(writer, out)
+            if not keep_open:
+                break
+
+        async with send_lock:
+            await send_responses_async(writer, out)
+    except ConnectionError:
+        pass
+    finally:
+        if state['watchdog'] is not None:
+            state['watchdog'].cancel()
+        connection_closed()
+        if pusher is not None:
+            pusher.cancel()
+        writer.close()
+        if index_client is None:
+            close_session(session)
+        else:
+            # peer_delete is a round trip to the owner, and a long one for a large collection
+            await loop.run_in_executor(None, close_session, session)
 
 def handle_add(conn_file, rfc_number, title, host, port):
     rfc_add(rfc_number, title, host, port)
@@ -172,126 +733,2670 @@ def handle_add(conn_file, rfc_number, title, host, port):
         "\r\n" 
     )
     conn_file.write(response.encode())
-    conn_file.flush()
 
-def handle_lookup(conn_file, rfc_number):
-    entries = rfc_lookup(rfc_number)
+FEATURES = ("batch-add", "stats", "binary", "keepalive", "delta", "subscribe", "search", "ranking",
+            "deflate")
+MAX_BATCH_ADD = 50000  # most entry lines one ADD RFCS may carry
+
+def handle_options(conn_file):
+    # Standbys lists where to fail over to; a standby names its Primary instead
+    standby_list = standby_addresses() if replication_port else ()
+    response = (
+        "P2P-CI/1.0 200 OK\r\n"
+        f"Features: {', '.join(advertised_features())}\r\n"
+        + (f"Shards: {', '.join(shard_names)}\r\n" if shard_names else "")
+        + (f"Standbys: {', '.join(standby_list)}\r\n" if standby_list else "")
+        + (f"Primary: {primary_client or ''}\r\n" if primary_address is not None else "")
+        + "\r\n"
+    )
+    conn_file.write(response.encode())
+
+def advertised_features():
+    return FEATURES + ("shards",) if shard_names else FEATURES
+
+def handle_keepalive(conn_file, host, port, headers):
+    # peer_add has already renewed the lease; Resumed says whether `token` still names it.
+    # Peers that know "ranking" also report their uploads here.
+    report = None
+    if "Upload-Capacity" in headers:
+        try:
+            report = tuple(int(headers.get(name, "0")) for name in
+                           ("Uploads-Active", "Uploads-Served", "Upload-Capacity"))
+        except ValueError:
+            send_err(conn_file, 400, "Bad Request")
+            return
+    current, resumed = peer_keepalive(host, port, headers.get("Session"), report)
+    response = (
+        "P2P-CI/1.0 200 OK\r\n"
+        f"Session: {current}\r\n"
+        f"Lease: {lease_ttl:g}\r\n"
+        f"Resumed: {'yes' if resumed else 'no'}\r\n"
+        "\r\n"
+    )
+    conn_file.write(response.encode())
+
+def handle_add_batch(conn_file, lines, host, port):
+    # each entry line is "RFC <number> <title>"; one bad line rejects the whole batch
+    entries = []
+    for line in lines:
+        parts = line.strip().split(None, 2)
+        if len(parts) != 3 or parts[0] != "RFC":
+            send_err(conn_file, 400, "Bad Request")
+            return
+        try:
+            entries.append((rfc_number_from(parts[1]), parts[2]))
+        except ValueError:
+            send_err(conn_file, 400, "Bad Request")
+            return
+
+    owner = misdirected(rfc_number for rfc_number, _ in entries)
+    if owner is not None:
+        send_misdirected(conn_file, owner)
+        return
+
+    added = rfc_add_many(entries, host, port)
+    response = (
+        "P2P-CI/1.0 200 OK\r\n"
+        f"Count: {len(entries)}\r\n"
+        f"Added: {added}\r\n"
+        "\r\n"
+    )
+    conn_file.write(response.encode())
+
+def handle_list_since(conn_file, since, epoch):
+    # Changes come as "ADD RFC ..." / "DEL RFC ..." entry lines, oldest first. 410 means
+    # they no longer reach back to `since`: take a full LIST ALL, then poll from the
+    # Generation given here -- replaying a change the listing already has is harmless.
+    epoch, generation, changes = changes_since(since, epoch)
+    head = f"Generation: {generation}\r\nEpoch: {epoch}\r\n\r\n"
+    if changes is None:
+        error_counts[410] = error_counts.get(410, 0) + 1
+        conn_file.write(f"P2P-CI/1.0 410 Gone\r\n{head}".encode())
+        return
+    lines = ["P2P-CI/1.0 200 OK\r\n", head]
+    for _, added, rfc_number, (host, port), title in changes:
+        lines.append(f"{'ADD' if added else 'DEL'} RFC {rfc_number} {title} {host} {port}\r\n")
+    lines.append("\r\n")
+    conn_file.write("".join(lines).encode())
+
+SEARCH_LIMIT = 100       # RFCs a SEARCH returns without a Limit header
+MAX_SEARCH_LIMIT = 1000  # most it returns with one
+
+def handle_search(conn_file, headers):
+    # "Query: tcp congest*" -- RFCs whose titles have every term, * marking a prefix
+    terms = parse_query(headers.get("Query", ""))
+    try:
+        limit = min(int(headers.get("Limit", SEARCH_LIMIT)), MAX_SEARCH_LIMIT)
+    except ValueError:
+        limit = 0
+    if not terms or limit < 1:
+        send_err(conn_file, 400, "Bad Request")
+        return
+    response = search_response(terms, limit)
+    if response is None:
+        response = b"P2P-CI/1.0 404 Not Found\r\n\r\n"
+    conn_file.write(response)
+
+def parse_query(query):
+    """Search terms as (token, is_prefix) pairs, tokenized the way titles are."""
+    terms = []
+    for word in query.split():
+        tokens = TOKEN_RE.findall(word.lower())
+        terms.extend((token, False) for token in tokens)
+        if tokens and word.endswith("*"):
+            terms[-1] = (tokens[-1], True)
+    return terms
+
+def search_response(terms, limit):
+    """The whole 200 response for a SEARCH, or None if no title matches."""
+    total, numbers = rfc_search(terms, limit)
+    if not numbers:
+        return None
+    parts = [f"P2P-CI/1.0 200 OK\r\nMatches: {total}\r\n\r\n".encode()]
+    for rfc_number in numbers:
+        holders = rfc_index.get(rfc_number)
+        if holders:  # may have gone since the search
+            parts.append(entry_lines(rfc_number, holders))
+    parts.append(b"\r\n")
+    return b"".join(parts)
 
-    if not entries:
+def handle_lookup(conn_file, rfc_number, requester, max_results, deflate=False):
+    # "Max-Results: N" keeps only the N best-ranked holders
+    try:
+        max_results = int(max_results) if max_results is not None else 0
+    except ValueError:
+        max_results = -1
+    if max_results < 0:
+        send_err(conn_file, 400, "Bad Request")
+        return
+    response = lookup_response(rfc_number, requester, max_results)
+
+    if response is None:
         response = "P2P-CI/1.0 404 Not Found\r\n\r\n"
         conn_file.write(response.encode())
-        conn_file.flush()
         return
 
-    response = "P2P-CI/1.0 200 OK\r\n\r\n"
-    conn_file.write(response.encode())
+    # ranked, so made per request: a long holder list is compressed each time
+    conn_file.write(deflated(response) if deflate else response)
 
-    for entry in entries:
-        line = f"RFC {entry['rfc']} {entry['title']} {entry['host']} {entry['port']}\r\n"
-        conn_file.write(line.encode())
+LIST_CHUNK_BYTES = 64 * 1024        # bytes per piece when streaming LIST ALL or sending a large body
+LIST_CACHE_MAX_BYTES = 256 * 1024 * 1024  # larger listings are streamed but not cached
+MAX_PAGE_LIMIT = 10000  # largest Limit a paged LIST ALL may ask for
 
-    conn_file.write(b"\r\n")
-    conn_file.flush()
+def handle_list_all(conn_file, headers):
+    limit = headers.get("Limit")
+    if limit is not None:
+        handle_list_page(conn_file, limit, headers.get("Cursor"), accepts_deflate(headers))
+        return
 
-def handle_list_all(conn_file):
-    entries = rfc_list()
+    if accepts_deflate(headers):
+        # compressed whole, since Content-Length comes first
+        response = list_all_deflated()
+        if response is None:
+            conn_file.write(b"P2P-CI/1.0 404 Not Found\r\n\r\n")
+        else:
+            conn_file.stream((response,))
+        return
 
-    if not entries:
+    cached = list_cache
+    if cached is not None and cached[0] == index_generation:
+        cache_stats['list_hits'] += 1
+        conn_file.stream((cached[1],))
+        return
+    cache_stats['list_misses'] += 1
+
+    # read the generation first: the snapshot is then at least that new
+    generation = index_generation
+    snapshot = rfc_snapshot()
+
+    if not snapshot:
         response = "P2P-CI/1.0 404 Not Found\r\n\r\n"
         conn_file.write(response.encode())
-        conn_file.flush()
         return
-    
-    response = "P2P-CI/1.0 200 OK\r\n\r\n"
-    conn_file.write(response.encode())
 
-    for entry in entries:
-        line = f"RFC {entry['rfc']} {entry['title']} {entry['host']} {entry['port']}\r\n"
-        conn_file.write(line.encode())
+    conn_file.stream(list_all_chunks(snapshot, generation))
+
+def list_all_response():
+    """The whole LIST ALL response as one bytes object, or None if the index is empty."""
+    cached = list_cache
+    if cached is not None and cached[0] == index_generation:
+        cache_stats['list_hits'] += 1
+        return cached[1]
+    cache_stats['list_misses'] += 1
+    generation = index_generation
+    snapshot = rfc_snapshot()
+    if not snapshot:
+        return None
+    return b"".join(list_all_chunks(snapshot, generation))
+
+def list_all_deflated():
+    """list_all_response() with its body deflated, cached per index generation too."""
+    global list_cache_deflate
+    cached = list_cache_deflate
+    if cached is not None and cached[0] == index_generation:
+        cache_stats['list_deflate_hits'] += 1
+        return cached[1]
+    cache_stats['list_deflate_misses'] += 1
+    generation = index_generation
+    response = list_all_response()
+    if response is None:
+        return None
+    response = deflated(response)
+    if generation == index_generation:
+        list_cache_deflate = (generation, response)
+    return response
+
+def list_all_chunks(snapshot, generation):
+    """Yield a full listing about LIST_CHUNK_BYTES at a time, caching it on the way."""
+    global list_cache
+    yield OK_HEADER
+    parts = [OK_HEADER]
+    total = len(OK_HEADER)
+    body = []
+    size = 0
+    for rfc_number, holders in snapshot:
+        lines = entry_lines(rfc_number, holders)
+        body.append(lines)
+        size += len(lines)
+        if size >= LIST_CHUNK_BYTES:
+            chunk = b"".join(body)
+            yield chunk
+            if parts is not None:
+                parts.append(chunk)
+                total += size
+                if total > LIST_CACHE_MAX_BYTES:
+                    parts = None
+            body = []
+            size = 0
+    body.append(b"\r\n")
+    chunk = b"".join(body)
+    yield chunk
+    if parts is not None and generation == index_generation:
+        parts.append(chunk)
+        list_cache = (generation, b"".join(parts))
+
+def handle_list_page(conn_file, limit, cursor, deflate=False):
+    # Paged form: "Limit: N" plus the "Cursor" returned by the previous page, if any
+    try:
+        limit = min(int(limit), MAX_PAGE_LIMIT)
+        start = parse_cursor(cursor) if cursor else (0, 0)
+    except ValueError:
+        send_err(conn_file, 400, "Bad Request")
+        return
+    if limit < 1:
+        send_err(conn_file, 400, "Bad Request")
+        return
+
+    entries, next_cursor = rfc_page(start, limit)
+    if not entries and start == (0, 0):
+        # nothing from the very first position: the index is empty
+        response = "P2P-CI/1.0 404 Not Found\r\n\r\n"
+        conn_file.write(response.encode())
+        return
+
+    lines = ["P2P-CI/1.0 200 OK\r\n"]
+    if next_cursor is not None:
+        lines.append(f"Cursor: {next_cursor[0]}:{next_cursor[1]}\r\n")
+    lines.append("\r\n")
+    for rfc_number, title, host, port in entries:
+        lines.append(f"RFC {rfc_number} {title} {host} {port}\r\n")
+    lines.append("\r\n")
+    response = "".join(lines).encode()
+    conn_file.write(deflated(response) if deflate else response)
+
+def parse_cursor(cursor):
+    rfc_number, skip = cursor.split(":", 1)
+    rfc_number, skip = int(rfc_number), int(skip)
+    if rfc_number < 0 or skip < 0:
+        raise ValueError(cursor)
+    return rfc_number, skip
+
+OK_HEADER = b"P2P-CI/1.0 200 OK\r\n\r\n"
+
+# "Accept-Encoding: deflate" on a LOOKUP or LIST ALL asks for the entry lines, closing
+# blank line included, as one zlib stream: the head then carries
+# "Content-Encoding: deflate" and the stream's Content-Length. Shorter bodies are
+# sent as they are, so a client must check Content-Encoding on every response.
+DEFLATE_MIN_BYTES = 1024  # smaller bodies gain too little to be worth compressing
+DEFLATE_LEVEL = 1         # entry lines compress about 5x even at the fastest level
+
+def accepts_deflate(headers):
+    return "deflate" in (name.strip() for name in headers.get("Accept-Encoding", "").split(","))
+
+def deflated(response):
+    """A 200 response with its body compressed, or as it is if the body is short."""
+    start = response.find(b"\r\n\r\n") + 4
+    if len(response) - start < DEFLATE_MIN_BYTES:
+        return response
+    with memoryview(response) as view:
+        body = zlib.compress(view[start:], DEFLATE_LEVEL)
+        return b"".join([view[:start - 2],
+                         f"Content-Encoding: deflate\r\nContent-Length: {len(body)}\r\n\r\n".encode(), body])
+
+def lookup_response(rfc_number, requester=None, max_results=0):
+    """The full encoded 200 response for a LOOKUP, or None if nobody holds the RFC.
 
-    conn_file.write(b"\r\n")
-    conn_file.flush()
+    Holders come best download source first for `requester` (see rank_holders).
+    """
+    holders = rfc_index.get(rfc_number)
+    if not holders:
+        return None
+    if len(holders) > 1:
+        # ranked per requester, so never served whole from the cache
+        cache_stats['lookup_misses'] += 1
+        lines = holder_lines(rfc_number, holders)
+        order = rank_holders(holders, requester, max_results)
+        return b"".join([OK_HEADER, *[lines[position] for position in order], b"\r\n"])
+    refer(next(iter(holders)))
+    cached = lookup_cache.get(rfc_number)
+    if cached is not None and cached[0] is holders:
+        cache_stats['lookup_hits'] += 1
+        cache_touch(lookup_cache, rfc_number)
+        return cached[1]
+    cache_stats['lookup_misses'] += 1
+    response = OK_HEADER + entry_lines(rfc_number, holders) + b"\r\n"
+    cache_put(lookup_cache, rfc_number, (holders, response))
+    return response
+
+def entry_lines(rfc_number, holders):
+    """The entry lines of a LOOKUP body for the RFC: the cached ones if holders is
+    current, else freshly encoded. LIST ALL and SEARCH use this rather than filling
+    the LOOKUP cache with every RFC they go through."""
+    cached = lookup_cache.get(rfc_number)
+    if cached is not None and cached[0] is holders:
+        return memoryview(cached[1])[len(OK_HEADER):-2]
+    return "".join([f"RFC {rfc_number} {title} {host} {port}\r\n"
+                    for (host, port), title in holders.items()]).encode()
+
+def cache_touch(cache, rfc_number):
+    # the LOOKUP caches are LRUs: a hit moves the RFC to the recent end
+    try:
+        cache.move_to_end(rfc_number)
+    except KeyError:
+        pass  # dropped by a writer since it was read
+
+def cache_put(cache, rfc_number, entry):
+    cache[rfc_number] = entry
+    while len(cache) > LOOKUP_CACHE_SIZE:
+        try:
+            cache.popitem(last=False)
+        except KeyError:
+            break  # emptied by a writer meanwhile
+
+def response_cache_stats():
+    return dict(cache_stats, generation=index_generation, cached_lookups=len(lookup_cache),
+                list_cached=list_cache is not None and list_cache[0] == index_generation,
+                list_deflate_cached=list_cache_deflate is not None and list_cache_deflate[0] == index_generation)
 
 def send_err(conn_file, code, message):
+    error_counts[code] = error_counts.get(code, 0) + 1
     response = f"P2P-CI/1.0 {code} {message}\r\n\r\n"
     conn_file.write(response.encode())
-    conn_file.flush()
 
-peers = []
-rfc_index = []
+def send_read_only(conn_file):
+    # a standby's index only changes through the primary, which the Primary header names
+    error_counts[403] = error_counts.get(403, 0) + 1
+    conn_file.write(f"P2P-CI/1.0 403 Read-Only Standby\r\nPrimary: {primary_client or ''}\r\n\r\n".encode())
 
-data_lock = threading.Lock()
+def send_misdirected(conn_file, owner):
+    # the RFC is another shard's: the Shard header names it, for a peer whose ring is stale
+    error_counts[421] = error_counts.get(421, 0) + 1
+    conn_file.write(f"P2P-CI/1.0 421 Misdirected Request\r\nShard: {owner}\r\n\r\n".encode())
 
-def peer_add(host, port):
-    with data_lock:
-        # Check if this port is already used by a different peer
-        for peer in peers:
-            if peer['port'] == port and peer['host'] != host:
-                print(f"[Server] Rejected: Port {port} already in use by {peer['host']}")
-                return False
-            if peer['host'] == host and peer['port'] == port:
-                return True
-        peers.append({'host': host, 'port': port})
-        print(f"[Server] Added {host}:{port}")
+# P2P-CI/2.0 -- binary framing. A client's first request is the plain OPTIONS probe;
+# when Features lists "binary" it sends OPTIONS again with Host, Port and
+# "Upgrade: P2P-CI/2.0" (headers a pre-OPTIONS server would take for request lines).
+# The reply is "P2P-CI/2.0 101 Switching Protocols" plus the Features header, and
+# every message after that, both ways, is a frame -- a varint body length, then the body.
+# Request bodies are an opcode byte and its fields; response bodies a varint status
+# followed by the result, or by a reason string for anything but 200. Integers are
+# LEB128 varints, strings a varint byte length plus UTF-8. Entry results list each
+# (host, port) once in a peer table and then the entries grouped by RFC number, as
+#   peers (host, port)*, groups (rfc, count, (peer index, title)*)*
+# each list prefixed with its length. Pushes for a SUBSCRIBE are frames with status 0,
+# sent only between responses:
+#   0, kind (1 added, 0 removed, 2 resync), and unless resync: rfc, title, host, port
+# Fields in [] are optional; servers without "ranking" must not be sent them. A 421
+# (another shard's RFC, see --shards) adds the owning shard after the reason, and a
+# 403 (a write sent to a standby, see --standby-of) the primary.
+# Servers without "binary" are only ever sent 1.0.
+V2_VERSION = "P2P-CI/2.0"
+OP_ADD = 1        # rfc, title
+OP_ADD_BATCH = 2  # count, (rfc, title)*                 -> count, added
+OP_LOOKUP = 3     # rfc[, max results]                   -> entries
+OP_LIST = 4       # limit (0 for all), cursor rfc, skip  -> has cursor, [rfc, skip], entries
+OP_STATS = 5      #                                      -> the STATS lines as one string
+OP_KEEPALIVE = 6  # session token ("" for none)          -> token, lease ms, resumed
+                  #   [, uploads active, uploads served, upload capacity]
+OP_LIST_SINCE = 7 # generation, epoch ("" for any)       -> epoch, generation, changes
+                  #   changes: count, (added, rfc, title, host, port)*; 410 adds epoch, generation
+OP_SUBSCRIBE = 8  # flags, rfc                           -> nothing
+                  #   flags: 1 on (else off), 2 just `rfc`; without the 2, rfc 0 means all
+OP_SEARCH = 9     # query, limit (0 for the default)     -> matches, entries
+OP_NAMES = {OP_ADD: "ADD", OP_ADD_BATCH: "ADD RFCS", OP_LOOKUP: "LOOKUP", OP_LIST: "LIST",
+            OP_STATS: "STATS", OP_KEEPALIVE: "KEEPALIVE", OP_LIST_SINCE: "LIST SINCE",
+            OP_SUBSCRIBE: "SUBSCRIBE", OP_SEARCH: "SEARCH"}
+MAX_FRAME_BYTES = 16 * 1024 * 1024  # largest request frame accepted; room for a full ADD RFCS
+
+def put_varint(buf, n):
+    while n > 0x7f:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def put_str(buf, text):
+    data = text.encode()
+    put_varint(buf, len(data))
+    buf += data
+
+def frame(body):
+    head = bytearray()
+    put_varint(head, len(body))
+    head += body
+    return bytes(head)
+
+class FrameReader:
+    """Reads fields off one frame body; anything truncated or malformed raises ValueError."""
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def varint(self):
+        data = self.data
+        n = shift = 0
+        while True:
+            if self.pos >= len(data) or shift > 63:
+                raise ValueError("bad varint")
+            byte = data[self.pos]
+            self.pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def text(self):
+        size = self.varint()
+        end = self.pos + size
+        if end > len(self.data):
+            raise ValueError("truncated string")
+        value = bytes(self.data[self.pos:end]).decode()  # UnicodeDecodeError is a ValueError
+        self.pos = end
+        return value
+
+    def more(self):
+        return self.pos < len(self.data)
+
+    def end(self):
+        if self.pos != len(self.data):
+            raise ValueError("trailing bytes")
+
+class FrameFramer:
+    """RequestFramer's counterpart once a connection speaks 2.0: yields frame bodies.
+
+    A frame longer than MAX_FRAME_BYTES comes back as an empty body, which
+    serve_frame rejects by closing the connection.
+    """
+
+    def __init__(self, data=b""):
+        self.buf = bytearray(data)
+
+    def feed(self, data):
+        self.buf += data
+
+    def partial(self):
+        return bool(self.buf)
+
+    def next_request(self):
+        buf = self.buf
+        size = shift = pos = 0
+        while True:
+            if pos >= len(buf):
+                return None
+            byte = buf[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+            if shift > 28:
+                return b""
+        if size > MAX_FRAME_BYTES:
+            return b""
+        if len(buf) - pos < size:
+            return None
+        body = bytes(buf[pos:pos + size])
+        del buf[:pos + size]
+        return body
+
+def handle_upgrade(conn_file, headers, session):
+    """Switch the connection to 2.0. Returns False, having sent nothing, unless the
+    request names its peer."""
+    host = headers.get("Host")
+    try:
+        port = int(headers.get("Port", ""))
+    except ValueError:
+        return False
+    if not host:
+        return False
+    session.update(host=host, port=port, protocol=2, logged=True)
+    conn_log.info("Connection from host %s at %s:%s (%s)", host, session['addr'][0], port, V2_VERSION)
+    response = (
+        f"{V2_VERSION} 101 Switching Protocols\r\n"
+        f"Features: {', '.join(advertised_features())}\r\n"
+        "\r\n"
+    )
+    conn_file.write(response.encode())
+    return True
+
+def serve_frame(conn_file, body, session):
+    """Answer one 2.0 request frame. Returns (method, keep_open)."""
+    if not body:
+        # oversized or unframeable: the stream cannot be followed any further
+        send_frame_err(conn_file, 400, "Bad Request")
+        return "INVALID", False
+    op = body[0]
+    method = OP_NAMES.get(op)
+    if method is None:
+        send_frame_err(conn_file, 400, "Bad Request")
+        return "INVALID", True
+
+    if op == OP_STATS:
+        reply = bytearray()
+        put_varint(reply, 200)
+        put_str(reply, "".join(f"{name} {value}\n" for name, value in metrics_lines()))
+        conn_file.write(frame(reply))
+        return method, True
+
+    host, port = session['host'], session['port']
+    if primary_address is not None:
+        if op in (OP_ADD, OP_ADD_BATCH, OP_KEEPALIVE):
+            reply = bytearray()
+            put_varint(reply, 403)
+            put_str(reply, "Read-Only Standby")
+            put_str(reply, primary_client or "")
+            error_counts[403] = error_counts.get(403, 0) + 1
+            conn_file.write(frame(reply))
+            return method, True
+    elif not register_peer(session, host, port, op == OP_KEEPALIVE):
+        send_frame_err(conn_file, 400, "Bad Request - Port already in use by another peer")
+        return method, False
+
+    fields = FrameReader(body, 1)
+    try:
+        if op == OP_ADD:
+            args = (rfc_number_from(fields.varint()), fields.text())
+        elif op == OP_ADD_BATCH:
+            count = fields.varint()
+            if count < 1 or count > MAX_BATCH_ADD:
+                raise ValueError("batch size out of range")
+            args = ([(rfc_number_from(fields.varint()), fields.text()) for _ in range(count)],)
+        elif op == OP_LOOKUP:
+            args = (rfc_number_from(fields.varint()), fields.varint() if fields.more() else 0)
+        elif op == OP_KEEPALIVE:
+            args = (fields.text() or None,
+                    (fields.varint(), fields.varint(), fields.varint()) if fields.more() else None)
+        elif op == OP_LIST_SINCE:
+            args = (fields.varint(), fields.text() or None)
+        elif op == OP_SUBSCRIBE:
+            flags = fields.varint()
+            rfc_number = rfc_number_from(fields.varint())
+            args = (bool(flags & 1), rfc_number if flags & 2 or rfc_number else None)
+        elif op == OP_SEARCH:
+            args = (parse_query(fields.text()), min(fields.varint() or SEARCH_LIMIT, MAX_SEARCH_LIMIT))
+            if not args[0]:
+                raise ValueError("empty query")
+        else:
+            args = (fields.varint(), (fields.varint(), fields.varint()))
+        fields.end()
+    except ValueError:
+        send_frame_err(conn_file, 400, "Bad Request")
+        return method, True
+
+    if shard_names and op in (OP_ADD, OP_ADD_BATCH, OP_LOOKUP, OP_SUBSCRIBE):
+        if op == OP_ADD_BATCH:
+            owner = misdirected(rfc_number for rfc_number, _ in args[0])
+        else:
+            owner = misdirected((args[1] if op == OP_SUBSCRIBE else args[0],))
+        if owner is not None:
+            reply = bytearray()
+            put_varint(reply, 421)
+            put_str(reply, "Misdirected Request")
+            put_str(reply, owner)
+            error_counts[421] = error_counts.get(421, 0) + 1
+            conn_file.write(frame(reply))
+            return method, True
+
+    if op == OP_ADD:
+        handle_add_v2(conn_file, *args, host, port)
+    elif op == OP_ADD_BATCH:
+        handle_add_batch_v2(conn_file, *args, host, port)
+    elif op == OP_LOOKUP:
+        handle_lookup_v2(conn_file, *args, (host, port))
+    elif op == OP_KEEPALIVE:
+        handle_keepalive_v2(conn_file, host, port, *args)
+    elif op == OP_LIST_SINCE:
+        handle_list_since_v2(conn_file, *args)
+    elif op == OP_SUBSCRIBE:
+        subscribe(session, *args)
+        reply = bytearray()
+        put_varint(reply, 200)
+        conn_file.write(frame(reply))
+    elif op == OP_SEARCH:
+        handle_search_v2(conn_file, *args)
+    else:
+        handle_list_v2(conn_file, *args)
+    return method, True
+
+def send_frame_err(conn_file, code, message):
+    error_counts[code] = error_counts.get(code, 0) + 1
+    reply = bytearray()
+    put_varint(reply, code)
+    put_str(reply, message)
+    conn_file.write(frame(reply))
+
+def put_entries(buf, groups):
+    """Append an entry block for (rfc, [((host, port), title), ...]) groups."""
+    peer_ids = {}
+    body = bytearray()
+    for rfc_number, items in groups:
+        put_varint(body, rfc_number)
+        put_varint(body, len(items))
+        for key, title in items:
+            peer_id = peer_ids.get(key)
+            if peer_id is None:
+                peer_id = peer_ids[key] = len(peer_ids)
+            put_varint(body, peer_id)
+            put_str(body, title)
+    put_varint(buf, len(peer_ids))
+    for host, port in peer_ids:
+        put_str(buf, host)
+        put_varint(buf, port)
+    put_varint(buf, len(groups))
+    buf += body
+
+def handle_add_v2(conn_file, rfc_number, title, host, port):
+    rfc_add(rfc_number, title, host, port)
+    reply = bytearray()
+    put_varint(reply, 200)
+    put_entries(reply, [(rfc_number, [((host, port), title)])])
+    conn_file.write(frame(reply))
+
+def handle_add_batch_v2(conn_file, entries, host, port):
+    added = rfc_add_many(entries, host, port)
+    reply = bytearray()
+    put_varint(reply, 200)
+    put_varint(reply, len(entries))
+    put_varint(reply, added)
+    conn_file.write(frame(reply))
+
+def handle_keepalive_v2(conn_file, host, port, token, report):
+    current, resumed = peer_keepalive(host, port, token, report)
+    reply = bytearray()
+    put_varint(reply, 200)
+    put_str(reply, current)
+    put_varint(reply, round(lease_ttl * 1000))
+    put_varint(reply, resumed)
+    conn_file.write(frame(reply))
+
+def handle_list_since_v2(conn_file, since, epoch):
+    epoch, generation, changes = changes_since(since, epoch)
+    reply = bytearray()
+    if changes is None:
+        error_counts[410] = error_counts.get(410, 0) + 1
+        put_varint(reply, 410)
+        put_str(reply, "Gone")
+        put_str(reply, epoch)
+        put_varint(reply, generation)
+        conn_file.write(frame(reply))
+        return
+    put_varint(reply, 200)
+    put_str(reply, epoch)
+    put_varint(reply, generation)
+    put_varint(reply, len(changes))
+    for _, added, rfc_number, (host, port), title in changes:
+        put_varint(reply, added)
+        put_varint(reply, rfc_number)
+        put_str(reply, title)
+        put_str(reply, host)
+        put_varint(reply, port)
+    conn_file.write(frame(reply))
+
+def handle_search_v2(conn_file, terms, limit):
+    response = search_response_v2(terms, limit)
+    if response is None:
+        send_frame_err(conn_file, 404, "Not Found")
+        return
+    conn_file.write(response)
+
+def search_response_v2(terms, limit):
+    total, numbers = rfc_search(terms, limit)
+    groups = []
+    for rfc_number in numbers:
+        holders = rfc_index.get(rfc_number)
+        if holders:
+            groups.append((rfc_number, holders.items()))
+    if not groups:
+        return None
+    reply = bytearray()
+    put_varint(reply, 200)
+    put_varint(reply, total)
+    put_entries(reply, groups)
+    return frame(reply)
+
+def handle_lookup_v2(conn_file, rfc_number, max_results, requester):
+    response = lookup_response_v2(rfc_number, requester, max_results)
+    if response is None:
+        send_frame_err(conn_file, 404, "Not Found")
+        return
+    conn_file.write(response)
+
+def handle_list_v2(conn_file, limit, start):
+    if not limit:
+        response = list_all_response_v2()
+        if response is None:
+            send_frame_err(conn_file, 404, "Not Found")
+            return
+        conn_file.stream((response,))
+        return
+
+    entries, next_cursor = rfc_page(start, min(limit, MAX_PAGE_LIMIT))
+    if not entries and start == (0, 0):
+        send_frame_err(conn_file, 404, "Not Found")
+        return
+    reply = bytearray()
+    put_varint(reply, 200)
+    if next_cursor is None:
+        put_varint(reply, 0)
+    else:
+        put_varint(reply, 1)
+        put_varint(reply, next_cursor[0])
+        put_varint(reply, next_cursor[1])
+    groups = [(rfc_number, [((host, port), title) for _, title, host, port in group])
+              for rfc_number, group in itertools.groupby(entries, key=lambda entry: entry[0])]
+    put_entries(reply, groups)
+    conn_file.write(frame(reply))
+
+def lookup_response_v2(rfc_number, requester=None, max_results=0):
+    """lookup_response() framed for 2.0: the whole 200 frame, or None if nobody holds the RFC."""
+    holders = rfc_index.get(rfc_number)
+    if not holders:
+        return None
+    if len(holders) > 1:
+        cache_stats['lookup_misses'] += 1
+        reply = bytearray()
+        put_varint(reply, 200)
+        items = list(holders.items())
+        order = rank_holders(holders, requester, max_results)
+        put_entries(reply, [(rfc_number, [items[position] for position in order])])
+        return frame(reply)
+    refer(next(iter(holders)))
+    cached = lookup_cache_v2.get(rfc_number)
+    if cached is not None and cached[0] is holders:
+        cache_stats['lookup_hits'] += 1
+        cache_touch(lookup_cache_v2, rfc_number)
+        return cached[1]
+    cache_stats['lookup_misses'] += 1
+    reply = bytearray()
+    put_varint(reply, 200)
+    put_entries(reply, [(rfc_number, holders.items())])
+    response = frame(reply)
+    cache_put(lookup_cache_v2, rfc_number, (holders, response))
+    return response
+
+def list_all_response_v2():
+    """The whole unpaged LIST ALL as one 2.0 frame, or None if the index is empty."""
+    global list_cache_v2
+    cached = list_cache_v2
+    if cached is not None and cached[0] == index_generation:
+        cache_stats['list_hits'] += 1
+        return cached[1]
+    cache_stats['list_misses'] += 1
+    generation = index_generation
+    snapshot = rfc_snapshot()
+    if not snapshot:
+        return None
+    reply = bytearray()
+    put_varint(reply, 200)
+    put_varint(reply, 0)  # no cursor
+    put_entries(reply, [(rfc_number, holders.items()) for rfc_number, holders in snapshot])
+    response = frame(reply)
+    if len(response) <= LIST_CACHE_MAX_BYTES and generation == index_generation:
+        list_cache_v2 = (generation, response)
+    return response
+
+# metrics -- plain counters and log2 histograms, cheap enough to leave on. Updates
+# are not locked, so a rare increment can be lost when threads race.
+class Histogram:
+    """Latency histogram with power-of-two microsecond buckets."""
+
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS  # bucket i counts samples under 2**i us
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        self.buckets[min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """Upper bound, in seconds, of the bucket holding the q-th quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return (1 << i) / 1e6
+        return (1 << (self.BUCKETS - 1)) / 1e6
+
+class TimedLock:
+    """threading.Lock that records how long callers wait for it and how long they hold it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.wait = Histogram()
+        self.hold = Histogram()
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        self._acquired_at = now = time.perf_counter()
+        self.wait.record(now - start)
+
+    def __exit__(self, *exc):
+        self.hold.record(time.perf_counter() - self._acquired_at)
+        self._lock.release()
+
+started_at = time.time()
+request_counts = {}     # method -> requests served ("INVALID" for unparsable lines)
+request_latency = {}    # method -> Histogram of time spent answering
+error_counts = {}       # status code -> error responses sent by send_err
+connection_counts = {'open': 0, 'total': 0, 'rejected': 0, 'timed_out': 0}
+counts_lock = threading.Lock()  # connections open and close on different threads
+
+# Admission control (--max-connections, per process): past the cap a connection is
+# answered 503 with a Retry-After and closed straight away rather than left queued.
+listen_backlog = socket.SOMAXCONN  # --backlog: peers connect in bursts, e.g. after a restart
+max_connections = 0  # 0 for no cap
+request_timeout = 30.0  # --request-timeout
+idle_timeout = 0.0      # --idle-timeout; 0 lets peers sit between requests indefinitely
+RETRY_AFTER_SECONDS = 1
+OVERLOADED = f"P2P-CI/1.0 503 Service Unavailable\r\nRetry-After: {RETRY_AFTER_SECONDS}\r\n\r\n".encode()
+
+def record_request(method, seconds):
+    request_counts[method] = request_counts.get(method, 0) + 1
+    histogram = request_latency.get(method)
+    if histogram is None:
+        histogram = request_latency.setdefault(method, Histogram())
+    histogram.record(seconds)
+
+def set_connection_limits(args):
+    global listen_backlog, max_connections, request_timeout, idle_timeout
+    listen_backlog = args.backlog
+    max_connections = max(0, args.max_connections)
+    request_timeout = max(0.0, args.request_timeout)
+    idle_timeout = max(0.0, args.idle_timeout)
+
+def admit():
+    """Count a new connection in, or return False (and count it rejected) when at the cap."""
+    with counts_lock:
+        if max_connections and connection_counts['open'] >= max_connections:
+            connection_counts['rejected'] += 1
+            return False
+        connection_counts['open'] += 1
+        connection_counts['total'] += 1
         return True
 
+def connection_closed():
+    with counts_lock:
+        connection_counts['open'] -= 1
+
+# (host, port) -> session info for every registered peer, including its session token
+# and, with --lease-ttl, the monotonic time its lease runs out
+peers = {}
+# upload port -> host currently registered on it
+port_owners = {}
+# (host, port) -> monotonic deadline for peers restored from disk that have not
+# reconnected yet; their records stay listed until then
+provisional = {}
+
+# RFC number -> {(host, port): title}, holders kept in registration order. Entries
+# are kept small: every entry of a peer shares one key tuple (see peer_keys), and a
+# holder registering an RFC under the title the RFC already has shares that string.
+rfc_index = {}
+# (host, port) -> array of the RFC numbers registered by that peer, each once
+peer_rfcs = {}
+# (host, port) -> the key tuple all of that peer's entries use
+peer_keys = {}
+
+class RfcOrder:
+    """Every RFC number in rfc_index, ascending -- the order paged LIST ALL walks.
+
+    The numbers are kept in sorted chunks of at most CHUNK, so adding or removing
+    one moves a chunk's worth of items rather than the whole order, and a peer
+    disconnect stays O(RFCs it held). Writers hold data_lock; slice_from() runs
+    without it. Splitting, merging or dropping chunks builds new lists, so a
+    reader walking the chunks it already has never sees numbers go missing.
+    """
+
+    CHUNK = 1024
+
+    def __init__(self):
+        self.parts = ([], [])  # (chunks, last number of each chunk), swapped together
+
+    def __sizeof__(self):
+        chunks, maxes = self.parts
+        return object.__sizeof__(self) + sys.getsizeof(maxes) + sum(map(sys.getsizeof, chunks), sys.getsizeof(chunks))
+
+    def reset(self, numbers=()):
+        # caller holds data_lock; `numbers` ascending. Chunks start half full.
+        size = self.CHUNK // 2
+        chunks = [numbers[i:i + size] for i in range(0, len(numbers), size)]
+        self.parts = (chunks, [chunk[-1] for chunk in chunks])
+
+    def add(self, rfc_number):
+        # caller holds data_lock, and rfc_number is not in the order yet
+        chunks, maxes = self.parts
+        if not chunks:
+            self.parts = ([[rfc_number]], [rfc_number])
+            return
+        k = min(bisect.bisect_left(maxes, rfc_number), len(chunks) - 1)
+        chunk = chunks[k]
+        if len(chunk) < self.CHUNK:
+            bisect.insort(chunk, rfc_number)
+            maxes[k] = chunk[-1]
+            return
+        numbers = chunk[:]
+        bisect.insort(numbers, rfc_number)
+        self._replace(k, k + 1, numbers)
+
+    def remove(self, rfc_number):
+        # caller holds data_lock, and rfc_number is in the order
+        chunks, maxes = self.parts
+        k = bisect.bisect_left(maxes, rfc_number)
+        chunk = chunks[k]
+        if len(chunk) > self.CHUNK // 4:
+            del chunk[bisect.bisect_left(chunk, rfc_number)]
+            maxes[k] = chunk[-1]
+            return
+        # a small chunk is merged into a neighbour, so chunks never pile up nearly empty
+        numbers = chunk[:]
+        del numbers[bisect.bisect_left(numbers, rfc_number)]
+        if k + 1 < len(chunks):
+            self._replace(k, k + 2, numbers + chunks[k + 1])
+        elif k:
+            self._replace(k - 1, k + 1, chunks[k - 1] + numbers)
+        else:
+            self._replace(k, k + 1, numbers)
+
+    def _replace(self, start, end, numbers):
+        # chunks[start:end] become the new list `numbers`, split in two if it is too long
+        chunks, maxes = self.parts
+        if len(numbers) > self.CHUNK:
+            half = len(numbers) // 2
+            pieces = [numbers[:half], numbers[half:]]
+        else:
+            pieces = [numbers] if numbers else []
+        self.parts = (chunks[:start] + pieces + chunks[end:],
+                      maxes[:start] + [piece[-1] for piece in pieces] + maxes[end:])
+
+    def slice_from(self, start, limit):
+        """Up to `limit` numbers, ascending, from the first one >= `start`."""
+        chunks, maxes = self.parts
+        numbers = []
+        for k in range(bisect.bisect_left(maxes, start), len(chunks)):
+            chunk = chunks[k][:]  # one atomic copy, a writer may be changing it
+            i = bisect.bisect_left(chunk, start)
+            numbers.extend(chunk[i:i + limit - len(numbers)])
+            if len(numbers) >= limit:
+                break
+        return numbers
+
+    def has_from(self, start):
+        """Whether any number >= `start` is in the order."""
+        maxes = self.parts[1]
+        return bool(maxes) and maxes[-1] >= start
+
+rfc_order = RfcOrder()
+
+# bumped once for every entry added to or removed from rfc_index
+index_generation = 0
+# Identifies this run of the server, so LIST SINCE never applies one run's
+# generations to another's history.
+index_epoch = secrets.token_hex(8)
+# (generation, added, rfc, key, title) for the latest changes, oldest first, for
+# LIST SINCE. Changes up to change_floor have fallen out of it.
+CHANGE_LOG_SIZE = 100000
+change_log = collections.deque(maxlen=CHANGE_LOG_SIZE)
+change_floor = 0
+change_event = threading.Event()
+# (rfc, host, port) registrations currently in rfc_index
+index_counts = {'entries': 0}
+# Encoded responses. LOOKUPs are cached per RFC as (holders, bytes): holders dicts
+# are replaced on every change, so an identity check rejects anything stale even if
+# a reader races the writer's invalidation. The full LIST ALL is (generation, bytes).
+# The _v2 caches hold the same responses framed for P2P-CI/2.0, and list_cache_deflate
+# the LIST ALL with its body compressed (see deflated), also by generation.
+# The LOOKUP caches keep the LOOKUP_CACHE_SIZE most recently used RFCs.
+LOOKUP_CACHE_SIZE = 10000
+lookup_cache = collections.OrderedDict()
+list_cache = None
+list_cache_deflate = None
+lookup_cache_v2 = collections.OrderedDict()
+lookup_lines = collections.OrderedDict()  # rfc -> (holders, encoded line per holder), for ranked LOOKUPs
+list_cache_v2 = None
+cache_stats = {'lookup_hits': 0, 'lookup_misses': 0, 'list_hits': 0, 'list_misses': 0,
+               'list_deflate_hits': 0, 'list_deflate_misses': 0}
+
+# Title search: token -> {rfc: how many of the RFC's distinct titles have the token},
+# or just the RFC number for a token only one title has (most of them); and every
+# token in ascending order for prefix terms. Kept up to date by rfc_insert and
+# peer_remove; searches copy what they read, as list() and set() of a dict are atomic.
+TOKEN_RE = re.compile(r"[0-9a-z]+")
+title_postings = {}
+title_token_order = []
+# While a snapshot or the WAL is loaded, new tokens skip the insort into
+# title_token_order and sort_title_tokens() puts them all in order once at the end
+title_order_deferred = False
+
+# Seconds a peer's records outlive its last request (--lease-ttl). 0 ties them to its
+# connection instead: they go as soon as it closes.
+lease_ttl = 0
+lease_counts = {'expired': 0}
+
+# Writers (peer_add, rfc_add, peer_delete) serialize on data_lock. Readers take no
+# lock at all: a holders dict is never mutated once it is in rfc_index -- writers
+# publish an updated copy instead -- so a lookup or listing always iterates a
+# consistent snapshot while updates carry on.
+data_lock = TimedLock()
+
+def peer_add(host, port, requests=1):
+    # `requests` is how many requests this call stands for (see register_peer)
+    key = (host, port)
+    # Every request re-checks its peer, so the already-registered case skips the lock
+    session = peers.get(key)
+    if session is not None:
+        session['requests'] += requests  # per-peer stat, a rare lost update is harmless
+        if lease_ttl:
+            session['expires'] = time.monotonic() + lease_ttl
+        return True
+    with data_lock:
+        session = peers.get(key)
+        if session is not None:
+            session['requests'] += requests
+            session['expires'] = time.monotonic() + lease_ttl
+            return True
+        return peer_register(key)
+
+def peer_register(key):
+    # caller holds data_lock; False if another host has the port
+    host, port = key
+    owner = port_owners.get(port)
+    if owner is not None and owner != host:
+        index_log.warning("Rejected: Port %s already in use by %s", port, owner)
+        return False
+    # a promoted standby gives back the token the peer had from the old primary
+    token = replica_tokens.pop(key, None) or secrets.token_hex(16)
+    peers[key] = {'host': host, 'port': port, 'connected': time.time(), 'requests': 1,
+                  'token': token, 'expires': time.monotonic() + lease_ttl,
+                  'active': 0, 'capacity': 1, 'load': 0.0, 'load_at': 0.0}
+    port_owners[port] = host
+    if journal is not None:
+        journal.append(("P", host, port, token))
+    if standbys:
+        replicate(("P", host, port, token))
+    if provisional.pop(key, None) is not None:
+        index_log.info("Peer %s:%s reconnected, keeping its restored records", host, port)
+    else:
+        index_log.info("Added %s:%s", host, port)
+    return True
+
+def peer_keepalive(host, port, token, report=None):
+    """The peer's session token, and whether `token` is it -- i.e. its records were kept.
+
+    `report` is the peer's (uploads active, uploads served since its last report,
+    upload capacity), for rank_holders.
+    """
+    session = peers.get((host, port))
+    if session is None:
+        return "", False  # removed again since this request's peer_add
+    if report is not None:
+        active, served, capacity = report
+        now = time.monotonic()
+        session['active'] = active
+        session['capacity'] = max(1, capacity)
+        # referrals only see LOOKUPs; this catches GETs found through a LIST or a replica
+        session['load'] = max(recent_load(session, now), served)
+        session['load_at'] = now
+    return session['token'], token == session['token']
+
+# LOOKUP ranking. Users GET from the first holder a LOOKUP lists, so holders are
+# ordered by how busy they are per upload slot: uploads under way as last reported,
+# plus recent load -- a decaying count of the LOOKUPs that put them first, topped up
+# by the GETs they report serving. Holders on the requester's host come first, the
+# requester itself last; restored peers that haven't reconnected go after the rest.
+LOAD_HALF_LIFE = 30.0  # seconds for recent load to halve
+
+def recent_load(peer, now):
+    return peer['load'] * 0.5 ** ((now - peer['load_at']) / LOAD_HALF_LIFE)
+
+def refer(key):
+    # the holder a LOOKUP listed first is expected to get the download
+    peer = peers.get(key)
+    if peer is not None:  # per-peer stat like 'requests': a rare lost update is harmless
+        now = time.monotonic()
+        peer['load'] = recent_load(peer, now) + 1
+        peer['load_at'] = now
+        if index_client is not None:
+            referred[key] += 1  # passed on to the owner by refresh_peer_loads
+
+def rank_holders(holders, requester, max_results=0):
+    """Positions into holders' items, best download source first; at most
+    max_results of them unless that is 0. Counts the first as referred."""
+    now = time.monotonic()
+    local_host = requester[0] if requester is not None else None
+    keys = list(holders)
+    scored = []
+    # runs on every LOOKUP of a shared RFC, hence inline rather than a key function
+    for position, key in enumerate(keys):
+        peer = peers.get(key)
+        if peer is None:
+            cost = float("inf")
+        else:
+            load = peer['load'] * 0.5 ** ((now - peer['load_at']) / LOAD_HALF_LIFE)
+            cost = (peer['active'] + load) / peer['capacity']
+        place = 2 if key == requester else 0 if key[0] == local_host else 1
+        scored.append((place, cost, position))  # position breaks ties: registration order
+    if 0 < max_results < len(scored):
+        scored = heapq.nsmallest(max_results, scored)
+    else:
+        scored.sort()
+    order = [position for _, _, position in scored]
+    refer(keys[order[0]])
+    return order
+
+def holder_lines(rfc_number, holders):
+    # each holder's LOOKUP line, in holders' order, kept while holders is current
+    cached = lookup_lines.get(rfc_number)
+    if cached is not None and cached[0] is holders:
+        cache_touch(lookup_lines, rfc_number)
+        return cached[1]
+    lines = [f"RFC {rfc_number} {title} {host} {port}\r\n".encode() for (host, port), title in holders.items()]
+    cache_put(lookup_lines, rfc_number, (holders, lines))
+    return lines
+
 def rfc_add(rfc_number, title, host, port):
     with data_lock:
-        for rfc in rfc_index:
-            if rfc['rfc'] == rfc_number and rfc['host'] == host and rfc['port'] == port:
+        if not peer_present((host, port)):
+            return
+        if rfc_insert(rfc_number, title, (host, port)):
+            if journal is not None:
+                journal.append(("A", rfc_number, host, port, title))
+            if standbys:
+                replicate(("A", rfc_number, host, port, title))
+            index_log.debug("Added RFC %s from %s", rfc_number, host)
+
+def rfc_add_many(entries, host, port):
+    """Register (rfc_number, title) pairs for one peer under a single lock acquisition."""
+    key = (host, port)
+    with data_lock:
+        if not peer_present(key):
+            return 0
+        added = sum(rfc_insert(rfc_number, title, key) for rfc_number, title in entries)
+        if journal is not None and added:
+            journal.append(("B", host, port, entries))
+        if standbys and added:
+            replicate(("B", host, port, entries))
+    index_log.debug("Added %d RFC(s) from %s in one batch", added, host)
+    return added
+
+def peer_present(key):
+    # caller holds data_lock. The peer's lease may have been reaped between its
+    # request's peer_add and now; register it again rather than leave entries no
+    # lease covers.
+    return key in peers or key in provisional or peer_register(key)
+
+def rfc_insert(rfc_number, title, key):
+    # caller holds data_lock; returns False if the peer already had this RFC registered
+    global index_generation, list_cache, list_cache_v2, list_cache_deflate
+    key = peer_keys.setdefault(key, key)
+    holders = rfc_index.get(rfc_number)
+    if holders is None:
+        rfc_index[rfc_number] = {key: title}
+        rfc_order.add(rfc_number)
+        index_title(rfc_number, title)
+    elif key in holders:
+        return False
+    else:
+        first = next(iter(holders.values()))
+        if title == first:
+            title = first
+        elif title not in holders.values():
+            index_title(rfc_number, title)
+        holders = dict(holders)
+        holders[key] = title
+        rfc_index[rfc_number] = holders
+    numbers = peer_rfcs.get(key)
+    if numbers is None:
+        numbers = peer_rfcs[key] = array.array("q")
+    numbers.append(rfc_number)
+    index_counts['entries'] += 1
+    index_generation += 1
+    log_change(True, rfc_number, key, title)
+    lookup_cache.pop(rfc_number, None)
+    lookup_lines.pop(rfc_number, None)
+    lookup_cache_v2.pop(rfc_number, None)
+    list_cache = list_cache_v2 = list_cache_deflate = None
+    return True
+
+
+@functools.lru_cache(maxsize=4096)  # peers registering an RFC mostly share its title
+def title_tokens(title):
+    return frozenset(TOKEN_RE.findall(title.lower()))
+
+def index_title(rfc_number, title):
+    # caller holds data_lock, and `title` is new among the RFC's holders; O(tokens in it)
+    for token in title_tokens(title):
+        postings = title_postings.get(token)
+        if postings is None:
+            title_postings[token] = rfc_number
+            if not title_order_deferred:
+                bisect.insort(title_token_order, token)
+            continue
+        if type(postings) is int:
+            postings = title_postings[token] = {postings: 1}
+        postings[rfc_number] = postings.get(rfc_number, 0) + 1
+
+def unindex_title(rfc_number, title):
+    # caller holds data_lock, and no other holder of the RFC has `title`
+    for token in title_tokens(title):
+        postings = title_postings[token]
+        if type(postings) is int:
+            del title_postings[token]
+            if not title_order_deferred:
+                del title_token_order[bisect.bisect_left(title_token_order, token)]
+            continue
+        count = postings[rfc_number] - 1
+        if count:
+            postings[rfc_number] = count
+        elif len(postings) > 1:
+            del postings[rfc_number]
+        else:
+            del title_postings[token]
+            if not title_order_deferred:
+                del title_token_order[bisect.bisect_left(title_token_order, token)]
+
+def copy_title_postings():
+    # caller holds data_lock; the per-token dicts change in place, so a snapshot copies them
+    return {token: postings if type(postings) is int else postings.copy()
+            for token, postings in title_postings.items()}
+
+def sort_title_tokens():
+    # caller holds data_lock; ends a bulk load's title_order_deferred
+    global title_order_deferred
+    title_order_deferred = False
+    title_token_order[:] = sorted(title_postings)
+
+def rfc_search(terms, limit):
+    """(how many RFCs match, the first `limit` of them by number) for parse_query terms.
+
+    An RFC matches when, for every term, one of its holders' titles has that token
+    (or, for a prefix term, a token starting with it).
+    """
+    candidates = []
+    for token, prefix in terms:
+        if prefix:
+            # the order list may shift under us; slices are atomic copies
+            start = bisect.bisect_left(title_token_order, token)
+            end = bisect.bisect_left(title_token_order, token + "{")  # "{" sorts after "z"
+            numbers = set()
+            for match in title_token_order[start:end]:
+                postings = title_postings.get(match, ())
+                numbers.update((postings,) if type(postings) is int else postings)
+        else:
+            numbers = title_postings.get(token, ())
+            if type(numbers) is int:
+                numbers = (numbers,)
+        if not numbers:
+            return 0, []
+        candidates.append(numbers)
+    # walk the rarest term's RFCs, checking the others by membership
+    candidates.sort(key=len)
+    matches = [rfc_number for rfc_number in list(candidates[0])
+               if all(rfc_number in numbers for numbers in candidates[1:])]
+    return len(matches), heapq.nsmallest(limit, matches)
+
+def log_change(added, rfc_number, key, title):
+    # caller holds data_lock and has just bumped index_generation
+    global change_floor
+    if len(change_log) == CHANGE_LOG_SIZE:
+        change_floor = change_log[0][0]
+    change_log.append((index_generation, added, rfc_number, key, title))
+    if not change_event.is_set():
+        change_event.set()  # wake the notifier; it does the fan-out outside the lock
+
+def index_position():
+    return index_epoch, index_generation
+
+def changes_since(since, epoch):
+    """(epoch, generation, the change_log entries after generation `since`).
+
+    The entries are None when the log no longer reaches back to `since`, or `epoch`
+    names another run of the server; the caller then needs a full LIST ALL.
+    """
+    with data_lock:
+        generation = index_generation
+        if (epoch is not None and epoch != index_epoch) or not change_floor <= since <= generation:
+            return index_epoch, generation, None
+        changes = list(itertools.takewhile(lambda change: change[0] > since, reversed(change_log)))
+    changes.reverse()
+    return index_epoch, generation, changes
+
+def rfc_snapshot():
+    """(rfc, holders) pairs as of now; the holders dicts are never mutated, so this is stable."""
+    return list(rfc_index.items())
+
+def rfc_page(start, limit):
+    """Up to `limit` (rfc, title, host, port) entries in RFC-number order from cursor `start`.
+
+    A cursor is (rfc, skip): resume at that RFC number after its first `skip` holders.
+    Returns the entries and the cursor of the next page, or None once the end is reached.
+    Entries added or removed between pages may or may not show up in later pages.
+    """
+    start_rfc, skip = start
+    entries = []
+    numbers = rfc_order.slice_from(start_rfc, limit)  # every indexed RFC has at least one holder
+    for rfc_number in numbers:
+        holders = rfc_index.get(rfc_number)
+        if not holders:
+            continue
+        items = list(holders.items())
+        offset = skip if rfc_number == start_rfc else 0
+        room = limit - len(entries)
+        if len(items) - offset > room:
+            entries.extend((rfc_number, title, host, port)
+                           for (host, port), title in items[offset:offset + room])
+            return entries, (rfc_number, offset + room)
+        entries.extend((rfc_number, title, host, port) for (host, port), title in items[offset:])
+    if len(numbers) < limit:
+        return entries, None
+    next_rfc = numbers[-1] + 1
+    if not rfc_order.has_from(next_rfc):
+        return entries, None
+    return entries, (next_rfc, 0)
+
+def peer_delete(host, port):
+    with data_lock:
+        peer_remove((host, port))
+
+def peer_remove(key):
+    # caller holds data_lock
+    host, port = key
+    registered = peers.pop(key, None) is not None or provisional.pop(key, None) is not None
+    if port_owners.get(port) == host:
+        del port_owners[port]
+    # Only touch the RFCs this peer actually registered
+    rfc_numbers = peer_rfcs.pop(key, ())
+    peer_keys.pop(key, None)
+    replica_tokens.pop(key, None)
+    for rfc_number in rfc_numbers:
+        rfc_unlink(rfc_number, key)
+    if registered or rfc_numbers:
+        if journal is not None:
+            journal.append(("D", host, port))
+        if standbys:
+            replicate(("D", host, port))
+
+def rfc_unlink(rfc_number, key):
+    # caller holds data_lock; the peer's entry for the RFC leaves rfc_index (not peer_rfcs)
+    global index_generation, list_cache, list_cache_v2, list_cache_deflate
+    holders = rfc_index[rfc_number]
+    title = holders[key]
+    if len(holders) == 1:
+        del rfc_index[rfc_number]
+        rfc_order.remove(rfc_number)
+        unindex_title(rfc_number, title)
+    else:
+        holders = dict(holders)
+        del holders[key]
+        rfc_index[rfc_number] = holders
+        if title not in holders.values():
+            unindex_title(rfc_number, title)
+    index_counts['entries'] -= 1
+    index_generation += 1
+    log_change(False, rfc_number, key, title)
+    lookup_cache.pop(rfc_number, None)
+    lookup_lines.pop(rfc_number, None)
+    lookup_cache_v2.pop(rfc_number, None)
+    list_cache = list_cache_v2 = list_cache_deflate = None
+
+# push notifications -- SUBSCRIBE. A notifier thread follows the change log (the
+# worker's replica of it in --workers mode) and offers each change to the
+# subscriptions following its RFC. It never writes to a socket: each subscribed
+# connection has a writer of its own that sends what was queued between whole
+# responses, so a slow subscriber only fills its own queue. A full queue is dropped
+# for a single resync notice, after which the peer has to LOOKUP (or LIST SINCE) again.
+NOTIFY_QUEUE_LIMIT = 1000   # changes a subscriber may have waiting before that happens
+NOTIFY_POLL_SECONDS = 0.05  # longest the notifier sleeps between looks at the change log
+
+class Subscription:
+    """What one connection has subscribed to, and the changes waiting to be pushed to it."""
+
+    def __init__(self, session):
+        self.session = session
+        self.rfcs = set()
+        self.lock = threading.Lock()
+        self.queue = []
+        self.overflowed = False
+        self.closed = False
+        self.wake = None  # set by the connection's writer; called after offer()
+
+    def offer(self, change):
+        # notifier thread
+        with self.lock:
+            if self.overflowed:
                 return
-        rfc_index.append({'rfc': rfc_number, 'title': title, 'host': host, 'port': port})
-        print(f"[Server] Added RFC {rfc_number} from {host}")
+            if len(self.queue) >= NOTIFY_QUEUE_LIMIT:
+                self.queue = []
+                self.overflowed = True
+                notify_counts['resyncs'] += 1
+            else:
+                self.queue.append(change)
+
+    def resync(self):
+        with self.lock:
+            self.queue = []
+            self.overflowed = True
+            notify_counts['resyncs'] += 1
+
+    def take(self):
+        """Everything queued, encoded for the connection's protocol."""
+        with self.lock:
+            changes = [None] if self.overflowed else self.queue
+            self.queue = []
+            self.overflowed = False
+        if not changes:
+            return b""
+        notify_counts['pushed'] += len(changes)
+        return encode_notices(changes, self.session['protocol'])
+
+    def close(self):
+        self.closed = True
+        if self.wake is not None:
+            self.wake()
+
+def encode_notices(changes, protocol):
+    # a change of None stands for the resync notice
+    if protocol == 2:
+        out = bytearray()
+        for change in changes:
+            body = bytearray([0])
+            if change is None:
+                body.append(2)
+            else:
+                _, added, rfc_number, (host, port), title = change
+                body.append(added)
+                put_varint(body, rfc_number)
+                put_str(body, title)
+                put_str(body, host)
+                put_varint(body, port)
+            out += frame(body)
+        return bytes(out)
+    lines = []
+    for change in changes:
+        if change is None:
+            lines.append("NOTIFY RESYNC\r\n")
+        else:
+            _, added, rfc_number, (host, port), title = change
+            lines.append(f"NOTIFY {'ADD' if added else 'DEL'} RFC {rfc_number} {title} {host} {port}\r\n")
+    return "".join(lines).encode()
+
+# RFC number -> subscriptions following it; followers_all follow every RFC. Like the
+# index these sets are replaced rather than mutated, so the notifier reads them
+# without subscriptions_lock.
+followers = {}
+followers_all = frozenset()
+subscriptions_lock = threading.Lock()
+notifier_started = False
+notify_counts = {'pushed': 0, 'resyncs': 0}
+
+def subscribe(session, on, rfc_number):
+    """Start (on) or stop following one RFC for a connection, or every RFC if rfc_number is None."""
+    global followers_all, notifier_started
+    subscription = session['subscription']
+    if subscription is None:
+        if not on:
+            return
+        subscription = session['subscription'] = Subscription(session)
+    with subscriptions_lock:
+        if not notifier_started:
+            notifier_started = True
+            threading.Thread(target=run_notifier, daemon=True).start()
+        if rfc_number is not None:
+            numbers = [rfc_number]
+        elif on:
+            followers_all = followers_all | {subscription}
+            return
+        else:
+            # UNSUBSCRIBE ALL drops the per-RFC subscriptions too
+            followers_all = followers_all - {subscription}
+            numbers = list(subscription.rfcs)
+        for number in numbers:
+            members = followers.get(number, frozenset())
+            if on:
+                followers[number] = members | {subscription}
+                subscription.rfcs.add(number)
+            else:
+                members = members - {subscription}
+                if members:
+                    followers[number] = members
+                else:
+                    followers.pop(number, None)
+                subscription.rfcs.discard(number)
+
+def run_notifier():
+    """Offer every index change to the subscriptions following its RFC."""
+    epoch, seen = index_position()
+    while True:
+        change_event.wait(NOTIFY_POLL_SECONDS)
+        change_event.clear()
+        try:
+            epoch, generation, changes = changes_since(seen, epoch)
+        except (OSError, EOFError, RuntimeError) as e:
+            log.warning("Notifier could not read the change log - %s", e)
+            continue
+        if generation == seen:
+            continue
+        seen = generation
+        everyone = followers_all
+        woken = set()
+        if changes is None:
+            # changes were missed (or the index was loaded afresh): every subscriber resyncs
+            woken.update(everyone, *list(followers.values()))
+            for subscription in woken:
+                subscription.resync()
+        else:
+            for change in changes:
+                targets = followers.get(change[2])
+                if targets:
+                    targets = everyone | targets
+                elif everyone:
+                    targets = everyone
+                else:
+                    continue
+                for subscription in targets:
+                    subscription.offer(change)
+                woken.update(targets)
+        for subscription in woken:
+            if subscription.wake is not None:
+                subscription.wake()
+
+# persistence -- optional, enabled with --data-dir
+SNAPSHOT_RECORDS = 1000000  # also snapshot once the WAL holds this many records
+
+class IndexJournal:
+    """A snapshot of the index plus write-ahead logs of the changes made since.
+
+    wal.<n> files hold marshal records, appended under data_lock in index order:
+    ("A", rfc, host, port, title), ("B", host, port, [(rfc, title), ...]) and
+    ("D", host, port) for a peer leaving, and ("P", host, port, token) for a peer's
+    session token, so a peer that reconnects after a restart keeps it. index.snapshot
+    holds the index and tokens as they were when wal.<wal_seq> was closed (see
+    encode_snapshot), so recovery loads it and replays later WALs only.
+    Appends are buffered and flushed about once a second by the maintenance thread;
+    anything lost in a crash is re-sent when the peer reconnects and registers again.
+    """
+
+    def __init__(self, data_dir):
+        self.dir = data_dir
+        self.seq = 0
+        self.file = None
+        self.records = 0  # appended since the last snapshot
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def wal_numbers(self):
+        return sorted(int(name[4:]) for name in os.listdir(self.dir)
+                      if name.startswith("wal.") and name[4:].isdigit())
+
+    def load(self):
+        """Rebuild the index from disk and open a fresh WAL for new changes."""
+        global title_order_deferred
+        os.makedirs(self.dir, exist_ok=True)
+        covered = 0
+        title_order_deferred = True
+        # Millions of new dicts and tuples, none of them in a cycle: left on, the
+        # collector would scan the growing index over and over and double the load time
+        gc.disable()
+        try:
+            try:
+                with open(self.path("index.snapshot"), "rb") as f:
+                    data = marshal.loads(f.read())  # far faster than marshal.load(f)
+                covered = data["wal_seq"]
+                restore_snapshot(data)
+            except FileNotFoundError:
+                pass
 
+            numbers = self.wal_numbers()
+            for seq in numbers:
+                if seq > covered:
+                    self.replay(self.path(f"wal.{seq}"))
+        finally:
+            gc.enable()
+        with data_lock:
+            sort_title_tokens()
+        self.seq = max([covered] + numbers) + 1
+        self.file = open(self.path(f"wal.{self.seq}"), "ab")
 
-def rfc_lookup(rfc_number):
+    def replay(self, path):
+        with open(path, "rb") as f:
+            records = io.BytesIO(f.read())
+        while True:
+            try:
+                record = marshal.load(records)
+            except (EOFError, ValueError, TypeError):
+                break  # end of log, or a record torn by a crash
+            # straight into the index: the peers are not live, restore_index holds them provisionally
+            with data_lock:
+                apply_record(record)
+
+    def append(self, record):
+        # caller holds data_lock
+        marshal.dump(record, self.file)
+        self.records += 1
+
+    def flush(self):
+        with data_lock:
+            self.file.flush()
+
+    def snapshot(self):
+        # switch to a new WAL and copy the index at the same instant, then write it out
+        with data_lock:
+            rfcs = list(rfc_index.items())
+            postings = copy_title_postings()
+            generation = index_generation
+            # live sessions, plus restored ones whose peers have not reconnected yet
+            tokens = dict(replica_tokens)
+            tokens.update((key, session['token']) for key, session in peers.items())
+            self.file.close()
+            covered = self.seq
+            self.seq += 1
+            self.file = open(self.path(f"wal.{self.seq}"), "ab")
+            self.records = 0
+
+        start = time.perf_counter()
+        data = encode_snapshot(rfcs, postings)
+        data.update(wal_seq=covered, generation=generation, tokens=tokens)
+        tmp = self.path("index.snapshot.tmp")
+        with open(tmp, "wb") as f:
+            marshal.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path("index.snapshot"))
+        for seq in self.wal_numbers():
+            if seq <= covered:
+                os.remove(self.path(f"wal.{seq}"))
+        log.info("Wrote index snapshot of %d RFC(s) in %.3fs", len(rfcs), time.perf_counter() - start)
+
+journal = None
+
+def apply_record(record):
+    # caller holds data_lock; a WAL or replication record, straight into the index
+    if record[0] == "P":
+        replica_tokens[(record[1], record[2])] = record[3]
+    elif record[0] == "A":
+        rfc_insert(record[1], record[4], (record[2], record[3]))
+    elif record[0] == "B":
+        for rfc_number, title in record[3]:
+            rfc_insert(rfc_number, title, (record[1], record[2]))
+    elif record[0] == "D":
+        peer_remove((record[1], record[2]))
+
+def encode_snapshot(rfcs, postings):
+    """Columnar snapshot of (rfc, holders) pairs, with the title_postings copied at
+    the same instant.
+
+    Each peer key and each distinct title is stored once and entries refer to them
+    by position, so loading creates no per-entry tuples or strings and can rebuild
+    every holders dict with a single dict(zip(...)). The postings are stored as they
+    are, so loading doesn't tokenize a single title.
+    """
+    peer_ids = {}
+    keys = []
+    per_peer = []  # RFC numbers held by each peer, by peer id
+    title_ids = {}
+    titles = []
+    encoded = []
+    for rfc_number, holders in rfcs:
+        pids = []
+        tids = []
+        for key, title in holders.items():
+            pid = peer_ids.get(key)
+            if pid is None:
+                pid = peer_ids[key] = len(keys)
+                keys.append(key)
+                per_peer.append([])
+            tid = title_ids.get(title)
+            if tid is None:
+                tid = title_ids[title] = len(titles)
+                titles.append(title)
+            pids.append(pid)
+            tids.append(tid)
+            per_peer[pid].append(rfc_number)
+        encoded.append((rfc_number, pids, tids))
+    return {'version': 3, 'peers': keys, 'titles': titles, 'rfcs': encoded, 'peer_rfcs': per_peer,
+            'postings': postings}
+
+def restore_snapshot(data):
+    """Load a snapshot straight into the empty index.
+
+    Title tokens are left out of title_token_order; the caller sorts them in with
+    sort_title_tokens() once anything else it loads is in too.
+    """
+    global index_generation, change_floor, title_order_deferred
+    keys = data["peers"]
+    titles = data["titles"]
+    postings = data.get("postings")  # not in version 2 snapshots
     with data_lock:
-        return [rfc for rfc in rfc_index if rfc['rfc'] == rfc_number]
+        title_order_deferred = True
+        for rfc_number, pids, tids in data["rfcs"]:
+            rfc_index[rfc_number] = dict(zip(map(keys.__getitem__, pids), map(titles.__getitem__, tids)))
+            index_counts['entries'] += len(pids)
+            if postings is None:
+                for tid in set(tids):
+                    index_title(rfc_number, titles[tid])
+        if postings is not None:
+            title_postings.update(postings)
+        peer_rfcs.update((key, array.array("q", numbers)) for key, numbers in zip(keys, data["peer_rfcs"]))
+        peer_keys.update(zip(keys, keys))
+        replica_tokens.update(data.get("tokens", {}))  # only in --data-dir snapshots
+        rfc_order.reset(sorted(rfc_index))
+        index_generation = change_floor = data["generation"]
 
-def rfc_list():
+def restore_index(data_dir, grace):
+    """Load persisted state and hold every restored peer's records for `grace` seconds."""
+    global journal
+    start = time.perf_counter()
+    loaded = IndexJournal(data_dir)
+    loaded.load()
+    deadline = time.monotonic() + grace
     with data_lock:
-        return list(rfc_index)
+        # a peer that had registered but held no RFCs comes back by its token alone
+        for host, port in set(peer_rfcs) | set(replica_tokens):
+            port_owners[port] = host
+            provisional[(host, port)] = deadline
+    journal = loaded
+    atexit.register(journal.flush)
+    log.info("Restored %d entries for %d peer(s) in %.3fs; holding them %ss for their peers to reconnect",
+             index_counts['entries'], len(provisional), time.perf_counter() - start, grace)
 
-def peer_delete(host, port):
-    global peers
-    global rfc_index
+def expire_provisional():
+    now = time.monotonic()
+    expired = [key for key, deadline in list(provisional.items()) if deadline <= now]
+    for key in expired:
+        with data_lock:
+            # the peer may have reconnected since the list was taken
+            deadline = provisional.get(key)
+            if deadline is None or deadline > now:
+                continue
+            peer_remove(key)
+        index_log.info("Dropped restored records for %s:%s, it did not reconnect in time", *key)
+
+def expire_leases():
+    now = time.monotonic()
+    expired = [key for key, session in list(peers.items()) if session['expires'] <= now]
+    for key in expired:
+        with data_lock:
+            # a request may have renewed the lease since the list was taken
+            session = peers.get(key)
+            if session is None or session['expires'] > now:
+                continue
+            peer_remove(key)
+        lease_counts['expired'] += 1
+        index_log.info("Lease of %s:%s ran out, removed all records", *key)
+
+def run_maintenance(snapshot_interval):
+    """Background upkeep: flush the WAL, expire restored peers and leases, take periodic snapshots."""
+    last_snapshot = time.monotonic()
+    while True:
+        time.sleep(1)
+        expire_provisional()
+        if lease_ttl:
+            expire_leases()
+        if journal is None:
+            continue
+        journal.flush()
+        due = time.monotonic() - last_snapshot >= snapshot_interval
+        if journal.records and (due or journal.records >= SNAPSHOT_RECORDS):
+            journal.snapshot()
+            last_snapshot = time.monotonic()
+
+# multi-process mode (--workers N) -- worker processes all accept on the server port
+# (SO_REUSEPORT) and parse, dispatch and answer requests. The index belongs to the
+# parent, the owner: workers call INDEX_OPS, every write among them, in it over local
+# connections, with plain values for arguments and results. Reads are served from a
+# replica of the index in each worker, loaded whole from the owner at start and then
+# brought up to date from its change log (REPLICA_OPS) every REPLICA_POLL_SECONDS,
+# and straight after each of the worker's own INDEX_WRITES so a peer always sees
+# what it has just added.
+INDEX_OPS = ("peer_add", "peer_keepalive", "rfc_add", "rfc_add_many", "peer_delete",
+             "index_metrics", "standby_addresses")
+INDEX_WRITES = ("rfc_add", "rfc_add_many")
+REPLICA_OPS = ("changes_since", "replica_snapshot", "peer_loads")
+REPLICA_POLL_SECONDS = 0.05
+PEER_LOADS_SECONDS = 1.0  # how often a worker refreshes the peer loads LOOKUPs rank by
+index_client = None  # in a worker process, the IndexClient its INDEX_OPS go through
+replica_lock = threading.Lock()  # worker side: one catch-up with the owner at a time
+referred = collections.Counter()  # worker side: LOOKUP referrals not yet passed to the owner
+peer_workers = {}    # owner side: (host, port) -> id of the worker that last served the peer
+REGISTRATION_RENEW_SECONDS = 5.0  # longest a worker goes without re-registering a connection's peer
+
+def register_peer(session, host, port, renew=False):
+    """peer_add() for a request on this connection from the peer at host:port.
+
+    In a worker peer_add is a round trip to the owner, so it is made on the
+    connection's first request and then only when a renewal is due: every
+    REGISTRATION_RENEW_SECONDS, and at least twice per --lease-ttl so the lease
+    never runs out under a peer that keeps sending. A KEEPALIVE (`renew`) always
+    renews. Requests in between are passed on with the renewal, for the per-peer
+    request count.
+    """
+    if index_client is None:
+        return peer_add(host, port)
+    key = (host, port)
+    now = time.monotonic()
+    if not renew and session['registered'] == key and now < session['renew_at']:
+        session['unreported'] += 1
+        return True
+    if session['registered'] != key:
+        session['unreported'] = 0
+    if not peer_add(host, port, session['unreported'] + 1):
+        session['registered'] = None
+        return False
+    interval = min(REGISTRATION_RENEW_SECONDS, lease_ttl / 2) if lease_ttl else REGISTRATION_RENEW_SECONDS
+    session.update(registered=key, renew_at=now + interval, unreported=0)
+    return True
+
+class IndexClient:
+    """Worker side of the index channel: runs INDEX_OPS in the owner process.
+
+    A call borrows an idle connection (opening one if none is free) and returns it when
+    the reply is in, so concurrent threads never interleave on a connection.
+    """
+
+    def __init__(self, address, authkey, worker_id):
+        self.address = address
+        self.authkey = authkey
+        self.worker_id = worker_id
+        self.idle = queue.SimpleQueue()
+
+    def call(self, name, args):
+        try:
+            channel = self.idle.get_nowait()
+        except queue.Empty:
+            channel = multiprocessing.connection.Client(self.address, authkey=self.authkey)
+            channel.send(self.worker_id)
+        channel.send((name, args))
+        ok, result = channel.recv()
+        self.idle.put(channel)
+        if not ok:
+            raise RuntimeError(f"index call {name} failed in the owner: {result}")
+        return result
+
+    def proxy(self, name):
+        def remote(*args):
+            result = self.call(name, args)
+            if name in INDEX_WRITES:
+                sync_replica()  # the peer's next request may read what it wrote
+            return result
+        remote.__name__ = name
+        return remote
+
+def replica_snapshot():
+    """The index as encode_snapshot() puts it, for a worker to load its replica from."""
     with data_lock:
-        peers = [peer for peer in peers if not (peer['host'] == host and peer['port'] == port)]
-        rfc_index = [rfc for rfc in rfc_index if not (rfc['host'] == host and rfc['port'] == port)]
+        rfcs = list(rfc_index.items())
+        postings = copy_title_postings()
+        generation = index_generation
+    data = encode_snapshot(rfcs, postings)
+    data.update(generation=generation, epoch=index_epoch)
+    return data
 
+def peer_loads(referrals):
+    """Count a worker's LOOKUP referrals in and return what rank_holders reads of every peer."""
+    now = time.monotonic()
+    for key, count in referrals.items():
+        peer = peers.get(key)
+        if peer is not None:
+            peer['load'] = recent_load(peer, now) + count
+            peer['load_at'] = now
+    return [(key, peer['active'], peer['capacity'], peer['load'], peer['load_at'])
+            for key, peer in list(peers.items())]
 
-def main():
+def load_replica():
+    # worker side, caller holds replica_lock; readers see the index refill, as on a
+    # standby taking a fresh snapshot
+    global index_epoch
+    data = index_client.call("replica_snapshot", ())
+    with data_lock:
+        clear_index()
+    gc.disable()  # as in IndexJournal.load
+    try:
+        restore_snapshot(data)
+    finally:
+        gc.enable()
+    with data_lock:
+        sort_title_tokens()
+    index_epoch = data["epoch"]
+
+def sync_replica():
+    """Apply the owner's changes since the replica's generation, or load the index
+    again if its change log no longer reaches back that far."""
+    with replica_lock:
+        _, generation, changes = index_client.call("changes_since", (index_generation, index_epoch))
+        if changes is None:
+            load_replica()
+            return
+        if not changes:
+            return
+        with data_lock:
+            for _, added, rfc_number, key, title in changes:
+                if added:
+                    rfc_insert(rfc_number, title, key)
+                else:
+                    # the owner only ever drops all of a peer's entries at once (peer_remove)
+                    peer_rfcs.pop(key, None)
+                    peer_keys.pop(key, None)
+                    rfc_unlink(rfc_number, key)
+            in_step = index_generation == generation
+        if not in_step:
+            log.warning("Replica is out of step with the owner at generation %s, loading it again", generation)
+            load_replica()
+
+def refresh_peer_loads():
+    # worker side: this process's `peers` holds only what rank_holders and refer use
+    global peers, referred
+    referrals, referred = referred, collections.Counter()
+    peers = {key: {'active': active, 'capacity': capacity, 'load': load, 'load_at': load_at}
+             for key, active, capacity, load, load_at in index_client.call("peer_loads", (dict(referrals),))}
+
+def follow_owner():
+    """Worker thread: keep the replica and the peer loads current."""
+    loads_due = time.monotonic() + PEER_LOADS_SECONDS
+    while True:
+        time.sleep(REPLICA_POLL_SECONDS)
+        try:
+            sync_replica()
+            if time.monotonic() >= loads_due:
+                refresh_peer_loads()
+                loads_due = time.monotonic() + PEER_LOADS_SECONDS
+        except (OSError, EOFError, RuntimeError) as e:
+            log.warning("Replica could not catch up with the owner - %s", e)
+
+def serve_index(listener):
+    while True:
+        try:
+            channel = listener.accept()
+        except (OSError, multiprocessing.AuthenticationError) as e:
+            log.warning("Rejected index channel - %s", e)
+            continue
+        threading.Thread(target=index_channel, args=(channel,), daemon=True).start()
+
+def index_channel(channel):
+    """Owner side of one worker connection: run each call it sends, in order."""
+    try:
+        worker_id = channel.recv()
+        while True:
+            name, args = channel.recv()
+            if name not in INDEX_OPS and name not in REPLICA_OPS:
+                channel.send((False, f"unknown index call {name!r}"))
+                continue
+            try:
+                result = globals()[name](*args)
+            except Exception as e:
+                index_log.exception("Index call %s from worker %s failed", name, worker_id)
+                channel.send((False, repr(e)))
+                continue
+            # remember who serves each peer, so a crashed worker's peers can be dropped
+            if name == "peer_add" and result:
+                peer_workers[args[:2]] = worker_id
+            elif name == "peer_delete":
+                peer_workers.pop(args, None)
+            channel.send((True, result))
+    except (EOFError, OSError):
+        pass
+    finally:
+        channel.close()
+
+def reap_worker(worker_id):
+    """Remove the peers a dead worker was serving, as its connections' close_session would have."""
+    if lease_ttl:
+        return 0  # their leases run out on their own
+    keys = [key for key, owner in list(peer_workers.items()) if owner == worker_id]
+    for key in keys:
+        # the peer may have reconnected through another worker in the meantime
+        if peer_workers.get(key) == worker_id:
+            del peer_workers[key]
+            peer_delete(*key)
+    return len(keys)
+
+def run_worker(worker_id, args, address, authkey):
+    """Body of a worker process: serve peers on the shared port against the owner's index."""
+    global index_client, data_lock
+    # shutdown is the owner's call: it terminates the workers on its way out
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # a forked child inherits the handler but not the listener thread behind it
+    logging.getLogger("ci").handlers.clear()
+    request_log.filters.clear()
+    setup_logging(args.log_level, max(1, args.log_sample), process_tag=True)
+
+    index_client = IndexClient(address, authkey, worker_id)
+    for name in INDEX_OPS:
+        globals()[name] = index_client.proxy(name)
+    # the fork copied the owner's index as it was, maybe mid-write and with data_lock held
+    data_lock = TimedLock()
+    with replica_lock:
+        load_replica()
+    refresh_peer_loads()
+    threading.Thread(target=follow_owner, daemon=True).start()
+    threading.Thread(target=watch_owner, args=(os.getppid(),), daemon=True).start()
+    set_connection_limits(args)
+    set_shards(args)
+    set_replication(args)
+
+    if args.engine == "asyncio":
+        main_asyncio(args.port, reuse_port=True)
+    else:
+        main_threads(args.port, reuse_port=True)
+
+def watch_owner(owner_pid):
+    # without the owner there is no index; don't linger accepting connections
+    while os.getppid() == owner_pid:
+        time.sleep(1)
+    os._exit(1)
+
+def start_worker(worker_id, args, address, authkey):
+    process = multiprocessing.Process(target=run_worker, args=(worker_id, args, address, authkey),
+                                      name=f"worker-{worker_id}", daemon=True)
+    process.start()
+    process.started = time.monotonic()
+    return process
+
+def main_workers(args):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        log.error("--workers needs SO_REUSEPORT, which this platform does not have")
+        return
     try:
-        s_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s_socket.bind(('', S_PORT))
-        s_socket.listen(5)
-        print(f"[SERVER] Listening on port {S_PORT}...")
+        # fail here, not in every worker, if the port is taken
+        listen_socket(args.port, reuse_port=True).close()
     except OSError as e:
-        if e.errno == 10048 or e.errno == 48:  # Windows/Unix port in use
-            print(f"[SERVER] Error: Port {S_PORT} is already in use")
-            print("[SERVER] Please close the other application using this port or choose a different port")
-        else:
-            print(f"[SERVER] Error: Cannot bind to port {S_PORT} - {e}")
+        report_bind_error(args.port, e)
+        return
+
+    address = os.path.join(tempfile.mkdtemp(prefix="p2p-ci-"), "index.sock")
+    authkey = os.urandom(16)
+    listener = multiprocessing.connection.Listener(address, family="AF_UNIX", authkey=authkey)
+    atexit.register(os.rmdir, os.path.dirname(address))
+    atexit.register(listener.close)
+    threading.Thread(target=serve_index, args=(listener,), daemon=True).start()
+    # stop on SIGTERM as on Ctrl-C, so exit handlers run and take the workers down too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    workers = {worker_id: start_worker(worker_id, args, address, authkey)
+               for worker_id in range(1, args.workers + 1)}
+    log.info("Listening on port %s with %d worker processes (%s engine)...",
+             args.port, args.workers, args.engine)
+    try:
+        while True:
+            multiprocessing.connection.wait([process.sentinel for process in workers.values()])
+            for worker_id, process in list(workers.items()):
+                if process.is_alive():
+                    continue
+                dropped = reap_worker(worker_id)
+                log.warning("Worker %s exited with code %s; dropped %d peer(s) it was serving",
+                            worker_id, process.exitcode, dropped)
+                if time.monotonic() - process.started < 1:
+                    log.error("Worker %s failed right after starting, shutting down", worker_id)
+                    return
+                workers[worker_id] = start_worker(worker_id, args, address, authkey)
+    except KeyboardInterrupt:
+        log.info("Shutting down...")
+
+
+def handle_stats(conn_file):
+    lines = [f"{name} {value}\r\n" for name, value in metrics_lines()]
+    conn_file.write(OK_HEADER + "".join(lines).encode() + b"\r\n")
+
+def metrics_lines():
+    """(name, value) pairs for STATS and the metrics listener, Prometheus text style."""
+    yield "uptime_seconds", round(time.time() - started_at, 3)
+    yield "connections_open", connection_counts['open']
+    yield "connections_total", connection_counts['total']
+    yield "connections_rejected_total", connection_counts['rejected']
+    yield "connections_timed_out_total", connection_counts['timed_out']
+    yield "notices_pushed_total", notify_counts['pushed']
+    yield "notice_resyncs_total", notify_counts['resyncs']
+    for method, count in sorted(request_counts.items()):
+        yield f'requests_total{{method="{method}"}}', count
+    for method, histogram in sorted(request_latency.items()):
+        for q in (0.5, 0.99):
+            yield f'request_latency_seconds{{method="{method}",quantile="{q}"}}', histogram.quantile(q)
+    for code, count in sorted(error_counts.items()):
+        yield f'errors_total{{code="{code}"}}', count
+    cache = response_cache_stats()
+    for name in ("lookup", "list", "list_deflate"):
+        yield f'response_cache_hits_total{{cache="{name}"}}', cache[f"{name}_hits"]
+        yield f'response_cache_misses_total{{cache="{name}"}}', cache[f"{name}_misses"]
+    # with --workers the counters above are this process's; the index ones come from the owner
+    yield from index_metrics()
+
+def index_metrics():
+    """The index's share of metrics_lines(), as a list so it can cross processes."""
+    lines = [("peers", len(peers)), ("leases_expired_total", lease_counts['expired']), ("rfcs", len(rfc_index)),
+             ("index_entries", index_counts['entries']), ("index_generation", index_generation),
+             ("change_log_entries", len(change_log)), ("title_tokens", len(title_postings))]
+    for name, histogram in (("wait", data_lock.wait), ("hold", data_lock.hold)):
+        for q in (0.5, 0.99):
+            lines.append((f'data_lock_{name}_seconds{{quantile="{q}"}}', histogram.quantile(q)))
+        lines.append((f"data_lock_{name}_seconds_total", round(histogram.total, 6)))
+    for name, size in index_memory_estimate().items():
+        lines.append((f"{name}_bytes_estimate", size))
+    lines.extend(replication_metrics())
+    return lines
+
+def index_memory_estimate(sample=500):
+    """Approximate footprint of the peer registry, the index and the response caches.
+
+    Containers are measured exactly; their contents from a sample of entries scaled
+    up, so the cost stays flat however large the index grows.
+    """
+    def scaled(items, size_of):
+        # the dicts are sampled live (the lookup caches are filled without data_lock),
+        # so a sample cut short by a writer resizing one is simply taken again
+        while True:
+            try:
+                picked = list(itertools.islice(items, sample))
+                break
+            except RuntimeError:
+                continue
+        if not picked:
+            return 0
+        return sum(map(size_of, picked)) * len(items) // len(picked)
+
+    peers_bytes = (sys.getsizeof(peers) + sys.getsizeof(port_owners)
+                   + scaled(peers.items(), lambda item: sys.getsizeof(item[0]) + sys.getsizeof(item[0][0])
+                            + sys.getsizeof(item[1])))
+    index_bytes = (sys.getsizeof(rfc_index) + sys.getsizeof(rfc_order) + sys.getsizeof(peer_rfcs)
+                   + sys.getsizeof(peer_keys)
+                   + scaled(rfc_index.values(), lambda holders: sys.getsizeof(holders)
+                            + sum(sys.getsizeof(title) for title in holders.values()))
+                   + scaled(peer_rfcs.values(), sys.getsizeof))
+    cache_bytes = 0
+    for lookups, cache in ((lookup_cache, list_cache), (lookup_cache_v2, list_cache_v2)):
+        cache_bytes += (sys.getsizeof(lookups) + scaled(lookups.values(), lambda item: len(item[1]))
+                        + (len(cache[1]) if cache is not None else 0))
+    if list_cache_deflate is not None:
+        cache_bytes += len(list_cache_deflate[1])
+    return {'peers': peers_bytes, 'rfc_index': index_bytes, 'response_cache': cache_bytes}
+
+def serve_metrics(port):
+    """Plaintext metrics on a separate port; answers plain connects and HTTP GETs alike."""
+    try:
+        m_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        m_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        m_socket.bind(('', port))
+        m_socket.listen(5)
+    except OSError as e:
+        log.error("Cannot start metrics listener on port %s - %s", port, e)
+        return
+    log.info("Metrics on port %s", port)
+    while True:
+        conn, _addr = m_socket.accept()
+        threading.Thread(target=metrics_conn, args=(conn,), daemon=True).start()
+
+def metrics_conn(conn):
+    with conn:
+        conn.settimeout(0.2)
+        try:
+            first = conn.recv(1024)
+        except (socket.timeout, OSError):
+            first = b""
+        body = "".join(f"{name} {value}\n" for name, value in metrics_lines()).encode()
+        if first.startswith(b"GET "):
+            body = (
+                "HTTP/1.0 200 OK\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "\r\n"
+            ).encode() + body
+        try:
+            conn.sendall(body)
+        except OSError:
+            pass
+
+def report_bind_error(port, e):
+    if e.errno == 10048 or e.errno == 48 or e.errno == 98:  # Windows/macOS/Linux port in use
+        log.error("Port %s is already in use", port)
+        log.error("Please close the other application using this port or choose a different port")
+    else:
+        log.error("Cannot bind to port %s - %s", port, e)
+
+def raise_fd_limit():
+    # every idle peer holds a socket, so lift the soft open-file limit to the hard one
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+async def serve_asyncio(port, reuse_port=False):
+    server = await asyncio.start_server(peer_conn_async, port=port, reuse_address=True,
+                                        reuse_port=reuse_port or None, backlog=listen_backlog)
+    log.info("Listening on port %s (asyncio engine)...", port)
+    async with server:
+        await server.serve_forever()
+
+def main_asyncio(port, reuse_port=False):
+    raise_fd_limit()
+    try:
+        asyncio.run(serve_asyncio(port, reuse_port))
+    except OSError as e:
+        report_bind_error(port, e)
+    except KeyboardInterrupt:
+        log.info("Shutting down...")
+
+# Sharded deployment (--shards): several independent servers, each owning the RFC
+# numbers that consistent hashing maps to it. An RFC hashes onto a ring of
+# SHARD_VNODES points per shard and belongs to the next point clockwise, so adding
+# a shard moves only about 1/N of the RFCs. Peers learn the shard list from OPTIONS
+# and build the same ring (peer.py carries a copy of these functions): ADD, LOOKUP
+# and SUBSCRIBE go to the owner, LIST ALL and SEARCH to every shard and are merged.
+# A shard answers 421 for an RFC it does not own, and its LIST ALL is its own slice.
+SHARD_VNODES = 64
+shard_names = ()  # --shards, "host:port" each; empty when not sharded
+own_shard = None  # this instance's entry in shard_names
+shard_ring = ([], [])  # ring points, sorted, and the shard owning each
+
+def ring_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+def build_ring(names):
+    points = sorted((ring_hash(f"{name}#{i}"), name) for name in names for i in range(SHARD_VNODES))
+    return [point for point, _ in points], [name for _, name in points]
+
+def shard_of(rfc_number):
+    points, owners = shard_ring
+    return owners[bisect.bisect(points, ring_hash(str(rfc_number))) % len(points)]
+
+def misdirected(rfc_numbers):
+    """The shard owning the first of rfc_numbers that isn't this one's, or None."""
+    if shard_names:
+        for rfc_number in rfc_numbers:
+            if rfc_number is not None:
+                owner = shard_of(rfc_number)
+                if owner != own_shard:
+                    return owner
+    return None
+
+def set_shards(args):
+    """Adopt --shards and --shard-name; returns False (having logged why) if they don't fit."""
+    global shard_names, own_shard, shard_ring
+    if not args.shards:
+        return True
+    names = tuple(dict.fromkeys(name.strip() for name in args.shards.split(",") if name.strip()))
+    if args.shard_name:
+        own = args.shard_name
+    else:
+        # the entry with this instance's port, as long as only one has it
+        matches = [name for name in names if name.rpartition(":")[2] == str(args.port)]
+        own = matches[0] if len(matches) == 1 else None
+    if own not in names:
+        log.error("--shards must list this instance; name its entry with --shard-name")
+        return False
+    shard_names, own_shard, shard_ring = names, own, build_ring(names)
+    log.info("Shard %s of %d: %s", own, len(names), ", ".join(names))
+    return True
+
+# Hot standby (--replication-port on the primary, --standby-of on each standby). The
+# primary streams every index change to its standbys in the order it made them: the
+# journal's A/B/D records plus ("P", host, port, token) for each new peer session,
+# after a snapshot of the whole index for a standby that (re)connects. Messages are
+# a 4-byte length and a marshal body, ("S", seq, sent_at, snapshot, tokens, port),
+# ("R", seq, sent_at, records) or, when there is nothing to send, the heartbeat
+# ("H", seq, sent_at); seq counts the records streamed so far and the standby acks
+# each message with "ACK <seq>". A standby applies them straight to its index, serves
+# LOOKUP, LIST, SEARCH, LIST SINCE and SUBSCRIBE from it, and refuses writes with a
+# 403 naming the primary. Promoted -- SIGUSR1, or --promote-after seconds without
+# the primary -- it holds the replicated records for --grace like a restart does, and
+# hands each peer that comes back its old session token, so leases resume as they were.
+REPLICATION_HEARTBEAT = 0.5        # seconds between messages to an idle standby
+REPLICATION_QUEUE_LIMIT = 100000   # records a standby may fall behind by before it is resent a snapshot
+replication_port = 0     # --replication-port; 0 when no standbys are served
+replication_seq = 0      # records streamed so far
+standbys = set()         # Standby per connected standby; changed and walked under data_lock
+primary_address = None   # a standby's --standby-of, "host:port"; None on a primary
+primary_client = None    # the primary's port for peers, as "host:port", once the standby has heard from it
+replica_tokens = {}      # (host, port) -> session token the peer had from the old primary or before a restart
+promotion_grace = 60.0   # --grace
+replication_state = {'connected': 0, 'applied': 0, 'sent_at': 0.0, 'snapshots': 0}
+
+class Standby:
+    """Primary side of one standby: the records it has yet to be sent."""
+
+    def __init__(self, address):
+        self.address = address  # where its peers would reach it, for OPTIONS
+        self.queue = collections.deque()
+        self.resync = True      # send a snapshot next: it starts with one
+        self.acked = 0
+        self.event = threading.Event()
+
+    def offer(self, record):
+        # caller holds data_lock
+        if len(self.queue) >= REPLICATION_QUEUE_LIMIT:
+            self.queue.clear()
+            self.resync = True
+        elif not self.resync:
+            self.queue.append(record)
+        self.event.set()
+
+def replicate(record):
+    # caller holds data_lock and has checked that standbys is non-empty
+    global replication_seq
+    replication_seq += 1
+    for standby in standbys:
+        standby.offer(record)
+
+def standby_addresses():
+    return sorted(standby.address for standby in list(standbys))
+
+def serve_replication(port, client_port):
+    try:
+        r_socket = listen_socket(port)
+    except OSError as e:
+        log.error("Cannot start replication listener on port %s - %s", port, e)
+        return
+    log.info("Replicating to standbys on port %s", port)
+    while True:
+        conn, addr = r_socket.accept()
+        threading.Thread(target=replication_conn, args=(conn, addr, client_port), daemon=True).start()
+
+def replication_conn(conn, addr, client_port):
+    """Stream the index to one standby until it goes away."""
+    with conn:
+        conn.settimeout(REPLICATION_HEARTBEAT * 4)
+        reader = conn.makefile("rb")
+        try:
+            hello = reader.readline(64).split()
+        except OSError:
+            return
+        if len(hello) != 2 or hello[0] != b"REPLICATE" or not hello[1].isdigit():
+            return
+        if primary_address is not None:
+            log.warning("Refused standby %s: this server is a standby itself", addr[0])
+            return
+        standby = Standby(f"{addr[0]}:{int(hello[1])}")
+        with data_lock:
+            standbys.add(standby)
+        log.info("Standby %s connected", standby.address)
+        threading.Thread(target=read_acks, args=(reader, standby), daemon=True).start()
+        try:
+            while True:
+                with data_lock:
+                    standby.event.clear()
+                    if standby.resync:
+                        rfcs = list(rfc_index.items())
+                        postings = copy_title_postings()
+                        tokens = {key: session['token'] for key, session in peers.items()}
+                        standby.resync = False
+                        records = None
+                    else:
+                        records = list(standby.queue)
+                    standby.queue.clear()
+                    seq = replication_seq
+                if records is None:
+                    message = ("S", seq, time.time(), encode_snapshot(rfcs, postings), tokens, client_port)
+                elif records:
+                    message = ("R", seq, time.time(), records)
+                else:
+                    message = ("H", seq, time.time())
+                body = marshal.dumps(message)
+                conn.sendall(struct.pack(">I", len(body)) + body)
+                if not records:
+                    standby.event.wait(REPLICATION_HEARTBEAT)
+        except OSError as e:
+            log.warning("Standby %s disconnected - %s", standby.address, e)
+        finally:
+            with data_lock:
+                standbys.discard(standby)
+
+def read_acks(reader, standby):
+    try:
+        for line in reader:
+            parts = line.split()
+            if len(parts) == 2 and parts[0] == b"ACK" and parts[1].isdigit():
+                standby.acked = int(parts[1])
+    except OSError:
+        pass
+
+def follow_primary(client_port, promote_after):
+    """Standby main loop: apply the primary's stream, reconnecting until promoted."""
+    while primary_address is not None:
+        try:
+            stream_from_primary(client_port)
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            if replication_state['connected']:
+                log.warning("Lost the primary at %s - %s", primary_address, e)
+        replication_state['connected'] = 0
+        # promote only a standby that has had a copy of the index to promote
+        idle = time.time() - replication_state['sent_at']
+        if promote_after and replication_state['snapshots'] and idle >= promote_after:
+            promote(f"no primary for {idle:.1f}s")
+            return
+        time.sleep(REPLICATION_HEARTBEAT)
+
+def stream_from_primary(client_port):
+    host, _, port = primary_address.rpartition(":")
+    with socket.create_connection((host, int(port)), timeout=REPLICATION_HEARTBEAT * 4) as sock:
+        sock.sendall(f"REPLICATE {client_port}\n".encode())
+        reader = sock.makefile("rb")
+        while primary_address is not None:
+            header = reader.read(4)
+            if len(header) < 4:
+                raise EOFError("primary closed the stream")
+            size = struct.unpack(">I", header)[0]
+            body = reader.read(size)
+            if len(body) < size:
+                raise EOFError("primary closed the stream")
+            message = marshal.loads(body)
+            if not replication_state['connected']:
+                replication_state['connected'] = 1
+                log.info("Following the primary at %s", primary_address)
+            apply_replication(message, host)
+            sock.sendall(f"ACK {message[1]}\n".encode())
+
+def apply_replication(message, primary_host):
+    global primary_client
+    kind, seq, sent_at = message[:3]
+    if kind == "S":
+        data, tokens = message[3], message[4]
+        with data_lock:
+            # a fresh start: LIST SINCE readers and subscribers see a resync
+            data['generation'] = index_generation + 1
+            clear_index()
+            replica_tokens.clear()
+            replica_tokens.update(tokens)
+        gc.disable()  # as in IndexJournal.load
+        try:
+            restore_snapshot(data)
+        finally:
+            gc.enable()
+        with data_lock:
+            sort_title_tokens()
+        primary_client = f"{primary_host}:{message[5]}"
+        replication_state['snapshots'] += 1
+        if journal is not None:
+            journal.snapshot()
+        log.info("Loaded a snapshot of %d entries from the primary", index_counts['entries'])
+    elif kind == "R":
+        with data_lock:
+            for record in message[3]:
+                apply_record(record)
+                if record[0] != "D" and journal is not None:
+                    journal.append(record)  # peer_remove journals a "D" itself
+    replication_state.update(applied=seq, sent_at=sent_at)
+
+def clear_index():
+    # caller holds data_lock; empties the index for a standby's fresh snapshot
+    global list_cache, list_cache_v2, list_cache_deflate
+    for table in (rfc_index, peer_rfcs, peer_keys, title_postings, provisional, port_owners,
+                  lookup_cache, lookup_cache_v2, lookup_lines):
+        table.clear()
+    rfc_order.reset()
+    title_token_order.clear()
+    change_log.clear()
+    index_counts['entries'] = 0
+    list_cache = list_cache_v2 = list_cache_deflate = None
+
+def promote(reason):
+    """Turn this standby into the primary, holding the replicated records for their peers."""
+    global primary_address
+    with data_lock:
+        if primary_address is None:
+            return
+        primary_address = None
+        deadline = time.monotonic() + promotion_grace
+        for host, port in set(peer_rfcs) | set(replica_tokens):
+            port_owners[port] = host
+            provisional[(host, port)] = deadline
+    log.warning("Promoted to primary (%s); holding %d peer(s)' records %ss for them to reconnect",
+                reason, len(provisional), promotion_grace)
+
+def replication_metrics():
+    if primary_address is not None:
+        lag = time.time() - replication_state['sent_at'] if replication_state['snapshots'] else -1
+        return [("replication_connected", replication_state['connected']),
+                ("replication_applied_records", replication_state['applied']),
+                ("replication_snapshots_total", replication_state['snapshots']),
+                ("replication_lag_seconds", round(lag, 3))]
+    if not replication_port:
+        return []
+    lines = [("replication_standbys", len(standbys)), ("replication_records_total", replication_seq)]
+    for standby in list(standbys):
+        lines.append((f'replication_lag_records{{standby="{standby.address}"}}', replication_seq - standby.acked))
+    return lines
+
+def set_replication(args):
+    """Adopt --replication-port, --standby-of and --grace; returns False (having logged why) if they don't fit."""
+    global replication_port, primary_address, promotion_grace
+    replication_port = args.replication_port
+    promotion_grace = args.grace
+    if args.standby_of:
+        if args.workers > 1:
+            log.error("--standby-of runs in a single process; drop --workers")
+            return False
+        host, _, port = args.standby_of.rpartition(":")
+        if not host or not port.isdigit():
+            log.error("--standby-of takes HOST:PORT, the primary's --replication-port")
+            return False
+        primary_address = args.standby_of
+    return True
+
+def listen_socket(port, reuse_port=False):
+    s_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s_socket.bind(('', port))
+    s_socket.listen(listen_backlog)
+    return s_socket
+
+def reject(conn):
+    # never wait on an overloaded server's behalf: one non-blocking send, then close
+    conn.setblocking(False)
+    try:
+        conn.send(OVERLOADED)
+    except OSError:
+        pass
+    conn.close()
+
+def main_threads(port, reuse_port=False):
+    try:
+        s_socket = listen_socket(port, reuse_port)
+        log.info("Listening on port %s...", port)
+    except OSError as e:
+        report_bind_error(port, e)
         return
     except Exception as e:
-        print(f"[SERVER] Error: Failed to start server - {e}")
+        log.error("Failed to start server - %s", e)
         return
 
     try:
         while True:
             conn, addr = s_socket.accept()
-            print(f"[SERVER] New connection from {addr}")
+            conn_log.debug("New connection from %s", addr)
+            if not admit():
+                reject(conn)
+                continue
 
             thread = threading.Thread(target=peer_conn, args=(conn, addr), daemon=True)
             thread.start()
     except KeyboardInterrupt:
-        print("\n[SERVER] Shutting down...")
+        log.info("Shutting down...")
         s_socket.close()
     except Exception as e:
-        print(f"[SERVER] Error: {e}")
+        log.error("%s", e)
         s_socket.close()
 
+def main():
+    parser = argparse.ArgumentParser(description="P2P-CI centralized index server")
+    parser.add_argument("--port", type=int, default=S_PORT, help=f"listening port (default {S_PORT})")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads",
+                        help="threads: one thread per peer (default); asyncio: one event loop for all peers")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="DEBUG adds a line per request and per registered RFC (default INFO)")
+    parser.add_argument("--log-sample", type=int, default=1, metavar="N",
+                        help="at DEBUG, log only one in every N request lines")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="also serve plaintext metrics on this port (off by default)")
+    parser.add_argument("--data-dir",
+                        help="persist the index here (snapshot + write-ahead log) and reload it on start")
+    parser.add_argument("--snapshot-interval", type=float, default=300,
+                        help="seconds between index snapshots when --data-dir is set (default 300)")
+    parser.add_argument("--grace", type=float, default=60,
+                        help="seconds restored peers have to reconnect before their records go (default 60)")
+    parser.add_argument("--lease-ttl", type=float, default=0,
+                        help="seconds a peer's records outlive its last request or KEEPALIVE, "
+                             "across reconnects; 0 drops them when its connection closes (default)")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN,
+                        help=f"listen backlog for connect bursts, e.g. after a restart (default {socket.SOMAXCONN})")
+    parser.add_argument("--max-connections", type=int, default=0,
+                        help="connections served at once, per process; past it peers are told "
+                             "503 and when to retry (default 0: no cap)")
+    parser.add_argument("--request-timeout", type=float, default=30,
+                        help="seconds a request may take to arrive, and a send may stall, "
+                             "before the connection is closed (default 30; 0 for none)")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        help="seconds a connection may sit between requests before it is closed "
+                             "(default 0: indefinitely)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port, with the index kept in this one (default 1)")
+    parser.add_argument("--shards", metavar="HOST:PORT,...",
+                        help="run as one shard of this list of servers, owning its slice of the RFC "
+                             "numbers; peers connect to every shard (tools/run_shards.py starts a set)")
+    parser.add_argument("--shard-name", metavar="HOST:PORT",
+                        help="this instance's entry in --shards (default: the one with --port)")
+    parser.add_argument("--replication-port", type=int, default=0,
+                        help="stream the index to standbys connecting on this port (off by default)")
+    parser.add_argument("--standby-of", metavar="HOST:PORT",
+                        help="run as a read-only standby of the primary with this --replication-port")
+    parser.add_argument("--promote-after", type=float, default=0,
+                        help="seconds a standby waits without its primary before taking over "
+                             "(default 0: only when sent SIGUSR1)")
+    args = parser.parse_args()
+    setup_logging(args.log_level, max(1, args.log_sample))
+    if not set_shards(args) or not set_replication(args):
+        return
+
+    global lease_ttl
+    lease_ttl = max(0.0, args.lease_ttl)
+    set_connection_limits(args)
+    if args.data_dir:
+        restore_index(args.data_dir, args.grace)
+    if args.data_dir or lease_ttl or args.standby_of:
+        threading.Thread(target=run_maintenance, args=(args.snapshot_interval,), daemon=True).start()
+
+    if args.replication_port:
+        threading.Thread(target=serve_replication, args=(args.replication_port, args.port), daemon=True).start()
+    if args.standby_of:
+        threading.Thread(target=follow_primary, args=(args.port, args.promote_after), daemon=True).start()
+        if hasattr(signal, "SIGUSR1"):
+            # off the signal handler: the interrupted thread may be holding data_lock
+            signal.signal(signal.SIGUSR1, lambda *_: threading.Thread(
+                target=promote, args=("SIGUSR1",), daemon=True).start())
+
+    if args.metrics_port:
+        threading.Thread(target=serve_metrics, args=(args.metrics_port,), daemon=True).start()
+
+    if args.workers > 1:
+        main_workers(args)
+    elif args.engine == "asyncio":
+        main_asyncio(args.port)
+    else:
+        main_threads(args.port)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
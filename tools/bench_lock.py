@@ -0,0 +1,113 @@
+"""Lock contention benchmark for the CI server index.
+
+Fills the index, then runs LOOKUP reader threads while one thread keeps
+adding/removing peers and another keeps taking full LIST ALL copies.
+Each run is repeated with reads taking data_lock (the old single-lock
+scheme) and with the current lock-free copy-on-write reads, so lookup
+throughput and tail latency can be compared side by side.
+
+    python tools/bench_lock.py --peers 2000 --rfcs-per-peer 100 --seconds 3
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def fill_index(n_peers, rfcs_per_peer, rfc_space):
+    rng = random.Random(1)
+    for p in range(n_peers):
+        host, port = f"peer{p}", 10000 + p
+        server.peer_add(host, port)
+        for rfc in rng.sample(range(1, rfc_space), rfcs_per_peer):
+            server.rfc_add(rfc, f"Title of RFC {rfc}", host, port)
+
+
+def run(n_readers, seconds, rfc_space, with_lister, locked_reads):
+    if locked_reads:
+        def lookup(rfc):
+            with server.data_lock:
+                return server.lookup_response(rfc)
+
+        def listing():
+            with server.data_lock:
+                return server.list_all_response()
+    else:
+        lookup, listing = server.lookup_response, server.list_all_response
+
+    stop = threading.Event()
+    counts = [0] * n_readers
+    worst = [[] for _ in range(n_readers)]
+    writes = [0]
+
+    def reader(i):
+        rng = random.Random(i)
+        lat = worst[i]
+        n = 0
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            lookup(rng.randrange(1, rfc_space))
+            lat.append(time.perf_counter() - t0)
+            n += 1
+        counts[i] = n
+
+    def writer():
+        rng = random.Random(-1)
+        n = 0
+        while not stop.is_set():
+            host, port = f"churn{n}", 60000 + n % 5000
+            server.peer_add(host, port)
+            for rfc in rng.sample(range(1, rfc_space), 10):
+                server.rfc_add(rfc, "churn", host, port)
+            server.peer_delete(host, port)
+            n += 1
+        writes[0] = n
+
+    def lister():
+        while not stop.is_set():
+            listing()
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(n_readers)]
+    threads.append(threading.Thread(target=writer))
+    if with_lister:
+        threads.append(threading.Thread(target=lister))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    lat = sorted(x for per_thread in worst for x in per_thread)
+    p99 = lat[int(len(lat) * 0.99)] if lat else 0.0
+    return sum(counts) / seconds, p99, writes[0] / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--peers", type=int, default=2000)
+    parser.add_argument("--rfcs-per-peer", type=int, default=100)
+    parser.add_argument("--rfc-space", type=int, default=20000)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--readers", default="1,2,4,8")
+    parser.add_argument("--no-lister", action="store_true", help="skip the concurrent LIST ALL thread")
+    args = parser.parse_args()
+
+    fill_index(args.peers, args.rfcs_per_peer, args.rfc_space)
+
+    print(f"{'reads':<9} {'readers':>7} {'lookups/s':>12} {'p99 lookup':>12} {'peer churn/s':>13}")
+    for name, locked in (("locked", True), ("lock-free", False)):
+        results = [(n, run(n, args.seconds, args.rfc_space, not args.no_lister, locked))
+                   for n in map(int, args.readers.split(","))]
+        for n, (rate, p99, churn) in results:
+            print(f"{name:<9} {n:>7} {rate:>12.0f} {p99 * 1e3:>10.2f}ms {churn:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
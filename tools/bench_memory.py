@@ -0,0 +1,123 @@
+"""Index memory benchmark for the CI server.
+
+Registers --entries RFC registrations through server.rfc_add / rfc_add_many, the
+way request handling does. Hosts, ports and titles are parsed afresh for every
+request, like they come off the wire. It then reports the index's memory per
+registration, measured with tracemalloc and, in a separate untraced run, as the
+growth of the process RSS.
+
+--baseline REV also measures server.py as of that git revision, so a change to
+the index layout can be compared with what came before it:
+
+    python tools/bench_memory.py --entries 1000000 --baseline HEAD~1
+"""
+import argparse
+import gc
+import importlib.util
+import multiprocessing
+import os
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_server(path):
+    spec = importlib.util.spec_from_file_location("server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def requests(n_entries, n_peers, rfc_space, batch):
+    """Yield (entries, host, port) registrations as fresh objects, like parsed requests."""
+    rng = random.Random(1)
+    per_peer = n_entries // n_peers
+    for p in range(n_peers):
+        numbers = rng.sample(range(1, rfc_space), per_peer)
+        for i in range(0, per_peer, batch):
+            host = "".join(["10.0.", str(p // 256), ".", str(p % 256)])
+            port = int(str(10000 + p))
+            yield [(int(str(n)), " ".join(["RFC", str(n), "Title", "of", "RFC", str(n)]))
+                   for n in numbers[i:i + batch]], host, port
+
+
+def measure(path, args, trace, out):
+    server = load_server(path)
+    gc.collect()
+    rss_before = rss_bytes()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for entries, host, port in requests(args.entries, args.peers, args.rfc_space, args.batch):
+        server.peer_add(host, port)
+        if len(entries) == 1:
+            server.rfc_add(entries[0][0], entries[0][1], host, port)
+        else:
+            server.rfc_add_many(entries, host, port)
+    seconds = time.perf_counter() - start
+    gc.collect()
+    entries = server.index_counts['entries']
+    if trace:
+        out.put((entries, seconds, tracemalloc.get_traced_memory()[0] / entries))
+    else:
+        rss_after = rss_bytes()
+        out.put((entries, seconds, (rss_after - rss_before) / entries if rss_before is not None else None))
+
+
+def run(path, args, trace):
+    """(entries, fill seconds, bytes per entry) from a fresh process, so nothing else is counted."""
+    out = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(path, args, trace, out))
+    process.start()
+    result = out.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--peers", type=int, default=10000)
+    parser.add_argument("--rfc-space", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=1,
+                        help="RFCs per registration request: 1 for single ADDs, more for ADD RFCS")
+    parser.add_argument("--baseline", metavar="REV", help="also measure server.py from this git revision")
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false",
+                        help="skip the traced runs, which are several times slower")
+    args = parser.parse_args()
+
+    runs = []
+    if args.baseline:
+        source = subprocess.check_output(["git", "show", f"{args.baseline}:server.py"], cwd=ROOT)
+        with tempfile.NamedTemporaryFile("wb", suffix=".py", delete=False) as f:
+            f.write(source)
+        runs.append((args.baseline, f.name))
+    runs.append(("current", os.path.join(ROOT, "server.py")))
+
+    print(f"{'server.py':<12} {'entries':>9} {'traced B/entry':>15} {'RSS B/entry':>12} {'fill':>8}")
+    try:
+        for name, path in runs:
+            entries, seconds, rss = run(path, args, False)
+            traced = run(path, args, True)[2] if args.tracemalloc else None
+            traced = "-" if traced is None else round(traced)
+            rss = "-" if rss is None else round(rss)
+            print(f"{name:<12} {entries:>9} {traced:>15} {rss:>12} {seconds:>7.2f}s")
+    finally:
+        if args.baseline:
+            os.unlink(runs[0][1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""P2P-CI/1.0 parsing micro-benchmarks for the server and the peer.
+
+Server: pipelined LOOKUP, ADD and ADD RFCS requests are fed to
+server.RequestFramer in recv-sized chunks, and every request is taken out with
+next_request(), the way a connection loop does. Peer: LOOKUP responses and one
+large LIST ALL response are read back through peer.CIStream over an in-memory
+socket, the way send_lookup and send_list read them. No sockets or threads are
+involved, so only the parsing is timed.
+
+--baseline REV also runs server.py and Peer1/peer.py as of that git revision, so
+a parser change can be compared with what came before it:
+
+    python tools/bench_parser.py --baseline HEAD~1
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PEER_HOST, PEER_PORT = "10.0.0.1", 10001
+
+
+def load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def entry_lines(n):
+    return [f"RFC {rfc} Title of RFC {rfc} {PEER_HOST} {PEER_PORT}\r\n" for rfc in range(1, n + 1)]
+
+
+def request_stream(kind, count):
+    """`count` pipelined requests of one kind, as the bytes a peer sends."""
+    headers = f"Host: {PEER_HOST}\r\nPort: {PEER_PORT}\r\n"
+    if kind == "lookup":
+        one = lambda n: f"LOOKUP RFC {n} P2P-CI/1.0\r\n{headers}Title: Title of RFC {n}\r\n\r\n"
+    elif kind == "add":
+        one = lambda n: f"ADD RFC {n} P2P-CI/1.0\r\n{headers}Title: Title of RFC {n}\r\n\r\n"
+    else:
+        batch = "".join(entry_lines(100))
+        one = lambda n: f"ADD RFCS P2P-CI/1.0\r\n{headers}Count: 100\r\n\r\n{batch}"
+    return "".join(one(n) for n in range(count)).encode()
+
+
+def bench_framer(server, data, chunk, repeat):
+    """Requests framed per second, best of `repeat`."""
+    best = None
+    for _ in range(repeat):
+        framer = server.RequestFramer()
+        requests = 0
+        start = time.perf_counter()
+        for i in range(0, len(data), chunk):
+            framer.feed(data[i:i + chunk])
+            while framer.next_request() is not None:
+                requests += 1
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return requests / best
+
+
+class MemorySocket:
+    """Just enough of a socket for CIStream: recv() hands out `data` in chunks."""
+
+    def __init__(self, data, chunk):
+        self.data, self.chunk, self.pos = data, chunk, 0
+
+    def recv(self, size):
+        end = self.pos + min(size, self.chunk)
+        data = self.data[self.pos:end]
+        self.pos = end
+        return data
+
+
+def read_entries(stream):
+    """Status line and entry lines of one LOOKUP/LIST response, as send_lookup reads them."""
+    if hasattr(stream, "read_head"):
+        status, code, _ = stream.read_head()
+        return status, stream.read_lines() if code == 200 else []
+    # before read_head/read_lines: a readline() and a decode per line
+    status = stream.readline().decode().strip()
+    stream.readline()
+    lines = []
+    while True:
+        line = stream.readline().decode().strip()
+        if line == "":
+            break
+        lines.append(line)
+    return status, lines
+
+
+def bench_responses(peer, data, responses, chunk, repeat):
+    """Responses read per second, best of `repeat`."""
+    best = None
+    for _ in range(repeat):
+        stream = peer.CIStream(MemorySocket(data, chunk))
+        start = time.perf_counter()
+        for _ in range(responses):
+            read_entries(stream)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return responses / best
+
+
+def run(server_path, peer_path, args):
+    server = load("server", server_path)
+    peer = load("peer", peer_path)
+    results = []
+    for kind in ("lookup", "add", "add-rfcs"):
+        count = args.requests // 100 if kind == "add-rfcs" else args.requests
+        rate = bench_framer(server, request_stream(kind, count), args.chunk, args.repeat)
+        results.append((f"server {kind}", rate, "requests/s"))
+
+    lookup = "".join(f"P2P-CI/1.0 200 OK\r\n\r\n{line}\r\n" for line in entry_lines(1)).encode()
+    rate = bench_responses(peer, lookup * args.requests, args.requests, args.chunk, args.repeat)
+    results.append(("peer lookup", rate, "responses/s"))
+    listing = ("P2P-CI/1.0 200 OK\r\n\r\n" + "".join(entry_lines(args.list_entries)) + "\r\n").encode()
+    rate = bench_responses(peer, listing, 1, args.chunk, args.repeat)
+    results.append((f"peer list ({args.list_entries} entries)", rate * args.list_entries, "entries/s"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100000, help="pipelined requests per server run")
+    parser.add_argument("--list-entries", type=int, default=200000, help="entries in the LIST ALL response")
+    parser.add_argument("--chunk", type=int, default=64 * 1024, help="bytes per recv (default 64 KiB)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the best is reported")
+    parser.add_argument("--baseline", metavar="REV", help="also run server.py and peer.py from this git revision")
+    args = parser.parse_args()
+
+    runs = []
+    temporary = []
+    if args.baseline:
+        paths = []
+        for name in ("server.py", "Peer1/peer.py"):
+            source = subprocess.check_output(["git", "show", f"{args.baseline}:{name}"], cwd=ROOT)
+            with tempfile.NamedTemporaryFile("wb", suffix=".py", delete=False) as f:
+                f.write(source)
+            paths.append(f.name)
+        temporary.extend(paths)
+        runs.append((args.baseline, *paths))
+    runs.append(("current", os.path.join(ROOT, "server.py"), os.path.join(ROOT, "Peer1", "peer.py")))
+
+    try:
+        table = [(name, run(server_path, peer_path, args)) for name, server_path, peer_path in runs]
+    finally:
+        for path in temporary:
+            os.unlink(path)
+
+    print(f"{'case':<28} " + " ".join(f"{name:>14}" for name, _ in table) + "  unit")
+    for i, (case, _, unit) in enumerate(table[0][1]):
+        rates = " ".join(f"{results[i][1]:>14,.0f}" for _, results in table)
+        print(f"{case:<28} {rates}  {unit}")
+    if len(table) > 1:
+        base, current = table[0][1], table[-1][1]
+        speedups = ", ".join(f"{c[0]} x{c[1] / b[1]:.2f}" for b, c in zip(base, current))
+        print(f"speed-up: {speedups}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+"""Load generator and benchmark for the CI server.
+
+Starts server.py on a free local port (or targets a running one with --connect),
+then simulates --peers peers, each on its own CI connection. Every peer first
+registers --rfcs-per-peer RFCs, then sends a weighted mix of ADD, LOOKUP and
+LIST ALL requests for --seconds, one at a time, timing each request until its
+full response is in. Requests are the exact bytes Peer1/peer.py sends
+(format_add, format_lookup, format_list, or their encode_*_v2 counterparts
+with --protocol 2). --deflate adds "Accept-Encoding: deflate" to 1.0 LOOKUPs and
+LISTs.
+
+Results -- throughput, p50/p99/p999 latency per method, errors, the server's RSS
+and its own STATS -- are written as JSON. --compare checks them against an
+earlier run's JSON and exits 1 on a regression beyond --tolerance.
+
+    python tools/bench_server.py --peers 2000 --rfcs-per-peer 50 --seconds 10 \\
+        --mix add=1,lookup=20,list=0.1 --output run.json
+    python tools/bench_server.py --server-args="--workers 4" --compare run.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Peer1"))
+
+import peer  # noqa: E402
+
+METHODS = ("ADD", "LOOKUP", "LIST")
+BASE_PORT = 10000         # simulated peer i announces upload port BASE_PORT + i
+STREAM_LIMIT = 1 << 28    # largest response the client will buffer (a full LIST ALL)
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        method = name.strip().upper()
+        if method not in METHODS:
+            raise argparse.ArgumentTypeError(f"unknown method {name!r} in --mix")
+        weights[method] = float(weight)
+    if sum(weights.values()) <= 0:
+        raise argparse.ArgumentTypeError("--mix needs a positive weight")
+    return weights
+
+
+def request_for(method, rng, peer_port, rfc_space, protocol, deflate=False):
+    if protocol == 2:
+        rfc_number = rng.randrange(1, rfc_space)
+        if method == "ADD":
+            return peer.encode_add_v2(rfc_number, f"RFC {rfc_number} Title")
+        if method == "LOOKUP":
+            return peer.encode_lookup_v2(rfc_number)
+        return peer.encode_list_v2()
+    if method == "ADD":
+        rfc_number = rng.randrange(1, rfc_space)
+        return peer.format_add(rfc_number, f"RFC {rfc_number} Title", peer_port)
+    if method == "LOOKUP":
+        rfc_number = rng.randrange(1, rfc_space)
+        return peer.format_lookup(rfc_number, peer_port, f"RFC {rfc_number} Title", deflate)
+    return peer.format_list(peer_port, deflate)
+
+
+async def read_response(reader):
+    """Read one CI response; returns its status code."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    code = int(head.split(None, 2)[1])
+    # every 200 to ADD, LOOKUP and LIST ALL has entry lines and a closing blank line,
+    # or, compressed, a Content-Length of deflate stream
+    if code == 200:
+        _, headers = peer.parse_head(head[:-4])
+        if headers.get("Content-Encoding") == "deflate":
+            zlib.decompress(await reader.readexactly(int(headers["Content-Length"])))
+        else:
+            await reader.readuntil(b"\r\n\r\n")
+    return code
+
+
+async def read_frame_status(reader):
+    """Read one P2P-CI/2.0 response frame; returns its status code."""
+    size = shift = 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        size |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return peer.FrameReader(await reader.readexactly(size)).varint()
+
+
+async def upgrade(reader, writer, peer_port):
+    writer.write(f"OPTIONS P2P-CI/1.0\r\nHost: {peer.PEER_HOST}\r\nPort: {peer_port}\r\n"
+                 f"Upgrade: {peer.V2_VERSION}\r\n\r\n".encode())
+    status = await reader.readuntil(b"\r\n\r\n")
+    if not status.startswith(f"{peer.V2_VERSION} 101".encode()):
+        raise ConnectionError("server did not switch to P2P-CI/2.0")
+
+
+async def run_peer(index, args, start_at, stop_at, results):
+    rng = random.Random(index)
+    peer_port = BASE_PORT + index
+    reader, writer = await asyncio.open_connection(args.host, args.port, limit=STREAM_LIMIT)
+    read = read_response
+    try:
+        if args.protocol == 2:
+            await upgrade(reader, writer, peer_port)
+            read = read_frame_status
+        # registration: all of this peer's ADDs pipelined in one write
+        numbers = rng.sample(range(1, args.rfc_space), min(args.rfcs_per_peer, args.rfc_space - 1))
+        if numbers:
+            if args.protocol == 2:
+                adds = (peer.encode_add_v2(n, f"RFC {n} Title") for n in numbers)
+            else:
+                adds = (peer.format_add(n, f"RFC {n} Title", peer_port) for n in numbers)
+            writer.write(b"".join(adds))
+            for _ in numbers:
+                if await read(reader) != 200:
+                    results["setup_errors"] += 1
+            results["setup_adds"] += len(numbers)
+
+        await asyncio.sleep(max(0.0, start_at - time.time()))
+        methods = list(args.mix)
+        weights = [args.mix[m] for m in methods]
+        while time.time() < stop_at:
+            method = rng.choices(methods, weights)[0]
+            request = request_for(method, rng, peer_port, args.rfc_space, args.protocol, args.deflate)
+            t0 = time.perf_counter()
+            writer.write(request)
+            code = await read(reader)
+            results["latency"][method].append(time.perf_counter() - t0)
+            if code != 200 and not (code == 404 and method != "ADD"):
+                results["errors"][method] = results["errors"].get(method, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run_peers(indexes, args, start_at, stop_at):
+    results = {"latency": {m: [] for m in METHODS}, "errors": {},
+               "setup_adds": 0, "setup_errors": 0, "failed_peers": {}}
+    outcomes = await asyncio.gather(*(run_peer(i, args, start_at, stop_at, results) for i in indexes),
+                                    return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            name = type(outcome).__name__
+            results["failed_peers"][name] = results["failed_peers"].get(name, 0) + 1
+    return results
+
+
+def client_process(indexes, args, start_at, stop_at, out):
+    raise_fd_limit()
+    out.put(asyncio.run(run_peers(indexes, args, start_at, stop_at)))
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, extra_args):
+    command = [sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port),
+               "--log-level", "WARNING"] + extra_args
+    process = subprocess.Popen(command)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"server exited with code {process.returncode} before listening")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    sys.exit("server did not start listening within 10s")
+
+
+def process_tree(pid):
+    """pid plus all of its descendants, read from /proc; [] where /proc is unavailable."""
+    children = {}
+    try:
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                try:
+                    with open(f"/proc/{name}/stat") as f:
+                        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                except OSError:
+                    continue
+                children.setdefault(ppid, []).append(int(name))
+    except OSError:
+        return []
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        todo.extend(children.get(current, ()))
+    return tree
+
+
+def rss_bytes(pid):
+    """Resident memory of the server, summed over its worker processes, or None if unknown."""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total or None
+
+
+def server_stats(host, port):
+    """The server's own STATS lines as {name: value}, or {} if it does not support STATS."""
+    try:
+        with socket.create_connection((host, port), timeout=5) as sock:
+            ci_file = peer.CIStream(sock)
+            ci_file.write(b"STATS P2P-CI/1.0\r\n\r\n")
+            ci_file.flush()
+            _status, code, _headers, lines = peer.read_response(ci_file, True)
+    except OSError:
+        return {}
+    if code != 200:
+        return {}
+    stats = {}
+    for line in lines:
+        name, _, value = line.rpartition(" ")
+        try:
+            stats[name] = float(value)
+        except ValueError:
+            pass
+    return stats
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def summarize(per_process, seconds):
+    latency = {m: [] for m in METHODS}
+    errors = {}
+    summary = {"setup_adds": 0, "setup_errors": 0}
+    failed = {}
+    for results in per_process:
+        for method, samples in results["latency"].items():
+            latency[method].extend(samples)
+        for method, count in results["errors"].items():
+            errors[method] = errors.get(method, 0) + count
+        for key in summary:
+            summary[key] += results[key]
+        for name, count in results["failed_peers"].items():
+            failed[name] = failed.get(name, 0) + count
+
+    methods = {}
+    for method, samples in latency.items():
+        if not samples:
+            continue
+        samples.sort()
+        methods[method] = {
+            "requests": len(samples),
+            "throughput": len(samples) / seconds,
+            "errors": errors.get(method, 0),
+            "p50": percentile(samples, 0.5),
+            "p99": percentile(samples, 0.99),
+            "p999": percentile(samples, 0.999),
+            "max": samples[-1],
+        }
+    total = sum(m["requests"] for m in methods.values())
+    summary.update(requests=total, throughput=total / seconds, methods=methods, failed_peers=failed)
+    return summary
+
+
+def compare(result, baseline, tolerance):
+    """Regressions of result against baseline, as human-readable strings."""
+    regressions = []
+
+    def check(name, new, old, higher_is_better):
+        if new is None or not old:
+            return
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(f"{name}: {old:.6g} -> {new:.6g} ({change:+.1%})")
+
+    check("throughput", result["throughput"], baseline.get("throughput"), True)
+    for method, stats in result["methods"].items():
+        old = baseline.get("methods", {}).get(method)
+        if old is None:
+            continue
+        check(f"{method} throughput", stats["throughput"], old["throughput"], True)
+        for q in ("p50", "p99"):
+            check(f"{method} {q}", stats[q], old[q], False)
+    old_rss = (baseline.get("server_rss_bytes") or {}).get("peak")
+    new_rss = (result.get("server_rss_bytes") or {}).get("peak")
+    check("server peak RSS", new_rss, old_rss, False)
+    return regressions
+
+
+def print_report(result):
+    print(f"{'method':<8} {'requests':>9} {'req/s':>10} {'p50':>9} {'p99':>9} {'p999':>9} {'errors':>7}",
+          file=sys.stderr)
+    for method, stats in result["methods"].items():
+        print(f"{method:<8} {stats['requests']:>9} {stats['throughput']:>10.0f} "
+              f"{stats['p50'] * 1e3:>7.2f}ms {stats['p99'] * 1e3:>7.2f}ms {stats['p999'] * 1e3:>7.2f}ms "
+              f"{stats['errors']:>7}", file=sys.stderr)
+    print(f"total {result['requests']} requests, {result['throughput']:.0f} req/s; "
+          f"{result['setup_adds']} registrations in {result['setup_seconds']:.2f}s", file=sys.stderr)
+    rss = result.get("server_rss_bytes")
+    if rss:
+        print(f"server RSS: {rss['after_setup'] / 2**20:.1f} MiB after setup, "
+              f"{rss['peak'] / 2**20:.1f} MiB peak", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--peers", type=int, default=1000, help="simulated peers, one CI connection each")
+    parser.add_argument("--rfcs-per-peer", type=int, default=50)
+    parser.add_argument("--rfc-space", type=int, default=20000, help="RFC numbers are drawn from 1..N-1")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("add=1,lookup=20,list=0.1"),
+                        help="relative weights of ADD, LOOKUP and LIST (default add=1,lookup=20,list=0.1)")
+    parser.add_argument("--seconds", type=float, default=10.0, help="length of the measured phase")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=1,
+                        help="1: text requests; 2: upgrade each connection to binary P2P-CI/2.0")
+    parser.add_argument("--deflate", action="store_true",
+                        help="ask for compressed LOOKUP and LIST bodies (protocol 1 only)")
+    parser.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="client processes the peers are spread over")
+    parser.add_argument("--server-args", default="", help="extra arguments for server.py, e.g. '--workers 4'")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="benchmark a running server instead")
+    parser.add_argument("--output", help="write the JSON results here (default stdout)")
+    parser.add_argument("--compare", metavar="JSON", help="baseline results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="relative slowdown --compare accepts (default 0.10)")
+    args = parser.parse_args()
+
+    server = None
+    if args.connect:
+        args.host, _, port = args.connect.rpartition(":")
+        args.port = int(port)
+    else:
+        args.host, args.port = "127.0.0.1", free_port()
+        server = start_server(args.port, args.server_args.split())
+
+    try:
+        out = multiprocessing.Queue()
+        setup_budget = 5 + args.peers * args.rfcs_per_peer / 20000  # generous time to register
+        start_at = time.time() + setup_budget
+        stop_at = start_at + args.seconds
+        clients = [multiprocessing.Process(target=client_process,
+                                           args=(range(i, args.peers, args.clients), args, start_at, stop_at, out))
+                   for i in range(args.clients)]
+        setup_started = time.time()
+        for client in clients:
+            client.start()
+
+        # registration has finished once the server's entry count stops climbing
+        expected = args.peers * args.rfcs_per_peer
+        rss = {"after_setup": None, "peak": 0}
+        setup_seconds = None
+        while time.time() < stop_at:
+            if setup_seconds is None:
+                entries = server_stats(args.host, args.port).get("index_entries", 0)
+                if entries >= expected * 0.99 or time.time() >= start_at:
+                    setup_seconds = time.time() - setup_started
+            if server is not None:
+                current = rss_bytes(server.pid)
+                if current is not None:
+                    rss["peak"] = max(rss["peak"], current)
+                    if rss["after_setup"] is None and time.time() >= start_at:
+                        rss["after_setup"] = current
+            time.sleep(0.5)
+
+        per_process = [out.get() for _ in clients]
+        for client in clients:
+            client.join()
+    finally:
+        stats = server_stats(args.host, args.port)
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    result = summarize(per_process, args.seconds)
+    result.update(
+        setup_seconds=setup_seconds or 0.0,
+        server_rss_bytes=rss if server is not None and rss["peak"] else None,
+        server_stats=stats,
+        config={"peers": args.peers, "rfcs_per_peer": args.rfcs_per_peer, "rfc_space": args.rfc_space,
+                "mix": args.mix, "seconds": args.seconds, "clients": args.clients, "protocol": args.protocol,
+                "deflate": args.deflate, "server_args": args.server_args, "connect": args.connect},
+        environment={"python": sys.version.split()[0], "platform": sys.platform,
+                     "cpus": os.cpu_count(), "revision": git_revision(), "timestamp": time.time()},
+    )
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    print_report(result)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
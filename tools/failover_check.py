@@ -0,0 +1,173 @@
+"""Hot-standby failover check for the CI server, on localhost.
+
+Starts a primary with --replication-port and a standby following it, registers
+--entries RFCs for a peer on the primary, and checks that the standby has them,
+answers LOOKUPs and refuses writes. It then kills the primary with SIGKILL and
+checks that the standby promotes itself and that the peer's KEEPALIVE resumes
+its old session there with every record in place. Exits non-zero on a failure.
+
+    python tools/failover_check.py --entries 10000 --promote-after 2
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PEER = ("peer-a", 5001)
+
+
+class Client:
+    """A bare P2P-CI/1.0 connection: request() returns (status, headers, body lines)."""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+        self.file = self.sock.makefile("rwb")
+
+    def request(self, line, headers=(), body=(), has_body=False):
+        text = line + "\r\n" + "".join(f"{name}: {value}\r\n" for name, value in headers) + "\r\n"
+        self.file.write((text + "".join(body)).encode())
+        self.file.flush()
+        status = self.file.readline().decode().strip()
+        reply = {}
+        while True:
+            header = self.file.readline().decode().strip()
+            if not header:
+                break
+            name, _, value = header.partition(":")
+            reply[name.strip()] = value.strip()
+        lines = []
+        if has_body and " 200 " in status:
+            while True:
+                entry = self.file.readline().decode().strip()
+                if not entry:
+                    break
+                lines.append(entry)
+        return status, reply, lines
+
+    def close(self):
+        self.sock.close()
+
+
+def peer_headers():
+    return (("Host", PEER[0]), ("Port", PEER[1]))
+
+
+def stats(port):
+    client = Client(port)
+    _, _, lines = client.request("STATS P2P-CI/1.0", has_body=True)
+    client.close()
+    return dict(line.rsplit(" ", 1) for line in lines)
+
+
+def wait_listening(process, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def check(ok, what):
+    print(f"{'ok  ' if ok else 'FAIL'} {what}", flush=True)
+    if not ok:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=10000, help="RFCs to register (default 10000)")
+    parser.add_argument("--base-port", type=int, default=7760,
+                        help="primary, its replication port and the standby take this and the next two")
+    parser.add_argument("--promote-after", type=float, default=2, help="standby's --promote-after (default 2)")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="-- then extra arguments for both servers")
+    args = parser.parse_args()
+    extra = args.server_args[1:] if args.server_args[:1] == ["--"] else args.server_args
+    primary_port, replication_port, standby_port = args.base_port, args.base_port + 1, args.base_port + 2
+    server = [sys.executable, os.path.join(ROOT, "server.py"), "--lease-ttl", "60", "--log-level", "WARNING"]
+
+    processes = []
+    try:
+        primary = subprocess.Popen(server + ["--port", str(primary_port),
+                                             "--replication-port", str(replication_port)] + extra)
+        processes.append(primary)
+        check(wait_listening(primary, primary_port), "primary started")
+        standby = subprocess.Popen(server + ["--port", str(standby_port),
+                                             "--standby-of", f"127.0.0.1:{replication_port}",
+                                             "--promote-after", str(args.promote_after)] + extra)
+        processes.append(standby)
+        check(wait_listening(standby, standby_port), "standby started")
+
+        client = Client(primary_port)
+        _, reply, _ = client.request("KEEPALIVE P2P-CI/1.0", peer_headers())
+        token = reply.get("Session")
+        entries = [f"RFC {n} Title of RFC {n}\r\n" for n in range(1, args.entries + 1)]
+        for i in range(0, len(entries), 5000):
+            chunk = entries[i:i + 5000]
+            status, _, _ = client.request("ADD RFCS P2P-CI/1.0", peer_headers() + (("Count", len(chunk)),),
+                                          chunk)
+        check(" 200 " in status and token, f"registered {args.entries} RFCs on the primary")
+
+        written = int(stats(primary_port)["replication_records_total"])
+        check(wait_for(lambda: int(stats(standby_port).get("replication_applied_records", 0)) >= written, 10),
+              "standby caught up")
+        lag = stats(standby_port)["replication_lag_seconds"]
+        print(f"     replication_lag_seconds {lag}")
+
+        reader = Client(standby_port)
+        status, _, lines = reader.request(f"LOOKUP RFC {args.entries} P2P-CI/1.0",
+                                          (("Host", "reader"), ("Port", 5002)), has_body=True)
+        check(" 200 " in status and len(lines) == 1, "standby answers LOOKUP")
+        status, reply, _ = reader.request("ADD RFC 1 P2P-CI/1.0", peer_headers() + (("Title", "x"),))
+        check(" 403 " in status and reply.get("Primary") == f"127.0.0.1:{primary_port}",
+              "standby refuses ADD and names the primary")
+        reader.close()
+
+        primary.send_signal(signal.SIGKILL)
+        primary.wait()
+        killed = time.time()
+
+        def promoted():
+            client = Client(standby_port)
+            _, reply, _ = client.request("OPTIONS P2P-CI/1.0")
+            client.close()
+            return "Primary" not in reply
+        check(wait_for(promoted, args.promote_after + 10), "standby promoted itself")
+        print(f"     failover took {time.time() - killed:.2f}s")
+
+        client = Client(standby_port)
+        _, reply, _ = client.request("KEEPALIVE P2P-CI/1.0", peer_headers() + (("Session", token),))
+        check(reply.get("Resumed") == "yes", "peer resumed its session on the new primary")
+        status, _, lines = client.request("LIST ALL P2P-CI/1.0", peer_headers(), has_body=True)
+        check(len(lines) == args.entries, f"all {args.entries} records survived")
+        status, _, _ = client.request("ADD RFC 0 P2P-CI/1.0", peer_headers() + (("Title", "After failover"),),
+                                      has_body=True)
+        check(" 200 " in status, "new primary takes writes")
+        client.close()
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Run a sharded CI tier on localhost.
+
+Starts --count server.py instances on consecutive ports from --base-port, each
+started with the full --shards list so it owns its slice of the RFC numbers.
+Point a peer at any of them; it learns the others from OPTIONS. Anything after
+"--" is passed to every instance. Ctrl-C stops them all.
+
+    python tools/run_shards.py --count 3 --base-port 7734 -- --engine asyncio
+
+To grow the tier, stop it and start it again with a larger --count: consistent
+hashing moves only the RFCs the new shards take over, and peers re-register
+those on their next connection.
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_listening(process, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=3, help="shards to start (default 3)")
+    parser.add_argument("--base-port", type=int, default=7734, help="port of the first shard (default 7734)")
+    parser.add_argument("--host", default="127.0.0.1", help="address peers reach the shards at")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="-- then extra arguments for server.py")
+    args = parser.parse_args()
+    extra = args.server_args[1:] if args.server_args[:1] == ["--"] else args.server_args
+
+    # stop the shards on a plain kill too, not only on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    ports = [args.base_port + i for i in range(args.count)]
+    shards = ",".join(f"{args.host}:{port}" for port in ports)
+    processes = []
+    try:
+        for port in ports:
+            command = [sys.executable, os.path.join(ROOT, "server.py"), "--port", str(port),
+                       "--shards", shards, "--shard-name", f"{args.host}:{port}"] + extra
+            process = subprocess.Popen(command)
+            processes.append(process)
+            if not wait_listening(process, port):
+                sys.exit(f"shard on port {port} did not start")
+        print(f"{args.count} shard(s) up: {shards}", flush=True)
+        while all(process.poll() is None for process in processes):
+            time.sleep(0.5)
+        sys.exit("a shard exited; stopping the rest")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()